@@ -0,0 +1,262 @@
+"""
+Benchmarks, run them with `python benchmarks.py <benchmark> [arguments]`:
+
+    notifications [companies] [tasks] [issues] [concurrency]
+        Wall time and HTTP calls of trigger_notifications against the JIRA stand-in. It exits with an error if a run
+        makes more calls than expected (it's a regression gate on network efficiency)
+
+    storage [companies] [days] [tasks per day] [results file]
+        Wall time of ingesting (update_tasks), re-ingesting (the update path), loading the companies (get_company),
+        selecting the pending tasks and the reports, on a scratch SQLite file filled with generated data (see
+        test_data.generate_companies). The results are written as JSON so they can be compared across commits
+
+    ingestion [companies] [days] [entries per day]
+        Wall time of splitting raw (start, end, description) entries at the local midnights of each company and
+        aggregating them (TimeTrackingAggregator.add_intervals). It exits with an error if it takes more than a second
+"""
+from business_logic.aggregation import TimeTrackingAggregator
+from business_logic.managers import CompaniesMgr, PluginsManager
+from business_logic.models import Company, get_models
+from playhouse.test_utils import test_database
+from plugins.notification.jira_plugin import ISSUES_SEARCH_CHUNK_SIZE
+from test_data import generate_companies
+from test_servers import JiraStubServer
+import collections
+import datetime
+import itertools
+import json
+import math
+import os
+import peewee
+import platform
+import pytz
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+def benchmark_notifications(companies=10, tasks=100, issues=20, concurrency=1):
+    """ Measures trigger_notifications for `companies` companies with `tasks` tasks each, spread over `issues` issues
+
+    Three runs are measured: the initial one (every worklog is created), one after all the tasks changed (every
+    worklog is updated) and one where nothing changed.
+
+    :return: The name of each run, with its wall time, HTTP calls and max HTTP calls expected
+    :rtype: [(str, dict)]
+    """
+    server = JiraStubServer().start()
+    # each company works on its own project
+    keys = [['BENCH%d-%d' % (c, i + 1) for i in range(issues)] for c in range(companies)]
+    server.reset(sum(keys, []))
+    date = datetime.date(2014, 1, 1)
+
+    notification_plugins = [{
+        'notification_plugin': 'jira_plugin.JiraIssueTrackingPlugin',
+        'notification_data': {'server': server.jira_url, 'username': 'admin', 'password': 'admin',
+                              'ticket_regexps': ['BENCH[0-9]+-[0-9]+'], 'concurrency': concurrency}
+    }]
+
+    searches = int(math.ceil(issues / float(ISSUES_SEARCH_CHUNK_SIZE)))
+    # per company: searching the issues, listing the worklogs of each one, creating / updating each worklog
+    expected = [('initial', searches + issues + tasks), ('changed', searches + tasks), ('unchanged', 0)]
+
+    results = []
+    try:
+        with test_database(peewee.SqliteDatabase(':memory:'), get_models()):
+            company_ids = []
+            for i in range(companies):
+                company = Company(name='Company %d' % i, notification_plugins=notification_plugins,
+                                  timezone='US/Pacific', time_tracking_plugin='test.TimeTrackingTestPlugin',
+                                  time_tracking_data={'responses': {}})
+                company.save()
+                company_ids.append(company.id)
+
+            # the plugin is created (and connects to the server) only once, that's not part of the runs
+            PluginsManager.reset_pool()
+            PluginsManager.get_notification_plugin(notification_plugins[0]['notification_plugin'],
+                                                   **notification_plugins[0]['notification_data'])
+
+            for run, expected_calls in expected:
+                for c, company_id in enumerate(company_ids):
+                    seconds = 60 if run == 'initial' else 120
+                    CompaniesMgr.update_tasks(company_id, date, [
+                        {'description': '%s task %d' % (keys[c][t % issues], t), 'seconds': seconds}
+                        for t in range(tasks)])
+
+                calls_before = len(server.requests)
+                start = time.time()
+                for company_id in company_ids:
+                    CompaniesMgr.trigger_notifications(company_id)
+                elapsed = time.time() - start
+
+                results.append((run, {
+                    'seconds': elapsed,
+                    'http_calls': len(server.requests) - calls_before,
+                    'max_http_calls': expected_calls * companies
+                }))
+    finally:
+        PluginsManager.reset_pool()
+        server.stop()
+
+    return results
+
+
+def benchmark_storage(companies=100, days=30, tasks_per_day=20):
+    """ Measures the storage layer on a scratch SQLite file with `companies` generated companies, each one with
+    `tasks_per_day` tasks on each of `days` days (so thousands of companies and millions of tasks are a matter of the
+    arguments)
+
+    :return: The seconds and amount of operations of each step
+    :rtype: collections.OrderedDict
+    """
+    fd, path = tempfile.mkstemp(prefix='horas-bench-', suffix='.db')
+    os.close(fd)
+
+    results = collections.OrderedDict()
+
+    def measure(step, fn):
+        start = time.time()
+        operations = fn()
+        elapsed = time.time() - start
+        results[step] = {'seconds': elapsed, 'operations': operations,
+                         'operations_per_second': operations / elapsed if elapsed else None}
+
+    def ingest(company_ids, changed_every=None):
+        tasks = 0
+        for company_id, data in itertools.izip(company_ids, generate_companies(companies, days, tasks_per_day)):
+            for snapshot, entries in sorted(data['time_tracking_data']['responses'].items()):
+                if changed_every is not None:
+                    entries = [dict(entry, seconds=entry['seconds'] + (60 if i % changed_every == 0 else 0))
+                               for i, entry in enumerate(entries)]
+                CompaniesMgr.update_tasks(company_id, snapshot.date(), entries)
+                tasks += len(entries)
+        return tasks
+
+    try:
+        with test_database(peewee.SqliteDatabase(path), get_models()):
+            company_ids = []
+
+            def create_companies():
+                for data in generate_companies(companies, days=0):
+                    company = Company(name=data['name'], notification_plugins=data['notification_plugins'],
+                                      timezone=data['timezone'], time_tracking_plugin=data['time_tracking_plugin'],
+                                      time_tracking_data=data['time_tracking_data'])
+                    company.save()
+                    company_ids.append(company.id)
+                return len(company_ids)
+
+            def get_companies():
+                for company_id in company_ids:
+                    CompaniesMgr.get_company(company_id).notification_plugins
+                return len(company_ids)
+
+            def select_pending(version):
+                return lambda: sum(len(list(CompaniesMgr.get_pending_tasks(company_id, version)))
+                                   for company_id in company_ids)
+
+            measure('create_companies', create_companies)
+            measure('ingest', lambda: ingest(company_ids))
+            measure('get_company', get_companies)
+            # every update_tasks call is a new version, the ingest left each company on version `days`
+            measure('pending_tasks_all', select_pending(0))
+            measure('reingest', lambda: ingest(company_ids, changed_every=3))
+            measure('pending_tasks_changed', select_pending(days))
+            measure('reingest_unchanged', lambda: ingest(company_ids, changed_every=3))
+
+            def report(group_by):
+                start = datetime.date(2014, 1, 1)
+                end = start + datetime.timedelta(days=days)
+                return lambda: sum(len(CompaniesMgr.get_report(company_id, start, end, group_by))
+                                   for company_id in company_ids)
+
+            measure('report_month', report('month'))
+            measure('report_issue', report('issue'))
+
+            results['database_bytes'] = os.path.getsize(path)
+    finally:
+        os.remove(path)
+
+    return results
+
+
+def benchmark_ingestion(companies=50, days=30, entries_per_day=20):
+    """ Measures the aggregation of raw entries of `companies` companies on different timezones, each one with
+    `entries_per_day` entries (some of them spanning midnight) on each of `days` days
+
+    :return: The seconds and amount of entries aggregated
+    :rtype: dict
+    """
+    rand = random.Random(0)
+    timezones = ['US/Pacific', 'Europe/London', 'Asia/Kolkata', 'Australia/Sydney', 'America/Sao_Paulo']
+    start = datetime.datetime(2014, 3, 1)
+
+    data = []
+    for company in range(companies):
+        intervals = []
+        for day in range(days):
+            for entry in range(entries_per_day):
+                entry_start = start + datetime.timedelta(days=day, seconds=rand.randint(0, 24 * 3600))
+                intervals.append((entry_start, entry_start + datetime.timedelta(seconds=rand.randint(60, 4 * 3600)),
+                                  'task %d' % rand.randint(0, entries_per_day)))
+        data.append((pytz.timezone(timezones[company % len(timezones)]), intervals))
+
+    begin = time.time()
+    for timezone, intervals in data:
+        TimeTrackingAggregator().add_intervals(intervals, timezone).get_results()
+    elapsed = time.time() - begin
+
+    entries = companies * days * entries_per_day
+    return {'seconds': elapsed, 'operations': entries, 'operations_per_second': entries / elapsed if elapsed else None}
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in ('notifications', 'storage', 'ingestion'):
+        print __doc__
+        sys.exit(1)
+
+    if argv[1] == 'notifications':
+        args = [int(arg) for arg in argv[2:]]
+        results = benchmark_notifications(*args)
+
+        print json.dumps(dict(results), indent=2, sort_keys=True)
+        if any(res['http_calls'] > res['max_http_calls'] for run, res in results):
+            print 'Too many HTTP calls'
+            sys.exit(1)
+    elif argv[1] == 'ingestion':
+        args = [int(arg) for arg in argv[2:]]
+        results = benchmark_ingestion(*args)
+
+        print json.dumps(results, indent=2, sort_keys=True)
+        if results['seconds'] > 1:
+            print 'Too slow'
+            sys.exit(1)
+    else:
+        args = [int(arg) for arg in argv[2:5]]
+        parameters = dict(zip(['companies', 'days', 'tasks_per_day'], args))
+        results = {
+            'benchmark': 'storage',
+            'commit': get_git_commit(),
+            'python': platform.python_version(),
+            'sqlite': peewee.sqlite3.sqlite_version,
+            'parameters': parameters,
+            'results': benchmark_storage(**parameters)
+        }
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        print output
+        if len(argv) > 5:
+            with open(argv[5], 'w') as f:
+                f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
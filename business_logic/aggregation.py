@@ -0,0 +1,160 @@
+from array import array
+import bisect
+import calendar
+import datetime
+import itertools
+import pytz
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def get_timestamp(value):
+    """ Gets the seconds since the epoch of a datetime (naive ones are in UTC), or of a timestamp
+
+    :param value: The time
+    :type value: datetime.datetime | int | float
+    :rtype: int
+    """
+    if isinstance(value, datetime.datetime):
+        delta = (value.replace(tzinfo=None) - value.utcoffset() if value.tzinfo is not None else value) - EPOCH
+        return delta.days * 86400 + delta.seconds
+    return int(value)
+
+
+def get_local_midnights(timezone, first_date, last_date):
+    """ Gets the time each day from first_date to last_date (both included) starts on a timezone, plus the time the
+    day after last_date starts. A midnight skipped by DST is moved forward as much as the clocks were.
+
+    :param timezone: The timezone
+    :type timezone: pytz.tzinfo.BaseTzInfo
+    :param first_date: The first date
+    :type first_date: datetime.date
+    :param last_date: The last date
+    :type last_date: datetime.date
+    :return: The timestamps (seconds since the epoch)
+    :rtype: array
+    """
+    res = array('d')
+    for days in range((last_date - first_date).days + 2):
+        naive = datetime.datetime.combine(first_date + datetime.timedelta(days=days), datetime.time())
+        try:
+            local = timezone.localize(naive, is_dst=None)
+        except pytz.AmbiguousTimeError:
+            local = timezone.localize(naive, is_dst=True)
+        except pytz.NonExistentTimeError:
+            local = timezone.normalize(timezone.localize(naive, is_dst=False))
+        res.append(calendar.timegm(local.utctimetuple()))
+    return res
+
+
+class TimeTrackingAggregator(object):
+    """
+    Sums the seconds of time tracking entries per (date, description) in a single pass, as they arrive. Only the
+    totals are kept, so entries can come from a generator of any size.
+    """
+
+    def __init__(self):
+        self.totals = {}
+
+    def add(self, date, description, seconds):
+        """ Adds the seconds of a single entry
+
+        :param date: The date of the entry
+        :type date: datetime.date
+        :param description: The description of the entry
+        :type description: str
+        :param seconds: The seconds spent
+        :type seconds: int
+        :return: void
+        """
+        key = (date, description)
+        self.totals[key] = self.totals.get(key, 0) + seconds
+
+    def add_entries(self, entries, date=None):
+        """ Adds time tracking entries (dicts with 'description', 'seconds' and optionally 'date')
+
+        :param entries: The entries to add
+        :type entries: iterable
+        :param date: The date of the entries that don't have one
+        :type date: datetime.date
+        :return: The aggregator itself
+        :rtype: TimeTrackingAggregator
+        """
+        totals = self.totals
+        for entry in entries:
+            key = (entry.get('date', date), entry['description'])
+            totals[key] = totals.get(key, 0) + entry['seconds']
+        return self
+
+    def add_results(self, time_tracking_results_by_date):
+        """ Adds time tracking results keyed by date (as the time tracking plugins return them)
+
+        :param time_tracking_results_by_date: The entries of each date
+        :type time_tracking_results_by_date: dict
+        :return: The aggregator itself
+        :rtype: TimeTrackingAggregator
+        """
+        for date, entries in time_tracking_results_by_date.items():
+            self.add_entries(entries, date)
+        return self
+
+    def add_intervals(self, intervals, timezone):
+        """ Adds raw time tracking entries, given as (start, end, description), on the dates of a timezone
+
+        The entries that span midnight are split, so each local date gets the seconds spent on it. The midnights of
+        the dates the entries cover are computed once, and the dates of each entry are found with a binary search on
+        them, so no timezone conversion is done per entry.
+
+        :param intervals: The entries, start and end are datetimes (naive ones are in UTC) or timestamps
+        :type intervals: iterable
+        :param timezone: The timezone whose dates are used
+        :type timezone: pytz.tzinfo.BaseTzInfo
+        :return: The aggregator itself
+        :rtype: TimeTrackingAggregator
+        """
+        starts, ends, descriptions = array('d'), array('d'), []
+        for start, end, description in intervals:
+            starts.append(get_timestamp(start))
+            ends.append(get_timestamp(end))
+            descriptions.append(description)
+
+        if len(descriptions) == 0:
+            return self
+
+        # no timezone is more than a day away from UTC
+        first_date = datetime.datetime.utcfromtimestamp(min(starts)).date() - datetime.timedelta(days=1)
+        last_date = datetime.datetime.utcfromtimestamp(max(ends)).date() + datetime.timedelta(days=1)
+        midnights = get_local_midnights(timezone, first_date, last_date)
+        dates = [first_date + datetime.timedelta(days=days) for days in range(len(midnights))]
+
+        totals = self.totals
+        for start, end, description in itertools.izip(starts, ends, descriptions):
+            day = bisect.bisect_right(midnights, start) - 1
+            while start < end:
+                boundary = min(end, midnights[day + 1])
+                key = (dates[day], description)
+                totals[key] = totals.get(key, 0) + int(boundary - start)
+                start = boundary
+                day += 1
+        return self
+
+    def get_totals(self, date):
+        """ Gets the seconds spent on each description on a date
+
+        :param date: The date
+        :type date: datetime.date
+        :return: The seconds of each description
+        :rtype: dict
+        """
+        return dict((description, seconds) for (day, description), seconds in self.totals.items() if day == date)
+
+    def get_results(self):
+        """ Gets the aggregated entries keyed by date, the way the time tracking plugins return them
+
+        :return: The entries (dicts with 'description' and 'seconds') of each date
+        :rtype: dict
+        """
+        res = {}
+        for (date, description), seconds in self.totals.items():
+            res.setdefault(date, []).append({'description': description, 'seconds': seconds})
+        return res
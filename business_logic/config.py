@@ -0,0 +1,76 @@
+import datetime
+import json
+import pickle
+
+# version of the format written by encode_config
+CONFIG_FORMAT_VERSION = 1
+
+
+def _to_json_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'__date__': value.isoformat()}
+    if isinstance(value, dict):
+        if all(isinstance(k, basestring) for k in value):
+            return dict((k, _to_json_value(v)) for k, v in value.items())
+        # json only supports string keys, so keep the (key, value) pairs (sorted, so the output is stable)
+        return {'__items__': [[_to_json_value(k), _to_json_value(v)] for k, v in sorted(value.items())]}
+    if isinstance(value, (list, tuple)):
+        return [_to_json_value(v) for v in value]
+    return value
+
+
+def _from_json_object(obj):
+    if '__datetime__' in obj:
+        value = obj['__datetime__']
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+    if '__date__' in obj:
+        return datetime.datetime.strptime(obj['__date__'], '%Y-%m-%d').date()
+    if '__items__' in obj:
+        return dict((_freeze(k), v) for k, v in obj['__items__'])
+    return obj
+
+
+def _freeze(value):
+    # lists can't be dict keys, tuples were converted to lists when encoding
+    return tuple(value) if isinstance(value, list) else value
+
+
+def encode_config(value):
+    """ Encodes a configuration value (plugin data, notification plugins) to be stored on the db
+
+    :param value: The value to encode
+    :return: The versioned json representation of the value
+    :rtype: str
+    """
+    return json.dumps({'version': CONFIG_FORMAT_VERSION, 'data': _to_json_value(value)}, sort_keys=True)
+
+
+def is_legacy_config(raw):
+    """ Checks if a stored configuration uses the old pickle format
+
+    :param raw: The stored configuration
+    :type raw: str
+    :rtype: bool
+    """
+    return not raw.startswith('{')
+
+
+def decode_config(raw):
+    """ Decodes a configuration stored on the db
+
+    Configurations stored before the json format existed are still unpickled, but the migrate command rewrites them.
+
+    :param raw: The stored configuration
+    :type raw: str
+    :return: The decoded value
+    """
+    if is_legacy_config(raw):
+        return pickle.loads(str(raw))
+
+    stored = json.loads(raw, object_hook=_from_json_object)
+    if stored.get('version') != CONFIG_FORMAT_VERSION:
+        raise ValueError('Unknown configuration format version: %s' % stored.get('version'))
+
+    return stored['data']
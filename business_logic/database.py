@@ -0,0 +1,111 @@
+from instrumentation import InstrumentedSqliteDatabase
+import threading
+
+# applied (in this order) to every new connection: readers don't block the writer nor each other with WAL, and with
+# it a normal sync is still safe
+DEFAULT_PRAGMAS = [
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('cache_size', -16000),
+]
+
+
+class PooledSqliteDatabase(InstrumentedSqliteDatabase):
+    """
+    Sqlite database where each thread gets its own connection, configured with the given pragmas and a busy timeout
+    (so concurrent writers wait for each other instead of failing with "database is locked").
+
+    Closed connections go back to a small pool and are reused by the next thread that needs one. Transactions take
+    the write lock when they begin, so a transaction that reads before writing can't be deadlocked by another writer.
+    """
+
+    def __init__(self, database, pragmas=None, busy_timeout=30, pool_size=4, **kwargs):
+        """
+        :param database: The path of the database file
+        :type database: str
+        :param pragmas: The pragmas of each connection, as (name, value) tuples. Defaults to DEFAULT_PRAGMAS
+        :type pragmas: [(str, str)]
+        :param busy_timeout: Seconds a connection waits for another one to release the database
+        :type busy_timeout: float
+        :param pool_size: Max amount of idle connections kept to be reused
+        :type pool_size: int
+        """
+        self.pragmas = DEFAULT_PRAGMAS if pragmas is None else pragmas
+        self.busy_timeout = busy_timeout
+        self.pool_size = pool_size
+        self._pool = []
+        self._pool_lock = threading.Lock()
+        kwargs.setdefault('threadlocals', True)
+        super(PooledSqliteDatabase, self).__init__(database, **kwargs)
+
+    def init(self, database, **connect_kwargs):
+        # connections are shared by the threads through the pool, and the transactions are started explicitly
+        connect_kwargs.update(timeout=self.busy_timeout, check_same_thread=False, isolation_level=None)
+        super(PooledSqliteDatabase, self).init(database, **connect_kwargs)
+
+    def configure(self, database=None, pragmas=None, busy_timeout=None, pool_size=None):
+        """ Changes the settings of the database, the idle connections are closed so the new ones use them
+
+        The connections the threads are using keep the previous settings until they're closed.
+
+        :param database: The path of the database file
+        :type database: str
+        :param pragmas: The pragmas of each connection, as (name, value) tuples
+        :type pragmas: [(str, str)]
+        :param busy_timeout: Seconds a connection waits for another one to release the database
+        :type busy_timeout: float
+        :param pool_size: Max amount of idle connections kept to be reused
+        :type pool_size: int
+        :return: void
+        """
+        if pragmas is not None:
+            self.pragmas = pragmas
+        if busy_timeout is not None:
+            self.busy_timeout = busy_timeout
+        if pool_size is not None:
+            self.pool_size = pool_size
+        self.init(database if database is not None else self.database, **self.connect_kwargs)
+        self.close_idle()
+
+    def _connect(self, database, **kwargs):
+        with self._pool_lock:
+            if self._pool:
+                return self._pool.pop()
+
+        conn = super(PooledSqliteDatabase, self)._connect(database, **kwargs)
+        for name, value in self.pragmas:
+            conn.execute('PRAGMA %s = %s;' % (name, value))
+        return conn
+
+    def _close(self, conn):
+        # a connection is never reused in the middle of a transaction
+        conn.rollback()
+        with self._pool_lock:
+            if len(self._pool) < self.pool_size:
+                self._pool.append(conn)
+                return
+        conn.close()
+
+    def close_idle(self):
+        """ Closes the connections in the pool
+
+        :return: void
+        """
+        with self._pool_lock:
+            pool, self._pool = self._pool, []
+        for conn in pool:
+            conn.close()
+
+    def begin(self):
+        self.get_conn().execute('BEGIN IMMEDIATE;')
+
+
+def release_connection(database):
+    """ Gives the connection of the current thread back to the pool, worker threads call it when they're done
+
+    :param database: The database
+    :type database: peewee.Database
+    :return: void
+    """
+    if isinstance(database, PooledSqliteDatabase) and not database.is_closed():
+        database.close()
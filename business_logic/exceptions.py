@@ -16,3 +16,11 @@ class CompanyNotFound(Exception):
 
 class InvalidPlugin(Exception):
     pass
+
+
+class InvalidReportGrouping(Exception):
+    pass
+
+
+class InvalidTaskFormat(Exception):
+    pass
@@ -0,0 +1,208 @@
+from peewee import SqliteDatabase
+import bisect
+import collections
+import json
+import threading
+import time
+
+# upper bounds (in milliseconds) of the latency histogram buckets, the last one takes everything slower
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+class Histogram(object):
+    """
+    Count, total and distribution of the latencies of a metric
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(BUCKETS_MS, seconds * 1000)] += 1
+
+    def percentile(self, p):
+        """ Gets an upper bound of the given percentile (the bound of the bucket it falls in)
+
+        :param p: The percentile, between 0 and 100
+        :type p: float
+        :return: The percentile, in seconds
+        :rtype: float
+        """
+        if self.count == 0:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, amount in enumerate(self.buckets):
+            seen += amount
+            if seen >= rank:
+                return min(BUCKETS_MS[i] / 1000.0, self.max) if i < len(BUCKETS_MS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'buckets_ms': dict(zip([str(b) for b in BUCKETS_MS] + ['inf'], self.buckets))
+        }
+
+
+class NullTimer(object):
+    """
+    What `timed` returns when the instrumentation is off, it does nothing
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+NULL_TIMER = NullTimer()
+
+
+class Timer(object):
+    def __init__(self, stats, metric, company_id):
+        self.stats = stats
+        self.metric = metric
+        self.company_id = company_id
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stats.record(self.metric, time.time() - self.start, self.company_id)
+        return False
+
+
+class CompanyContext(object):
+    def __init__(self, stats, company_id):
+        self.stats = stats
+        self.company_id = company_id
+
+    def __enter__(self):
+        self.previous = getattr(self.stats.local, 'company_id', None)
+        self.stats.local.company_id = self.company_id
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stats.local.company_id = self.previous
+        return False
+
+
+class Stats(object):
+    """
+    Opt-in counts and latency histograms of the hot paths (db queries, plugin creation, time tracking fetches,
+    notifications and HTTP requests), tagged by the company they were done for.
+
+    It's off by default. When it's off, `timed` and `company` return a shared object that does nothing, so the only
+    overhead is checking `enabled`.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.local = threading.local()
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    def current_company(self):
+        return getattr(self.local, 'company_id', None)
+
+    def company(self, company_id):
+        """ Tags everything recorded on this thread (inside the with block) with the given company
+
+        :param company_id: The ID of the company
+        :type company_id: int
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return CompanyContext(self, company_id)
+
+    def timed(self, metric, company_id=None):
+        """ Records the time spent on the with block
+
+        :param metric: The name of the metric
+        :type metric: str
+        :param company_id: The company it's done for, defaults to the current one on this thread (see `company`)
+        :type company_id: int
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, metric, company_id if company_id is not None else self.current_company())
+
+    def record(self, metric, seconds, company_id=None):
+        key = (metric, company_id)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.add(seconds)
+
+    def get_results(self):
+        """ Gets the histograms of each metric, for all the companies and for each of them
+
+        :return: The results of each metric: 'total' (a Histogram dict) and 'companies' (Histogram dicts by company)
+        :rtype: collections.OrderedDict
+        """
+        with self._lock:
+            histograms = dict(self._histograms)
+
+        res = collections.OrderedDict()
+        for metric in sorted(set(metric for metric, company_id in histograms)):
+            total = Histogram()
+            companies = collections.OrderedDict()
+            for (name, company_id), histogram in sorted(histograms.items()):
+                if name != metric:
+                    continue
+                total.count += histogram.count
+                total.total += histogram.total
+                total.max = max(total.max, histogram.max)
+                total.buckets = [a + b for a, b in zip(total.buckets, histogram.buckets)]
+                companies[company_id] = histogram.to_dict()
+            res[metric] = {'total': total.to_dict(), 'companies': companies}
+        return res
+
+    def dump(self, path):
+        """ Writes the results (see get_results) as JSON
+
+        :param path: The file to write them on
+        :type path: str
+        :return: void
+        """
+        with open(path, 'w') as f:
+            json.dump(self.get_results(), f, indent=2)
+
+stats = Stats()
+
+
+class InstrumentedSqliteDatabase(SqliteDatabase):
+    """
+    Sqlite database recording the time spent on each query (as 'db.query') when the instrumentation is on
+    """
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        if not stats.enabled:
+            return super(InstrumentedSqliteDatabase, self).execute_sql(sql, params, require_commit)
+
+        with stats.timed('db.query'):
+            return super(InstrumentedSqliteDatabase, self).execute_sql(sql, params, require_commit)
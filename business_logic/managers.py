@@ -1,11 +1,26 @@
 from exceptions import *
-from models import Company, Task
+from models import Company, Task, TimeTrackingWatermark, DailyTotal, DailyDigest
+from pool import PluginPool
+from ticket_matcher import TicketMatcher
+from aggregation import TimeTrackingAggregator
+from instrumentation import stats
+from database import release_connection
+from peewee import fn
+from multiprocessing.pool import ThreadPool
+import collections
+import hashlib
 import importlib
-import itertools
+import json
+import pytz
+import time
+import traceback
 from plugins.time_tracking.common import BaseTimeTrackingPlugin
 from plugins.notification.base import BaseNotificationPlugin
 import datetime
 
+# max amount of rows / parameters sent on each bulk statement (sqlite limits the variables per statement)
+BULK_CHUNK_SIZE = 100
+
 
 class CompaniesMgr(object):
     @staticmethod
@@ -43,6 +58,8 @@ class CompaniesMgr(object):
 
         company = Company(name=name, notification_plugins=notification_plugins, timezone=timezone,
                           time_tracking_plugin=time_tracking_plugin, time_tracking_data=time_tracking_data)
+        # it has no daily totals yet, so they're up to date with its regexps
+        company.totals_regexps_digest = CompaniesMgr.get_regexps_digest(company)
         company.save()
 
         return company.id
@@ -76,41 +93,506 @@ class CompaniesMgr(object):
         :type time_tracking_results: dict
         :return: void
         """
-        # element to group by
-        grouping_fn = lambda x: x['description']
+        CompaniesMgr.update_tasks_bulk(company_id, {date: time_tracking_results})
+
+    @staticmethod
+    def update_tasks_bulk(company_id, time_tracking_results_by_date, notify=True):
+        """ Updates the data from the time tracking plugin for several dates at once
+
+        The dates whose results are the same as the last time they were stored, and whose tasks still add up to what
+        was stored then (see DailyDigest), are skipped without loading their tasks. All the existing tasks for the rest
+        of the dates are loaded in a single query, and only the tasks whose seconds changed are written, in bulk inside
+        a single transaction, together with the changes to the daily totals and the new digests.
+
+        :param company_id: The ID of the company
+        :type company_id: int
+        :param time_tracking_results_by_date: The results from the time tracking plugin, keyed by date
+        :type time_tracking_results_by_date: dict
+        :param notify: Whether the tasks changed get a new version, so the notification plugins push them (see
+            Task.version). If not, the new tasks get version 0 and the ones updated keep theirs
+        :type notify: bool
+        :return: void
+        """
+        aggregated = TimeTrackingAggregator().add_results(time_tracking_results_by_date).totals
 
-        # sort the elements (groupby needs them sorted)
-        elements = sorted(time_tracking_results, key=grouping_fn)
-        groups = itertools.groupby(elements, grouping_fn)
-        res = [(r[0], sum([item['seconds'] for item in r[1]])) for r in groups]
+        if len(aggregated) == 0:
+            return
 
         company = CompaniesMgr.get_company(company_id)
-        for tt_task in res:
-            try:
-                task = company.tasks.where(Task.date == date, Task.description == tt_task[0]).get()
-            except:
-                task = Task()
-                task.company = company
-                task.date = date
-                task.description = tt_task[0]
+        # the changes are added to the daily totals under the keys the current regexps match
+        CompaniesMgr.check_daily_totals(company)
+
+        totals_by_date = {}
+        for (date, description), seconds in aggregated.items():
+            totals_by_date.setdefault(date, {})[description] = seconds
+        digests = dict((date, CompaniesMgr.get_results_digest(totals)) for date, totals in totals_by_date.items())
+
+        dates = list(digests.keys())
+        stored_digests = {}
+        for i in range(0, len(dates), BULK_CHUNK_SIZE):
+            for date, digest, tasks, seconds in DailyDigest.select(
+                    DailyDigest.date, DailyDigest.digest, DailyDigest.tasks, DailyDigest.time_spent_seconds).where(
+                    (DailyDigest.company == company.id) & (DailyDigest.date << dates[i:i + BULK_CHUNK_SIZE])).tuples():
+                stored_digests[date] = (digest, tasks, seconds)
+
+        # the tasks may have been changed without going through here (deleted by hand, restored from a backup...), so
+        # the digest is only trusted if they still add up to what they were
+        unchanged = [date for date in dates if date in stored_digests and stored_digests[date][0] == digests[date]]
+        for i in range(0, len(unchanged), BULK_CHUNK_SIZE):
+            current = dict((date, (tasks, seconds)) for date, tasks, seconds in Task.select(
+                Task.date, fn.Count(Task.id), fn.Sum(Task.time_spent_seconds)).where(
+                (Task.company == company.id) & (Task.date << unchanged[i:i + BULK_CHUNK_SIZE])).group_by(
+                Task.date).tuples())
+            for date in unchanged[i:i + BULK_CHUNK_SIZE]:
+                if current.get(date, (0, 0)) == stored_digests[date][1:]:
+                    del digests[date]
+
+        dates = list(digests.keys())
+        if len(dates) == 0:
+            return
+
+        existing = {}
+        for i in range(0, len(dates), BULK_CHUNK_SIZE):
+            for task in company.tasks.where(Task.date << dates[i:i + BULK_CHUNK_SIZE]):
+                existing[(task.date, task.description)] = task
+
+        now = datetime.datetime.utcnow()
+        to_insert = []
+        # task ids to update, grouped by their new value so that each distinct value is a single statement
+        to_update = {}
+        # seconds added to each (date, issue key) daily total
+        totals_deltas = {}
+        ticket_matcher = CompaniesMgr.get_ticket_matcher(company)
+        for date in dates:
+            for description, seconds in totals_by_date[date].items():
+                key = (date, description)
+                task = existing.get(key)
+                if task is None:
+                    to_insert.append({'company': company.id, 'date': key[0], 'description': key[1],
+                                      'time_spent_seconds': seconds, 'created_at': now, 'updated_at': now})
+                    delta = seconds
+                elif task.time_spent_seconds != seconds:
+                    # the tasks that didn't change are left alone, so they don't look pending to the notification
+                    # plugins
+                    to_update.setdefault(seconds, []).append(task.id)
+                    delta = seconds - task.time_spent_seconds
+                else:
+                    continue
+
+                totals_key = (key[0], CompaniesMgr.get_issue_key(ticket_matcher, key[1]))
+                totals_deltas[totals_key] = totals_deltas.get(totals_key, 0) + delta
+
+        with Task._meta.database.transaction():
+            if len(to_insert) > 0 or len(to_update) > 0:
+                version = 0
+                if notify:
+                    # everything changed on this call gets the same version, newer than any other of the company
+                    version = (Task.select(fn.Max(Task.version)).where(Task.company == company.id).scalar() or 0) + 1
 
-            task.time_spent_seconds = tt_task[1]
-            task.updated_at = datetime.datetime.utcnow()
-            task.save()
+                for row in to_insert:
+                    row['version'] = version
+                for i in range(0, len(to_insert), BULK_CHUNK_SIZE):
+                    Task.insert_many(to_insert[i:i + BULK_CHUNK_SIZE]).execute()
+
+                fields = {'updated_at': now}
+                if notify:
+                    fields['version'] = version
+                for seconds, task_ids in to_update.items():
+                    for i in range(0, len(task_ids), BULK_CHUNK_SIZE):
+                        Task.update(time_spent_seconds=seconds, **fields).where(
+                            Task.id << task_ids[i:i + BULK_CHUNK_SIZE]).execute()
+
+                CompaniesMgr.add_to_daily_totals(company.id, totals_deltas)
+
+            # what the tasks of each date add up to now: the ones that were there, with the new results over them
+            tasks_by_date = dict((date, dict(totals)) for date, totals in totals_by_date.items() if date in digests)
+            for (date, description), task in existing.items():
+                tasks_by_date[date].setdefault(description, task.time_spent_seconds)
+
+            new_digests = []
+            for date in dates:
+                fields = {'digest': digests[date], 'tasks': len(tasks_by_date[date]),
+                          'time_spent_seconds': sum(tasks_by_date[date].values())}
+                if date in stored_digests:
+                    DailyDigest.update(**fields).where(
+                        (DailyDigest.company == company.id) & (DailyDigest.date == date)).execute()
+                else:
+                    new_digests.append(dict(fields, company=company.id, date=date))
+            for i in range(0, len(new_digests), BULK_CHUNK_SIZE):
+                DailyDigest.insert_many(new_digests[i:i + BULK_CHUNK_SIZE]).execute()
 
     @staticmethod
-    def trigger_notifications(company_id):
+    def get_results_digest(totals):
+        """ Gets a hash of the aggregated results of a date, which doesn't depend on their order
+
+        :param totals: The seconds of each description
+        :type totals: dict
+        :return: The hash (hex encoded sha1)
+        :rtype: str
+        """
+        digest = hashlib.sha1()
+        for description, seconds in sorted((description.encode('utf-8') if isinstance(description, unicode) else
+                                            description, seconds) for description, seconds in totals.items()):
+            digest.update('%s\0%d\n' % (description, seconds))
+        return digest.hexdigest()
+
+    @staticmethod
+    def update_tasks_from_intervals(company_id, intervals):
+        """ Updates the tasks from raw time tracking entries, given as (start, end, description)
+
+        The entries are split at the midnights of the company's timezone and aggregated per local date (see
+        TimeTrackingAggregator.add_intervals), and then stored as update_tasks_bulk does. So, as with update_tasks, they
+        have to be all the entries of the dates they cover.
+
+        :param company_id: The ID of the company
+        :type company_id: int
+        :param intervals: The entries, start and end are datetimes (naive ones are in UTC) or timestamps
+        :type intervals: iterable
+        :return: void
+        """
         company = CompaniesMgr.get_company(company_id)
+        aggregator = TimeTrackingAggregator().add_intervals(intervals, pytz.timezone(company.timezone))
+        CompaniesMgr.update_tasks_bulk(company_id, aggregator.get_results())
+
+    @staticmethod
+    def get_ticket_matcher(company):
+        """ Gets the matcher of the issue keys on the company's task descriptions (using the ticket regexps of all
+        its notification plugins)
 
+        :param company: The company
+        :type company: Company
+        :rtype: TicketMatcher
+        """
+        return TicketMatcher(CompaniesMgr.get_ticket_regexps(company))
+
+    @staticmethod
+    def get_ticket_regexps(company):
+        """ Gets the ticket regexps of all the notification plugins of a company, in order
+
+        :param company: The company
+        :type company: Company
+        :rtype: [str]
+        """
+        ticket_regexps = []
         for nplugin in company.notification_plugins:
-            plugin = PluginsManager.get_notification_plugin(nplugin['notification_plugin'],
-                                                            **nplugin['notification_data'])
-            plugin.execute_if_it_has_to(company)
+            ticket_regexps += nplugin['notification_data'].get('ticket_regexps') or []
+        return ticket_regexps
+
+    @staticmethod
+    def get_regexps_digest(company):
+        """ Gets a hash of the ticket regexps of a company (their order matters, as the first one that matches wins)
+
+        :param company: The company
+        :type company: Company
+        :return: The hash (hex encoded sha1)
+        :rtype: str
+        """
+        return hashlib.sha1(json.dumps(CompaniesMgr.get_ticket_regexps(company))).hexdigest()
+
+    @staticmethod
+    def get_issue_key(ticket_matcher, description):
+        """ Gets the issue key a task is reported under
+
+        :param ticket_matcher: The matcher of the company (see get_ticket_matcher)
+        :type ticket_matcher: TicketMatcher
+        :param description: The description of the task
+        :type description: str
+        :return: The issue key, or an empty string if there's no key on the description
+        :rtype: str
+        """
+        match = ticket_matcher.match(description)
+        return match[0] if match is not None else ''
+
+    @staticmethod
+    def add_to_daily_totals(company_id, totals_deltas):
+        """ Adds seconds to the daily totals of a company, creating the ones that don't exist
+
+        :param company_id: The ID of the company
+        :type company_id: int
+        :param totals_deltas: The seconds to add, keyed by (date, issue key)
+        :type totals_deltas: dict
+        :return: void
+        """
+        totals_deltas = dict((key, delta) for key, delta in totals_deltas.items() if delta != 0)
+        if len(totals_deltas) == 0:
+            return
+
+        dates = list(set(date for date, issue_key in totals_deltas))
+        existing = {}
+        for i in range(0, len(dates), BULK_CHUNK_SIZE):
+            for total in DailyTotal.select().where(
+                    (DailyTotal.company == company_id) & (DailyTotal.date << dates[i:i + BULK_CHUNK_SIZE])):
+                existing[(total.date, total.issue_key)] = total
+
+        to_insert = []
+        with DailyTotal._meta.database.transaction():
+            for (date, issue_key), delta in totals_deltas.items():
+                total = existing.get((date, issue_key))
+                if total is None:
+                    to_insert.append({'company': company_id, 'date': date, 'issue_key': issue_key,
+                                      'time_spent_seconds': delta})
+                else:
+                    DailyTotal.update(time_spent_seconds=DailyTotal.time_spent_seconds + delta).where(
+                        DailyTotal.id == total.id).execute()
+
+            for i in range(0, len(to_insert), BULK_CHUNK_SIZE):
+                DailyTotal.insert_many(to_insert[i:i + BULK_CHUNK_SIZE]).execute()
+
+    @staticmethod
+    def check_daily_totals(company):
+        """ Computes the daily totals of a company again if its ticket regexps changed since they were computed, as
+        the tasks would be reported under the keys the old regexps matched
+
+        :param company: The company
+        :type company: Company
+        :return: True if they were computed again
+        :rtype: bool
+        """
+        digest = CompaniesMgr.get_regexps_digest(company)
+        if company.totals_regexps_digest == digest:
+            return False
+
+        CompaniesMgr.rebuild_daily_totals(company.id)
+        company.totals_regexps_digest = digest
+        return True
+
+    @staticmethod
+    def rebuild_daily_totals(company_id):
+        """ Computes the daily totals of a company from its tasks again (they need it when the ticket regexps of
+        the company change, see check_daily_totals)
+
+        :param company_id: The ID of the company
+        :type company_id: int
+        :return: void
+        """
+        company = CompaniesMgr.get_company(company_id)
+        ticket_matcher = CompaniesMgr.get_ticket_matcher(company)
+
+        totals = {}
+        for task in Task.select(Task.date, Task.description, Task.time_spent_seconds).where(
+                Task.company == company.id).naive().iterator():
+            key = (task.date, CompaniesMgr.get_issue_key(ticket_matcher, task.description))
+            totals[key] = totals.get(key, 0) + task.time_spent_seconds
+
+        with DailyTotal._meta.database.transaction():
+            DailyTotal.delete().where(DailyTotal.company == company.id).execute()
+            CompaniesMgr.add_to_daily_totals(company.id, totals)
+            Company.update(totals_regexps_digest=CompaniesMgr.get_regexps_digest(company)).where(
+                Company.id == company.id).execute()
+
+    @staticmethod
+    def get_report(company_id, start_date, end_date, group_by='day'):
+        """ Gets the seconds tracked by a company between two dates (both included), from its daily totals
+
+        :param company_id: The ID of the company
+        :type company_id: int
+        :param start_date: The first date of the report
+        :type start_date: datetime.date
+        :param end_date: The last date of the report
+        :type end_date: datetime.date
+        :param group_by: How the seconds are grouped: 'day', 'week' (keyed by their monday), 'month' (keyed by their
+            first day) or 'issue' (keyed by issue key, None for the time that isn't on any issue)
+        :type group_by: str
+        :return: The seconds of each group that has time tracked, in order
+        :rtype: collections.OrderedDict
+        :raises: InvalidReportGrouping
+        """
+        periods = {
+            'day': lambda date: date,
+            'week': lambda date: date - datetime.timedelta(days=date.weekday()),
+            'month': lambda date: date.replace(day=1)
+        }
+        if group_by != 'issue' and group_by not in periods:
+            raise InvalidReportGrouping()
+
+        CompaniesMgr.check_daily_totals(CompaniesMgr.get_company(company_id))
+
+        in_range = ((DailyTotal.company == company_id) & (DailyTotal.date >= start_date) &
+                    (DailyTotal.date <= end_date))
+        seconds = fn.Sum(DailyTotal.time_spent_seconds).alias('seconds')
+
+        res = collections.OrderedDict()
+        if group_by == 'issue':
+            for row in DailyTotal.select(DailyTotal.issue_key, seconds).where(in_range).group_by(
+                    DailyTotal.issue_key).order_by(DailyTotal.issue_key).tuples():
+                res[row[0] or None] = row[1]
+        else:
+            for date, total in DailyTotal.select(DailyTotal.date, seconds).where(in_range).group_by(
+                    DailyTotal.date).order_by(DailyTotal.date).tuples():
+                period = periods[group_by](date)
+                res[period] = res.get(period, 0) + total
+
+        # groups with no time at all (everything removed from them) aren't reported
+        return collections.OrderedDict((key, total) for key, total in res.items() if total)
+
+    @staticmethod
+    def get_pending_tasks(company_id, version):
+        """ Gets the tasks of a company that changed after the given version (see Task.version)
+
+        :param company_id: The ID of the company
+        :type company_id: int
+        :param version: The last version already seen
+        :type version: int
+        :return: The tasks, oldest change first
+        :rtype: peewee.SelectQuery
+        """
+        return Task.select().where((Task.company == company_id) & (Task.version > version)).order_by(Task.version)
+
+    @staticmethod
+    def trigger_notifications(company_id):
+        with stats.company(company_id):
+            company = CompaniesMgr.get_company(company_id)
+
+            for nplugin in company.notification_plugins:
+                plugin = PluginsManager.get_notification_plugin(nplugin['notification_plugin'],
+                                                                **nplugin['notification_data'])
+                with stats.timed('notifications.execute'):
+                    plugin.execute_if_it_has_to(company)
+
+    @staticmethod
+    def sync_company(company_id, since=None, timings=None):
+        """ Fetches the time tracked by a company, stores it and triggers its notifications
+
+        :param company_id: The ID of the company
+        :type company_id: int
+        :param since: The date to start fetching the times. If it's not set, only what changed since the last sync
+            (the company's watermark) is fetched
+        :type since: datetime.date
+        :param timings: Dict to record the timings on (so that they're available even if a step fails)
+        :type timings: dict
+        :return: The seconds spent on each step ('fetch', 'update_tasks' and 'notifications')
+        :rtype: dict
+        """
+        with stats.company(company_id):
+            return CompaniesMgr._sync_company(company_id, since, timings)
+
+    @staticmethod
+    def _sync_company(company_id, since, timings):
+        company = CompaniesMgr.get_company(company_id)
+
+        if timings is None:
+            timings = collections.OrderedDict()
+        start = time.time()
+        plugin = PluginsManager.get_time_tracking_plugin(company.time_tracking_plugin, **company.time_tracking_data)
+        with stats.timed('time_tracking.fetch'):
+            if since is None:
+                watermark = CompaniesMgr.get_watermark(company.id)
+                results, cursor = plugin.get_time_tracking_changes(company, watermark.cursor if watermark else None)
+            else:
+                results = plugin.get_time_tracking_results(company, since)
+                watermark, cursor = None, None
+        timings['fetch'] = time.time() - start
+
+        start = time.time()
+        with Task._meta.database.transaction():
+            CompaniesMgr.update_tasks_bulk(company.id, results)
+
+            # the watermark only moves together with the tasks it covers
+            if since is None and cursor is not None:
+                if watermark is None:
+                    watermark = TimeTrackingWatermark(company=company.id)
+                watermark.cursor = cursor
+                watermark.updated_at = datetime.datetime.utcnow()
+                watermark.save()
+        timings['update_tasks'] = time.time() - start
+
+        start = time.time()
+        CompaniesMgr.trigger_notifications(company.id)
+        timings['notifications'] = time.time() - start
+
+        return timings
+
+    @staticmethod
+    def get_watermark(company_id):
+        """ Gets how far the time tracking data of a company has been ingested
+
+        :param company_id: The ID of the company
+        :type company_id: int
+        :return: The watermark of the company, or None if it was never synced
+        :rtype: TimeTrackingWatermark
+        """
+        try:
+            return TimeTrackingWatermark.get(TimeTrackingWatermark.company == company_id)
+        except TimeTrackingWatermark.DoesNotExist:
+            return None
+
+    @staticmethod
+    def sync_companies(company_ids=None, since=None, workers=4):
+        """ Syncs several companies (see sync_company) concurrently, a failure on one doesn't affect the others
+
+        :param company_ids: The IDs of the companies, defaults to all of them
+        :type company_ids: [int]
+        :param since: The date to start fetching the times, defaults to what changed since each company's last sync
+        :type since: datetime.date
+        :param workers: Amount of companies synced at the same time
+        :type workers: int
+        :return: The result of each company: 'company_id', 'timings', 'elapsed' and 'error' (None if it succeeded)
+        :rtype: [dict]
+        """
+        if company_ids is None:
+            company_ids = [c.id for c in Company.select(Company.id).order_by(Company.id)]
+
+        def sync(company_id):
+            start = time.time()
+            res = {'company_id': company_id, 'timings': collections.OrderedDict(), 'error': None}
+            try:
+                CompaniesMgr.sync_company(company_id, since, timings=res['timings'])
+            except Exception:
+                res['error'] = traceback.format_exc()
+            res['elapsed'] = time.time() - start
+            return res
+
+        def sync_on_worker(company_id):
+            try:
+                return sync(company_id)
+            finally:
+                # the workers go away with the pool, their connections can be reused
+                release_connection(Company._meta.database)
+
+        if workers > 1 and len(company_ids) > 1:
+            pool = ThreadPool(min(workers, len(company_ids)))
+            try:
+                return pool.map(sync_on_worker, company_ids)
+            finally:
+                pool.close()
+                pool.join()
+
+        return [sync(company_id) for company_id in company_ids]
 
 
 class PluginsManager(object):
+    # plugin instances are shared by the whole process, see PluginPool
+    pool = PluginPool()
+
+    @staticmethod
+    def configure_pool(ttl=600, max_size=100):
+        """ Replaces the plugin pool with one using the given eviction settings, closing the current instances
+
+        :param ttl: Seconds a plugin can stay unused before it's evicted (None to keep them forever)
+        :type ttl: int
+        :param max_size: Max amount of plugins in the pool (None for no limit)
+        :type max_size: int
+        :return: void
+        """
+        PluginsManager.pool.reset()
+        PluginsManager.pool = PluginPool(ttl=ttl, max_size=max_size)
+
+    @staticmethod
+    def reset_pool():
+        """ Closes all the pooled plugins
+
+        :return: void
+        """
+        PluginsManager.pool.reset()
+
     @staticmethod
     def get_object(name, package, **kwargs):
+        with stats.timed('plugins.get_object'):
+            return PluginsManager.pool.get(package + '.' + name, kwargs,
+                                           lambda: PluginsManager.create_object(name, package, **kwargs))
+
+    @staticmethod
+    def create_object(name, package, **kwargs):
         # separate get the module and the class
         parts = name.split('.')
         module = ".".join(parts[:-1])
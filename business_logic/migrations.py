@@ -0,0 +1,225 @@
+from config import encode_config, decode_config, is_legacy_config
+from models import Company, Task, DailyTotal, DailyDigest, get_models
+from peewee import fn, Clause, Entity, SQL, JOIN_LEFT_OUTER
+from playhouse.migrate import SqliteMigrator, migrate as run_migration
+from plugins.notification.jira_plugin import JiraTaskUpdated
+
+
+def get_index_name(model_class, field_names):
+    """ Gets the name peewee gives to the index on the given fields
+
+    :param model_class: The model the index belongs to
+    :type model_class: peewee.Model
+    :param field_names: The names of the fields in the index
+    :type field_names: [str]
+    :return: The index name
+    :rtype: str
+    """
+    columns = [model_class._meta.fields[f].db_column for f in field_names]
+    return model_class._meta.database.compiler().index_name(model_class._meta.db_table, columns)
+
+
+def add_index(model_class, field_names, unique=False):
+    """ Adds an index to an existing table, unless it's already there
+
+    :param model_class: The model to add the index to
+    :type model_class: peewee.Model
+    :param field_names: The names of the fields in the index
+    :type field_names: [str]
+    :param unique: Whether the index is unique or not
+    :type unique: bool
+    :return: True if the index was created
+    :rtype: bool
+    """
+    database = model_class._meta.database
+    index_name = get_index_name(model_class, field_names)
+    # get_indexes_for_table is broken on this peewee version, so ask sqlite directly
+    indexes = database.execute_sql('PRAGMA index_list("%s");' % model_class._meta.db_table).fetchall()
+    if index_name in [index[1] for index in indexes]:
+        return False
+
+    columns = [model_class._meta.fields[f].db_column for f in field_names]
+    run_migration(SqliteMigrator(database).add_index(model_class._meta.db_table, columns, unique))
+    return True
+
+
+def add_column(model_class, field_name, default=None):
+    """ Adds a column to an existing table, unless it's already there
+
+    :param model_class: The model the field belongs to
+    :type model_class: peewee.Model
+    :param field_name: The name of the field to add
+    :type field_name: str
+    :param default: Value for the existing rows (required if the field isn't nullable)
+    :type default: int
+    :return: True if the column was created
+    :rtype: bool
+    """
+    database = model_class._meta.database
+    table = model_class._meta.db_table
+    field = model_class._meta.fields[field_name]
+    if field.db_column in [column[1] for column in database.execute_sql('PRAGMA table_info("%s");' % table)]:
+        return False
+
+    # the migrator would rebuild the whole table (losing its indexes) to add a not null column, sqlite doesn't need it
+    compiler = database.compiler()
+    nodes = [SQL('ALTER TABLE'), Entity(table), SQL('ADD COLUMN'), compiler.field_definition(field)]
+    if default is not None:
+        nodes.append(SQL('DEFAULT %d' % default))
+    database.execute_sql(*compiler.parse_node(Clause(*nodes)))
+    return True
+
+
+def remove_duplicated_tasks():
+    """ Removes the tasks that share (company, date, description), keeping only the one updated last of each group (the
+    one with the lowest id if they were updated at the same time)
+
+    Before the unique index existed nothing prevented them, and the index can't be created while they're there.
+    update_tasks kept updating only one of them (the first one it found), so the rest hold values that were replaced
+    since, and they are dropped instead of added to the one kept. The daily totals of the companies affected are
+    computed again from the tasks left.
+
+    :return: The amount of tasks removed
+    :rtype: int
+    """
+    # imported here, as the managers module isn't needed by the rest of the migrations
+    from managers import CompaniesMgr
+
+    duplicates = Task.select(Task.company, Task.date, Task.description).group_by(
+        Task.company, Task.date, Task.description).having(fn.Count(Task.id) > 1)
+
+    removed = 0
+    company_ids = set()
+    for company_id, date, description in list(duplicates.tuples()):
+        task_ids = [t.id for t in Task.select(Task.id).where(
+            (Task.company == company_id) & (Task.date == date) & (Task.description == description)).order_by(
+            Task.updated_at.desc(), Task.id)]
+
+        JiraTaskUpdated.delete().where(JiraTaskUpdated.task << task_ids[1:]).execute()
+        removed += Task.delete().where(Task.id << task_ids[1:]).execute()
+        company_ids.add(company_id)
+
+    # the companies without totals yet get them from fill_daily_totals
+    for company_id in company_ids:
+        if DailyTotal.select().where(DailyTotal.company == company_id).exists():
+            CompaniesMgr.rebuild_daily_totals(company_id)
+
+    return removed
+
+
+def add_totals_regexps_digests():
+    """ Adds the hash of the ticket regexps the daily totals were computed with to the companies. The existing ones get
+    none, so their totals are computed again the next time they're updated or reported
+
+    :return: void
+    """
+    add_column(Company, 'totals_regexps_digest')
+
+
+def add_lookup_indexes():
+    """ Adds the composite indexes used by update_tasks and the jira plugin
+
+    :return: void
+    """
+    with Task._meta.database.transaction():
+        remove_duplicated_tasks()
+        add_index(Task, ['company', 'date', 'description'], True)
+
+    add_index(JiraTaskUpdated, ['task', 'updated_at'])
+
+
+def convert_company_configs():
+    """ Rewrites the pickled company configurations using the json format
+
+    :return: The amount of companies converted
+    :rtype: int
+    """
+    converted = 0
+    with Company._meta.database.transaction():
+        for company in Company.select():
+            fields = {}
+            for field_name in ['notification_plugins_str', 'time_tracking_data_str']:
+                raw = getattr(company, field_name)
+                if is_legacy_config(raw):
+                    fields[field_name] = encode_config(decode_config(raw))
+
+            if fields:
+                Company.update(**fields).where(Company.id == company.id).execute()
+                converted += 1
+
+    return converted
+
+
+def add_task_versions():
+    """ Adds the version to the tasks, making the ones the jira plugin hadn't pushed yet pending
+
+    :return: void
+    """
+    with Task._meta.database.transaction():
+        if add_column(Task, 'version', default=0):
+            pending = Task.select(Task.id).join(JiraTaskUpdated, JOIN_LEFT_OUTER).where(
+                (JiraTaskUpdated.id >> None) | (JiraTaskUpdated.updated_at < Task.updated_at))
+            Task.update(version=1).where(Task.id << pending).execute()
+
+    add_index(Task, ['company', 'version'])
+
+
+def add_worklog_ids():
+    """ Adds the ids of the issue and worklog created to the tasks pushed to jira
+
+    :return: void
+    """
+    add_column(JiraTaskUpdated, 'issue_id')
+    add_column(JiraTaskUpdated, 'worklog_id')
+
+
+def fill_daily_totals():
+    """ Computes the daily totals of the companies that have tasks but no totals yet
+
+    :return: The amount of companies filled
+    :rtype: int
+    """
+    # imported here, as the managers module isn't needed by the rest of the migrations
+    from managers import CompaniesMgr
+
+    with_totals = DailyTotal.select(DailyTotal.company).distinct()
+    company_ids = [row[0] for row in Task.select(Task.company).where(
+        ~(Task.company << with_totals)).distinct().tuples()]
+    for company_id in company_ids:
+        CompaniesMgr.rebuild_daily_totals(company_id)
+    return len(company_ids)
+
+
+def add_digest_counts():
+    """ Adds the amount and seconds of the tasks to the daily digests. The existing ones get zeros, so their dates are
+    checked (and their digests completed) on the next update
+
+    :return: void
+    """
+    add_column(DailyDigest, 'tasks', default=0)
+    add_column(DailyDigest, 'time_spent_seconds', default=0)
+
+
+# every migration must be safe to run more than once, as they're all executed on each migrate
+MIGRATIONS = [
+    # first, as the rest of them load the companies
+    add_totals_regexps_digests,
+    add_lookup_indexes,
+    convert_company_configs,
+    add_task_versions,
+    add_worklog_ids,
+    fill_daily_totals,
+    add_digest_counts,
+]
+
+
+def migrate():
+    """ Brings an existing database up to date, creating any missing tables and applying all the migrations
+
+    :return: void
+    """
+    for model_class in get_models():
+        model_class.create_table(fail_silently=True)
+
+    for migration in MIGRATIONS:
+        migration()
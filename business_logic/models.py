@@ -1,8 +1,19 @@
-from peewee import SqliteDatabase, Model, CharField, ForeignKeyField, IntegerField, DateField, DateTimeField
+from peewee import Model, CharField, ForeignKeyField, IntegerField, DateField, DateTimeField
+from config import encode_config, decode_config
+from database import PooledSqliteDatabase
+from instrumentation import stats
 import datetime
-import pickle
 
-db = SqliteDatabase('horas.db')
+# each thread gets its own connection, so that companies can be synced concurrently (see configure_database)
+db = PooledSqliteDatabase('horas.db')
+
+
+def configure_database(path=None, pragmas=None, busy_timeout=None, pool_size=None):
+    """ Changes the settings of the database the models use (see PooledSqliteDatabase.configure)
+
+    :return: void
+    """
+    db.configure(path, pragmas, busy_timeout, pool_size)
 
 
 class Company(Model):
@@ -11,23 +22,40 @@ class Company(Model):
     time_tracking_plugin = CharField()
     time_tracking_data_str = CharField()
     timezone = CharField()
+    # hash of the ticket regexps the daily totals were computed with, as they're keyed by what those regexps match
+    # (see CompaniesMgr.check_daily_totals)
+    totals_regexps_digest = CharField(max_length=40, null=True)
     created_at = DateTimeField(default=datetime.datetime.utcnow)
 
+    def _get_config(self, field_name):
+        # the decoded value is memoized together with the raw value it came from, so it's decoded only once
+        raw = getattr(self, field_name)
+        cache = self.__dict__.setdefault('_config_cache', {})
+        if field_name not in cache or cache[field_name][0] != raw:
+            with stats.timed('config.decode'):
+                cache[field_name] = (raw, decode_config(raw))
+        return cache[field_name][1]
+
+    def _set_config(self, field_name, value):
+        raw = encode_config(value)
+        setattr(self, field_name, raw)
+        self.__dict__.setdefault('_config_cache', {})[field_name] = (raw, value)
+
     @property
     def notification_plugins(self):
-        return pickle.loads(self.notification_plugins_str)
+        return self._get_config('notification_plugins_str')
 
     @notification_plugins.setter
     def notification_plugins(self, value):
-        self.notification_plugins_str = pickle.dumps(value)
+        self._set_config('notification_plugins_str', value)
 
     @property
     def time_tracking_data(self):
-        return pickle.loads(self.time_tracking_data_str)
+        return self._get_config('time_tracking_data_str')
 
     @time_tracking_data.setter
     def time_tracking_data(self, value):
-        self.time_tracking_data_str = pickle.dumps(value)
+        self._set_config('time_tracking_data_str', value)
 
     class Meta:
         database = db
@@ -38,8 +66,77 @@ class Task(Model):
     date = DateField()
     description = CharField()
     time_spent_seconds = IntegerField()
+    # increases (per company) every time the task changes, so the notification plugins can tell what they're missing
+    version = IntegerField(default=0)
     created_at = DateTimeField(default=datetime.datetime.utcnow)
     updated_at = DateTimeField(default=datetime.datetime.utcnow)
 
     class Meta:
         database = db
+        indexes = (
+            # update_tasks looks tasks up by this key, and there should be only one task per key
+            (('company', 'date', 'description'), True),
+            (('company', 'version'), False),
+        )
+
+
+class DailyTotal(Model):
+    """
+    Seconds tracked by a company on a date, split by issue key (empty for the tasks without one). update_tasks keeps
+    them up to date, so the reports don't need to go through the tasks
+    """
+    company = ForeignKeyField(Company, related_name='daily_totals')
+    date = DateField()
+    issue_key = CharField(default='')
+    time_spent_seconds = IntegerField(default=0)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('company', 'date', 'issue_key'), True),
+        )
+
+
+class DailyDigest(Model):
+    """
+    Hash of the time tracking results of a company on a date, as update_tasks last stored them, with the amount and
+    seconds of the tasks the date had then. When the plugin returns the same results again, and the tasks weren't
+    changed by anything else since, the date is skipped without loading nor writing its tasks
+    """
+    company = ForeignKeyField(Company, related_name='daily_digests')
+    date = DateField()
+    digest = CharField(max_length=40)
+    tasks = IntegerField(default=0)
+    time_spent_seconds = IntegerField(default=0)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('company', 'date'), True),
+        )
+
+
+class TimeTrackingWatermark(Model):
+    """
+    How far the time tracking data of a company has been ingested. The cursor is opaque, its meaning depends on the
+    company's time tracking plugin
+    """
+    company = ForeignKeyField(Company, related_name='time_tracking_watermarks', unique=True)
+    cursor = CharField()
+    updated_at = DateTimeField(default=datetime.datetime.utcnow)
+
+    class Meta:
+        database = db
+
+
+def get_models():
+    """ Gets every model with a table: the core ones and the ones declared by the plugins, in creation order
+
+    :rtype: [peewee.Model]
+    """
+    # imported here, as the plugins import this module
+    from plugins.notification.jira_plugin import JiraTaskUpdated, JiraSyncState, JiraOutboxItem
+    from plugins.notification.email_plugin import EmailDigestSent
+
+    return [Company, Task, DailyTotal, DailyDigest, TimeTrackingWatermark, JiraTaskUpdated, JiraSyncState,
+            JiraOutboxItem, EmailDigestSent]
@@ -0,0 +1,136 @@
+from config import encode_config
+import collections
+import hashlib
+import threading
+import time
+
+
+class PluginPool(object):
+    """
+    Process-wide pool of plugin instances, so that plugins holding expensive resources (authenticated clients, HTTP
+    sessions) are reused instead of being created every time they're needed.
+
+    Instances are keyed by the plugin name and a stable hash of the arguments used to create them. They're evicted
+    when they haven't been used for `ttl` seconds, or when the pool grows over `max_size` (least recently used first).
+
+    Creating an instance can be slow (the JIRA one logs in), so it's done outside the pool's lock: only the threads
+    asking for the same instance wait for it, and they get the one created.
+    """
+
+    def __init__(self, ttl=600, max_size=100, clock=time.time):
+        """
+        :param ttl: Seconds an instance can stay unused before it's evicted (None to keep them forever)
+        :type ttl: int
+        :param max_size: Max amount of instances in the pool (None for no limit)
+        :type max_size: int
+        :param clock: Function returning the current time in seconds
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._instances = collections.OrderedDict()
+        self._lock = threading.RLock()
+        # lock of each instance being created
+        self._creating = {}
+
+    @staticmethod
+    def get_key(name, kwargs):
+        """ Gets the key a plugin is stored with
+
+        :param name: The full name of the plugin
+        :type name: str
+        :param kwargs: Values used on the plugin creation
+        :type kwargs: dict
+        :rtype: (str, str)
+        """
+        return name, hashlib.sha1(encode_config(kwargs)).hexdigest()
+
+    def get(self, name, kwargs, factory):
+        """ Gets a pooled instance of the plugin, creating it with `factory` if there isn't a live one
+
+        :param name: The full name of the plugin
+        :type name: str
+        :param kwargs: Values to use on the plugin creation
+        :type kwargs: dict
+        :param factory: Function that creates the plugin
+        :return: The plugin instance
+        """
+        key = self.get_key(name, kwargs)
+        with self._lock:
+            self._evict_expired()
+            if key in self._instances:
+                return self._use(key, self._instances.pop(key)[0])
+            creating = self._creating.setdefault(key, threading.Lock())
+
+        with creating:
+            with self._lock:
+                # another thread created it while this one was waiting
+                if key in self._instances:
+                    return self._use(key, self._instances.pop(key)[0])
+
+            try:
+                instance = factory()
+            except Exception:
+                with self._lock:
+                    self._creating.pop(key, None)
+                raise
+
+            with self._lock:
+                self._creating.pop(key, None)
+                return self._use(key, instance)
+
+    def close(self, name, kwargs):
+        """ Closes and removes an instance from the pool, if it's there
+
+        :param name: The full name of the plugin
+        :type name: str
+        :param kwargs: Values used on the plugin creation
+        :type kwargs: dict
+        :return: void
+        """
+        with self._lock:
+            entry = self._instances.pop(self.get_key(name, kwargs), None)
+            if entry is not None:
+                self._close(entry[0])
+
+    def reset(self):
+        """ Closes and removes all the instances in the pool
+
+        :return: void
+        """
+        with self._lock:
+            while self._instances:
+                self._close(self._instances.popitem(last=False)[1][0])
+
+    def __len__(self):
+        return len(self._instances)
+
+    def _use(self, key, instance):
+        # (re)insert it as the most recently used
+        self._instances[key] = (instance, self.clock())
+
+        while self.max_size is not None and len(self._instances) > self.max_size:
+            self._close(self._instances.popitem(last=False)[1][0])
+
+        return instance
+
+    def _evict_expired(self):
+        if self.ttl is None:
+            return
+
+        limit = self.clock() - self.ttl
+        # entries are sorted by last use, so the expired ones are at the beginning
+        while self._instances:
+            key, (instance, last_used) = next(self._instances.iteritems())
+            if last_used > limit:
+                break
+            del self._instances[key]
+            self._close(instance)
+
+    @staticmethod
+    def _close(instance):
+        try:
+            instance.close()
+        except Exception:
+            # a plugin failing to release its resources shouldn't break the one asking for a new instance
+            pass
@@ -0,0 +1,232 @@
+from managers import CompaniesMgr, PluginsManager
+from models import Company
+import datetime
+import hashlib
+import heapq
+import pytz
+import threading
+
+
+def next_local_time(timezone, now, hour, minute=0):
+    """ Gets the next time the wall clock of a timezone shows the given hour and minute
+
+    DST is taken into account: a time skipped when the clocks go forward is moved forward as much as they did (2:30
+    becomes 3:30), and a time that happens twice when they go back is its first occurrence, or the second one once the
+    first is past.
+
+    :param timezone: The timezone
+    :type timezone: pytz.tzinfo.BaseTzInfo
+    :param now: The current time (naive, in UTC)
+    :type now: datetime.datetime
+    :param hour: The hour of the day
+    :type hour: int
+    :param minute: The minute of the hour
+    :type minute: int
+    :return: The next time (naive, in UTC) after now
+    :rtype: datetime.datetime
+    """
+    local_date = pytz.utc.localize(now).astimezone(timezone).date()
+    for days in range(3):
+        naive = datetime.datetime.combine(local_date + datetime.timedelta(days=days), datetime.time(hour, minute))
+        try:
+            candidates = [timezone.localize(naive, is_dst=None)]
+        except pytz.AmbiguousTimeError:
+            candidates = [timezone.localize(naive, is_dst=True), timezone.localize(naive, is_dst=False)]
+        except pytz.NonExistentTimeError:
+            candidates = [timezone.normalize(timezone.localize(naive, is_dst=False))]
+
+        for local in candidates:
+            res = local.astimezone(pytz.utc).replace(tzinfo=None)
+            if res > now:
+                return res
+
+
+def next_interval_time(timezone, now, interval):
+    """ Gets the next time the wall clock of a timezone is on a multiple of `interval` minutes since midnight
+
+    The wall clock is followed on the UTC offset in effect, so the hour repeated when the clocks go back gets its runs
+    as well, and the times skipped when they go forward are moved to the first one after the change.
+
+    :param timezone: The timezone
+    :type timezone: pytz.tzinfo.BaseTzInfo
+    :param now: The current time (naive, in UTC)
+    :type now: datetime.datetime
+    :param interval: The minutes between runs
+    :type interval: int
+    :return: The next time (naive, in UTC) after now
+    :rtype: datetime.datetime
+    """
+    def get_offset(time):
+        return pytz.utc.localize(time).astimezone(timezone).utcoffset()
+
+    def get_next(offset):
+        wall = now + offset
+        midnight = datetime.datetime.combine(wall.date(), datetime.time())
+        minutes = min(int((wall - midnight).total_seconds()) // 60 // interval * interval + interval, 24 * 60)
+        return midnight + datetime.timedelta(minutes=minutes) - offset
+
+    offset = get_offset(now)
+    res = get_next(offset)
+    if get_offset(res) != offset:
+        # the clocks change before then, so the next time is the first one on the new offset after the change
+        offset = get_offset(res)
+        res = get_next(offset)
+        while get_offset(res) != offset:
+            res += datetime.timedelta(minutes=interval)
+    return res
+
+
+class Scheduler(object):
+    """
+    Keeps the companies in a queue ordered by the next time they're due, and syncs them (see
+    CompaniesMgr.sync_companies) when they are. The plugins and db connections are reused from one run to the next.
+
+    A company is due every `interval` minutes on its local time, and also when any of its notification plugins says
+    it is (see BaseNotificationPlugin.get_next_due_time). The companies are read again every `refresh_interval`
+    seconds, so the ones added or changed are picked up without restarting.
+    """
+
+    def __init__(self, interval=15, refresh_interval=60, workers=4, sync=None, clock=datetime.datetime.utcnow):
+        """
+        :param interval: Minutes between the syncs of each company
+        :type interval: int
+        :param refresh_interval: Seconds between the checks for new or changed companies
+        :type refresh_interval: float
+        :param workers: Amount of companies synced at the same time
+        :type workers: int
+        :param sync: Function that syncs the given company ids, defaults to CompaniesMgr.sync_companies
+        :param clock: Function returning the current time (naive, in UTC)
+        """
+        self.interval = interval
+        self.refresh_interval = refresh_interval
+        self.workers = workers
+        self.sync = sync or (lambda company_ids: CompaniesMgr.sync_companies(company_ids, workers=self.workers))
+        self.clock = clock
+        self._queue = []
+        # the signature of each company's configuration and its entry on the queue (the ones replaced stay on the
+        # queue, but they're skipped)
+        self._companies = {}
+        self._next_refresh = None
+        self._stop = threading.Event()
+
+    @staticmethod
+    def get_signature(company):
+        fields = [company.timezone, company.time_tracking_plugin, company.time_tracking_data_str,
+                  company.notification_plugins_str]
+        return hashlib.sha1(u'\0'.join(fields).encode('utf-8')).hexdigest()
+
+    def get_next_due_time(self, company, now):
+        """ Gets the next time a company is due
+
+        :param company: The company
+        :type company: Company
+        :param now: The current time (naive, in UTC)
+        :type now: datetime.datetime
+        :rtype: datetime.datetime
+        """
+        timezone = pytz.timezone(company.timezone)
+        res = next_interval_time(timezone, now, self.interval)
+        for nplugin in company.notification_plugins:
+            try:
+                plugin = PluginsManager.get_notification_plugin(nplugin['notification_plugin'],
+                                                                **nplugin['notification_data'])
+            except Exception:
+                # the sync reports what's wrong with it
+                continue
+
+            due = plugin.get_next_due_time(company, now)
+            if due is not None and now < due < res:
+                res = due
+        return res
+
+    def schedule(self, company, now):
+        entry = [self.get_next_due_time(company, now), company.id, self.get_signature(company)]
+        self._companies[company.id] = entry
+        heapq.heappush(self._queue, entry)
+
+    def refresh(self, now):
+        """ Adds the new companies to the queue, schedules again the ones whose configuration changed and drops the
+        ones that no longer exist
+
+        :param now: The current time (naive, in UTC)
+        :type now: datetime.datetime
+        :return: void
+        """
+        seen = set()
+        for company in Company.select():
+            seen.add(company.id)
+            entry = self._companies.get(company.id)
+            if entry is None or entry[2] != self.get_signature(company):
+                self.schedule(company, now)
+
+        for company_id in set(self._companies) - seen:
+            del self._companies[company_id]
+
+        self._next_refresh = now + datetime.timedelta(seconds=self.refresh_interval)
+
+    def pop_due(self, now):
+        """ Takes the companies that are due out of the queue
+
+        :param now: The current time (naive, in UTC)
+        :type now: datetime.datetime
+        :return: The IDs of the companies
+        :rtype: [int]
+        """
+        res = []
+        while self._queue and self._queue[0][0] <= now:
+            entry = heapq.heappop(self._queue)
+            if self._companies.get(entry[1]) is entry:
+                res.append(entry[1])
+        return res
+
+    def get_next_wake_time(self):
+        """ Gets when the scheduler has something to do: the next company is due, or it's time to refresh
+
+        :rtype: datetime.datetime
+        """
+        while self._queue and self._companies.get(self._queue[0][1]) is not self._queue[0]:
+            heapq.heappop(self._queue)
+
+        if self._queue and (self._next_refresh is None or self._queue[0][0] < self._next_refresh):
+            return self._queue[0][0]
+        return self._next_refresh
+
+    def run_once(self):
+        """ Refreshes the companies if it's time to, and syncs the ones that are due
+
+        :return: The results of the sync (see CompaniesMgr.sync_companies)
+        :rtype: [dict]
+        """
+        now = self.clock()
+        if self._next_refresh is None or self._next_refresh <= now:
+            self.refresh(now)
+
+        company_ids = self.pop_due(now)
+        if len(company_ids) == 0:
+            return []
+
+        results = self.sync(company_ids)
+
+        now = self.clock()
+        for company in Company.select().where(Company.id << company_ids):
+            self.schedule(company, now)
+
+        return results
+
+    def run_forever(self, on_results=None):
+        """ Runs until stop is called, sleeping until the scheduler has something to do
+
+        :param on_results: Function called with the results of each sync
+        :return: void
+        """
+        while not self._stop.is_set():
+            results = self.run_once()
+            if results and on_results is not None:
+                on_results(results)
+
+            wait = (self.get_next_wake_time() - self.clock()).total_seconds()
+            if wait > 0:
+                self._stop.wait(wait)
+
+    def stop(self):
+        self._stop.set()
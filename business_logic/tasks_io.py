@@ -0,0 +1,181 @@
+from exceptions import InvalidTaskFormat
+from managers import CompaniesMgr
+from models import Company, Task
+import csv
+import datetime
+import json
+
+FORMATS = ['csv', 'ndjson']
+EXPORT_COLUMNS = ['company_id', 'company', 'date', 'description', 'seconds']
+
+# names the columns can have on the files imported (the TimeDoctor ones as well)
+IMPORT_COLUMNS = {
+    'company_id': ['company_id'],
+    'date': ['date', 'start_time'],
+    'description': ['description', 'task_name'],
+    'seconds': ['seconds', 'length'],
+}
+
+
+def export_tasks(out, fmt='csv', company_id=None, start_date=None, end_date=None):
+    """ Writes the tasks to a file, reading them with a cursor so that only one is in memory at a time
+
+    :param out: The file to write them to
+    :type out: file
+    :param fmt: The format, 'csv' or 'ndjson' (a json object per line)
+    :type fmt: str
+    :param company_id: Only export the tasks of this company
+    :type company_id: int
+    :param start_date: Only export the tasks since this date
+    :type start_date: datetime.date
+    :param end_date: Only export the tasks up to this date
+    :type end_date: datetime.date
+    :return: The amount of tasks exported
+    :rtype: int
+    :raises: InvalidTaskFormat
+    """
+    if fmt not in FORMATS:
+        raise InvalidTaskFormat()
+
+    query = Task.select(Task.company, Company.name, Task.date, Task.description, Task.time_spent_seconds).join(
+        Company).order_by(Task.company, Task.date, Task.description)
+    if company_id is not None:
+        query = query.where(Task.company == company_id)
+    if start_date is not None:
+        query = query.where(Task.date >= start_date)
+    if end_date is not None:
+        query = query.where(Task.date <= end_date)
+
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(EXPORT_COLUMNS)
+
+    count = 0
+    for task_company_id, name, date, description, seconds in query.tuples().iterator():
+        if fmt == 'csv':
+            writer.writerow([task_company_id, name.encode('utf-8'), date.isoformat(), description.encode('utf-8'),
+                             seconds])
+        else:
+            out.write(json.dumps(dict(zip(EXPORT_COLUMNS, [task_company_id, name, date.isoformat(), description,
+                                                           seconds]))) + '\n')
+        count += 1
+
+    return count
+
+
+def read_rows(inp, fmt):
+    """ Parses the rows of a file as they're read
+
+    :param inp: The file
+    :type inp: file
+    :param fmt: The format, 'csv' or 'ndjson'
+    :type fmt: str
+    :return: The rows (dicts keyed by column name)
+    :rtype: generator
+    :raises: InvalidTaskFormat
+    """
+    if fmt == 'csv':
+        for line, row in enumerate(csv.DictReader(inp), 1):
+            # the columns missing on a short row are None, the values beyond the header are under None
+            if None in row.values():
+                raise InvalidTaskFormat('Line %d: some columns are missing' % line)
+            try:
+                row = dict((key, value.decode('utf-8')) for key, value in row.items() if key is not None)
+            except UnicodeDecodeError as e:
+                raise InvalidTaskFormat('Line %d: %s' % (line, e))
+            yield row
+    else:
+        line = 0
+        for text in inp:
+            if text.strip():
+                line += 1
+                try:
+                    row = json.loads(text)
+                except ValueError as e:
+                    raise InvalidTaskFormat('Line %d: %s' % (line, e))
+                if not isinstance(row, dict):
+                    raise InvalidTaskFormat('Line %d: not a json object' % line)
+                yield row
+
+
+def get_column(row, column, line):
+    for name in IMPORT_COLUMNS[column]:
+        if row.get(name) not in (None, ''):
+            return row[name]
+    raise InvalidTaskFormat('Line %d: %s is missing' % (line, column))
+
+
+def import_tasks(inp, fmt='csv', company_id=None, batch_size=1000, notify=False):
+    """ Reads time tracking entries from a file, storing them with the same rules update_tasks uses (the entries with
+    the same date and description are added up, and the result replaces the task stored)
+
+    The entries have to be sorted by company and date (as export_tasks writes them), so that each date is written
+    once, with all its entries, as soon as the next one starts. The file is parsed as it's read, and the dates are
+    written in transactions of at least `batch_size` rows. If the file turns out to be invalid, the dates written
+    before the error are complete, and importing it again once it's fixed skips them.
+
+    :param inp: The file
+    :type inp: file
+    :param fmt: The format, 'csv' or 'ndjson' (a json object per line). The columns are company_id (unless it's
+        given), date and description and seconds (or the start_time, task_name and length TimeDoctor uses)
+    :type fmt: str
+    :param company_id: The company of all the entries, instead of the one on each of them
+    :type company_id: int
+    :param batch_size: Amount of rows written on each transaction
+    :type batch_size: int
+    :param notify: Whether the notification plugins push the tasks imported, as they do with the synced ones (see
+        CompaniesMgr.update_tasks_bulk). By default they don't, and jira keeps the worklogs it has
+    :type notify: bool
+    :return: The amount of rows read
+    :rtype: int
+    :raises: InvalidTaskFormat
+    """
+    if fmt not in FORMATS:
+        raise InvalidTaskFormat()
+
+    # the (company, date) being read, and the total of each of its descriptions
+    current = None
+    totals = {}
+    # the dates read completely but not written yet, by company, and the amount of rows they had
+    pending = {}
+    pending_rows = 0
+
+    def flush():
+        with Task._meta.database.transaction():
+            for company, results in pending.items():
+                CompaniesMgr.update_tasks_bulk(company, results, notify)
+        pending.clear()
+
+    def add_pending():
+        pending.setdefault(current[0], {})[current[1]] = [
+            {'description': description, 'seconds': seconds} for description, seconds in totals.items()]
+
+    line = 0
+    for line, row in enumerate(read_rows(inp, fmt), 1):
+        try:
+            company = int(company_id if company_id is not None else get_column(row, 'company_id', line))
+            date = datetime.datetime.strptime(get_column(row, 'date', line)[:10], '%Y-%m-%d').date()
+            seconds = int(get_column(row, 'seconds', line))
+        except ValueError as e:
+            raise InvalidTaskFormat('Line %d: %s' % (line, e))
+        description = get_column(row, 'description', line)
+
+        if (company, date) != current:
+            if current is not None:
+                if (company, date) < current:
+                    raise InvalidTaskFormat('Line %d: the entries are not sorted by company and date' % line)
+                add_pending()
+                if pending_rows >= batch_size:
+                    flush()
+                    pending_rows = 0
+            current = (company, date)
+            totals = {}
+
+        totals[description] = totals.get(description, 0) + seconds
+        pending_rows += 1
+
+    if current is not None:
+        add_pending()
+        flush()
+
+    return line
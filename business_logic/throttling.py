@@ -0,0 +1,83 @@
+import random
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket, used to keep the requests sent to an external service under its throttling limits.
+
+    Tokens are refilled at `rate` per second, up to `capacity`. Each request takes one, waiting for it if needed.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.time, sleep=time.sleep):
+        """
+        :param rate: Tokens added per second
+        :type rate: float
+        :param capacity: Max amount of tokens stored (the burst size), defaults to one second worth of tokens
+        :type capacity: float
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.capacity
+        self._last_refill = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Takes a token, waiting until there's one available
+
+        :return: void
+        """
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+
+            self.sleep(wait)
+
+
+def get_backoff_delay(attempt, backoff, max_delay=None):
+    """ Gets the seconds to wait before retrying, exponential on the attempt and with some jitter
+
+    :param attempt: The amount of retries done before this one
+    :type attempt: int
+    :param backoff: Seconds to wait before the first retry, doubled on each one
+    :type backoff: float
+    :param max_delay: Max seconds to wait (None for no limit)
+    :type max_delay: float
+    :rtype: float
+    """
+    delay = backoff * (2 ** attempt) * random.uniform(1, 1.5)
+    return min(delay, max_delay) if max_delay is not None else delay
+
+
+def call_with_retries(fn, is_retryable, max_retries=3, backoff=1.0, sleep=time.sleep):
+    """ Calls a function, retrying it with exponential backoff (and some jitter) when it fails with a retryable error
+
+    :param fn: The function to call (without arguments)
+    :param is_retryable: Function that receives the exception raised and returns whether it's worth retrying
+    :param max_retries: Max amount of retries before giving up and raising the last error
+    :type max_retries: int
+    :param backoff: Seconds to wait before the first retry, doubled on each one
+    :type backoff: float
+    :return: Whatever the function returns
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+
+        sleep(get_backoff_delay(attempt, backoff))
+        attempt += 1
@@ -0,0 +1,58 @@
+import re
+
+
+class TicketMatcher(object):
+    """
+    Finds the issue key a task description refers to, using all the ticket regexps compiled in a single pattern.
+
+    The leftmost match wins, and when several regexps match at the same position the first one on the list does.
+    """
+
+    # characters stripped between the issue key and the comment when the description starts with the key
+    _comment_prefix = re.compile('^[^a-zA-Z0-9\\(]*')
+
+    def __init__(self, ticket_regexps):
+        """
+        :param ticket_regexps: The regexps that match the issue keys
+        :type ticket_regexps: [str]
+        """
+        self.ticket_regexps = ticket_regexps
+        if ticket_regexps:
+            self._pattern = re.compile('|'.join(['\\b(?:' + regexp + ')\\b' for regexp in ticket_regexps]))
+        else:
+            self._pattern = None
+
+    def match(self, description):
+        """ Gets the issue key and the worklog comment for a task description
+
+        :param description: The task description
+        :type description: str
+        :return: The issue key and the comment, or None if there's no key on the description
+        :rtype: (str, str)
+        """
+        match = self._pattern.search(description) if self._pattern is not None else None
+        if match is None:
+            return None
+
+        key = match.group(0)
+        comment = description
+        if match.start() == 0:
+            comment = self._comment_prefix.sub('', description[len(key):])
+
+        return key, comment
+
+    def match_all(self, descriptions):
+        """ Gets the issue keys and worklog comments for several task descriptions
+
+        :param descriptions: The task descriptions
+        :type descriptions: [str]
+        :return: The issue key and comment of every description that has a key on it
+        :rtype: dict
+        """
+        res = {}
+        for description in descriptions:
+            if description not in res:
+                match = self.match(description)
+                if match is not None:
+                    res[description] = match
+        return res
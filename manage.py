@@ -1,6 +1,88 @@
+import os
 import sys
-import peewee
+import time
 from business_logic.models import *
+from business_logic.managers import CompaniesMgr, PluginsManager
+from business_logic import migrations
+from business_logic.instrumentation import stats
+from business_logic.scheduler import Scheduler
+from business_logic import tasks_io
+
+
+def setup_database(environ):
+    """ Configures the database from the environment: HORAS_DB (the path of the file), HORAS_DB_PRAGMAS (name=value
+    pairs separated by commas, replacing the default ones), HORAS_DB_BUSY_TIMEOUT (seconds) and HORAS_DB_POOL_SIZE
+    """
+    pragmas = None
+    if environ.get('HORAS_DB_PRAGMAS') is not None:
+        pragmas = [tuple(pragma.strip().split('=', 1)) for pragma in environ['HORAS_DB_PRAGMAS'].split(',') if
+                   pragma.strip()]
+
+    busy_timeout = environ.get('HORAS_DB_BUSY_TIMEOUT')
+    pool_size = environ.get('HORAS_DB_POOL_SIZE')
+    configure_database(environ.get('HORAS_DB'), pragmas, float(busy_timeout) if busy_timeout else None,
+                       int(pool_size) if pool_size else None)
+
+
+def sync_all(since, workers):
+    start = time.time()
+    results = CompaniesMgr.sync_companies(since=since, workers=workers)
+    names = dict((c.id, c.name) for c in Company.select(Company.id, Company.name))
+
+    print '%-30s %10s %14s %15s %10s  %s' % ('company', 'fetch', 'update_tasks', 'notifications', 'total', 'status')
+    for res in results:
+        steps = [('%.2f' % res['timings'][step]) if step in res['timings'] else '-' for step in
+                 ['fetch', 'update_tasks', 'notifications']]
+        print '%-30s %10s %14s %15s %10.2f  %s' % tuple(
+            [names.get(res['company_id'], res['company_id'])] + steps +
+            [res['elapsed'], 'failed' if res['error'] else 'ok'])
+
+    for res in results:
+        if res['error']:
+            print
+            print 'Company %s failed:' % names.get(res['company_id'], res['company_id'])
+            print res['error']
+
+    failed = len([res for res in results if res['error']])
+    print
+    print '%d companies synced in %.2f seconds, %d failed' % (len(results), time.time() - start, failed)
+    if failed:
+        sys.exit(1)
+
+
+def daemon(interval, workers):
+    # the plugins are used once every interval, they'd be evicted (and connect again) on each run with a shorter ttl
+    PluginsManager.configure_pool(ttl=interval * 60 * 2)
+    scheduler = Scheduler(interval=interval, workers=workers)
+
+    def on_results(results):
+        failed = [res['company_id'] for res in results if res['error']]
+        print '%s %d companies synced, %d failed%s' % (
+            datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'), len(results), len(failed),
+            (' (%s)' % ', '.join(str(company_id) for company_id in failed)) if failed else '')
+        for res in results:
+            if res['error']:
+                print res['error']
+        sys.stdout.flush()
+
+    try:
+        scheduler.run_forever(on_results)
+    except KeyboardInterrupt:
+        scheduler.stop()
+
+
+def print_stats():
+    names = dict((c.id, c.name) for c in Company.select(Company.id, Company.name))
+
+    print '%-22s %-30s %8s %10s %10s %10s %10s' % ('metric', 'company', 'count', 'total', 'p50 (ms)', 'p95 (ms)',
+                                                   'max (ms)')
+    for metric, res in stats.get_results().items():
+        rows = [('(all)', res['total'])] + [(names.get(company_id, company_id or '-'), histogram) for
+                                            company_id, histogram in res['companies'].items()]
+        for company, histogram in rows:
+            print '%-22s %-30s %8d %10.3f %10.1f %10.1f %10.1f' % (
+                metric, company, histogram['count'], histogram['total'], histogram['p50'] * 1000,
+                histogram['p95'] * 1000, histogram['max'] * 1000)
 
 
 def main(argv):
@@ -9,11 +91,63 @@ def main(argv):
         sys.exit(1)
 
     if argv[1] == 'create_db':
-        db.create_tables(peewee.Model.__subclasses__())
+        db.create_tables(get_models())
+    elif argv[1] == 'migrate':
+        migrations.migrate()
+    elif argv[1] == 'sync-all':
+        # manage.py sync-all [since (YYYY-MM-DD), or - to sync what changed since the last sync] [workers]
+        since = datetime.datetime.strptime(argv[2], '%Y-%m-%d').date() if len(argv) > 2 and argv[2] != '-' else None
+        workers = int(argv[3]) if len(argv) > 3 else 4
+        sync_all(since, workers)
+    elif argv[1] == 'daemon':
+        # manage.py daemon [interval (minutes)] [workers]
+        interval = int(argv[2]) if len(argv) > 2 else 15
+        workers = int(argv[3]) if len(argv) > 3 else 4
+        daemon(interval, workers)
+    elif argv[1] == 'stats':
+        # manage.py stats [--json file] <command> [arguments]: runs the command with the instrumentation on, and
+        # prints what it recorded (or writes it as JSON)
+        args = argv[2:]
+        json_path = None
+        if len(args) > 1 and args[0] == '--json':
+            json_path, args = args[1], args[2:]
+
+        stats.enable()
+        try:
+            main([argv[0]] + args)
+        finally:
+            stats.disable()
+            if json_path is not None:
+                stats.dump(json_path)
+            else:
+                print
+                print_stats()
+    elif argv[1] == 'export-tasks':
+        # manage.py export-tasks <csv|ndjson> [file, or - for stdout] [company id]
+        out = open(argv[3], 'wb') if len(argv) > 3 and argv[3] != '-' else sys.stdout
+        try:
+            count = tasks_io.export_tasks(out, argv[2], int(argv[4]) if len(argv) > 4 else None)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        print >> sys.stderr, '%d tasks exported' % count
+    elif argv[1] == 'import-tasks':
+        # manage.py import-tasks [--notify] <csv|ndjson> [file, or - for stdin] [company id]: the entries have to be
+        # sorted by company and date, and they're only pushed to jira with --notify
+        notify = len(argv) > 2 and argv[2] == '--notify'
+        args = argv[3:] if notify else argv[2:]
+        inp = open(args[1], 'rb') if len(args) > 1 and args[1] != '-' else sys.stdin
+        try:
+            count = tasks_io.import_tasks(inp, args[0], int(args[2]) if len(args) > 2 else None, notify=notify)
+        finally:
+            if inp is not sys.stdin:
+                inp.close()
+        print '%d entries imported' % count
     elif argv[1] == 'create-company':
         print argv
         pass
 
 
 if __name__ == "__main__":
+    setup_database(os.environ)
     main(sys.argv)
@@ -14,4 +14,27 @@ class BaseNotificationPlugin(object):
         :type company: Company
         :return: void
         """
-        pass
\ No newline at end of file
+        pass
+
+    def get_next_due_time(self, company, now):
+        """ Gets the next time the plugin has something to do for the company, so that the scheduler runs it then
+
+        Plugins that don't depend on the time of the day (they just react to the tasks changing) don't need it
+
+        :param company: The company
+        :type company: Company
+        :param now: The current time (naive, in UTC)
+        :type now: datetime.datetime
+        :return: The next time (naive, in UTC), or None if it's not known
+        :rtype: datetime.datetime
+        """
+        return None
+
+    def close(self):
+        """ Releases the resources held by the plugin (connections, sessions)
+
+        It's called when the plugin is evicted from the plugins pool
+
+        :return: void
+        """
+        pass
@@ -0,0 +1,276 @@
+from base import BaseNotificationPlugin
+from business_logic.models import *
+from business_logic.scheduler import next_local_time
+from email.mime.text import MIMEText
+import datetime
+import hashlib
+import pytz
+import smtplib
+import socket
+import threading
+
+
+class EmailDigestSent(Model):
+    """
+    Last date whose digest was sent to some recipients for a company
+    """
+    company = ForeignKeyField(Company, related_name='email_digests_sent')
+    recipients = CharField()
+    date = DateField()
+    sent_at = DateTimeField(default=datetime.datetime.utcnow)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('company', 'recipients'), True),
+        )
+
+
+# the SMTP connections, keyed by get_connection_key. The plugin pool keeps an instance per configuration,
+# and the recipients are part of it, so the instances sending through the same server share them from here
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+class SmtpConnection(object):
+    """
+    SMTP connection opened when the first message is sent, reused for the next ones and closed once no plugin uses it
+    """
+
+    def __init__(self, host, port, username, password, use_tls):
+        self.key = get_connection_key(host, port, username, password, use_tls)
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.smtp = None
+        # amount of plugins using it
+        self.users = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        smtp = smtplib.SMTP(self.host, self.port)
+        if self.use_tls:
+            smtp.starttls()
+        if self.username is not None:
+            smtp.login(self.username, self.password)
+        return smtp
+
+    def send(self, sender, recipients, message):
+        """ Sends a message, reconnecting once if the server dropped the connection
+
+        :param sender: The address the message is sent from
+        :type sender: str
+        :param recipients: The addresses the message is sent to
+        :type recipients: [str]
+        :param message: The message
+        :type message: email.message.Message
+        :return: void
+        """
+        with self._lock:
+            for attempt in range(2):
+                if self.smtp is None:
+                    self.smtp = self.connect()
+                try:
+                    self.smtp.sendmail(sender, recipients, message.as_string())
+                    return
+                except smtplib.SMTPServerDisconnected:
+                    self.smtp = None
+                    if attempt == 1:
+                        raise
+
+    def close(self):
+        with self._lock:
+            if self.smtp is not None:
+                try:
+                    self.smtp.quit()
+                except (smtplib.SMTPException, socket.error):
+                    pass
+                self.smtp = None
+
+
+def get_connection_key(host, port, username, password, use_tls):
+    """ Gets the key a connection is shared under. The password is part of it (hashed, so it isn't kept around in
+    plain text), so a plugin with a wrong or old password doesn't get a connection logged in with another one
+
+    :rtype: tuple
+    """
+    password = password or ''
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+    return host, port, username, hashlib.sha1(password).hexdigest(), use_tls
+
+
+def get_connection(host, port, username, password, use_tls):
+    """ Gets the connection to an SMTP server, it has to be given back with release_connection
+
+    :rtype: SmtpConnection
+    """
+    with _connections_lock:
+        connection = _connections.get(get_connection_key(host, port, username, password, use_tls))
+        if connection is None:
+            connection = SmtpConnection(host, port, username, password, use_tls)
+            _connections[connection.key] = connection
+        connection.users += 1
+        return connection
+
+
+def release_connection(connection):
+    """ Gives back a connection taken with get_connection, closing it if no one else is using it
+
+    :param connection: The connection
+    :type connection: SmtpConnection
+    :return: void
+    """
+    with _connections_lock:
+        connection.users -= 1
+        if connection.users > 0:
+            return
+        del _connections[connection.key]
+    connection.close()
+
+
+def format_seconds(seconds):
+    return '%d:%02d' % (seconds // 3600, seconds % 3600 // 60)
+
+
+class EmailDigestPlugin(BaseNotificationPlugin):
+    """
+    Emails a daily digest of the tasks worked on, once the day is over on the company's timezone (at `send_at_hour`).
+
+    The SMTP connection is opened when the first digest is sent and reused for the next ones, also by the plugins of
+    other companies sending through the same server (see get_connection), so a run covering many companies doesn't
+    reconnect for each message. The days missed (because horas wasn't running, or the server was down) are sent on the
+    next run.
+    """
+
+    def __init__(self, host, sender, recipients, port=25, username=None, password=None, use_tls=False,
+                 send_at_hour=18, subject='Time report for %(date)s'):
+        """
+        :param recipients: The addresses the digest is sent to
+        :type recipients: [str]
+        :param send_at_hour: Hour of the day (on the company's timezone) from which the digest of the day is sent
+        :type send_at_hour: int
+        :param subject: Subject of the emails, %(date)s and %(company)s are replaced
+        :type subject: str
+        """
+        super(EmailDigestPlugin, self).__init__()
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipients = recipients
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.send_at_hour = send_at_hour
+        self.subject = subject
+        self.connection = None
+        self._lock = threading.Lock()
+
+    def execute_if_it_has_to(self, company):
+        for date in self.get_due_dates(company, datetime.datetime.utcnow()):
+            self.send_digest(company, date)
+
+    def get_due_dates(self, company, now):
+        """ Gets the dates whose digests are due for the company: the ones after the last digest sent, up to the
+        current one if it's already `send_at_hour`
+
+        :param company: The company
+        :type company: Company
+        :param now: The current time (naive, in UTC)
+        :type now: datetime.datetime
+        :return: The dates whose digests have to be sent, oldest first
+        :rtype: [datetime.date]
+        """
+        local_now = pytz.utc.localize(now).astimezone(pytz.timezone(company.timezone))
+        last = local_now.date()
+        if local_now.hour < self.send_at_hour:
+            last -= datetime.timedelta(days=1)
+
+        sent = self.get_digest_sent(company)
+        # the days before the first digest are not sent
+        first = local_now.date() if sent is None else sent.date + datetime.timedelta(days=1)
+
+        return [first + datetime.timedelta(days=days) for days in range((last - first).days + 1)]
+
+    def get_next_due_time(self, company, now):
+        return next_local_time(pytz.timezone(company.timezone), now, self.send_at_hour)
+
+    def get_digest_sent(self, company):
+        try:
+            return EmailDigestSent.get((EmailDigestSent.company == company.id) &
+                                       (EmailDigestSent.recipients == self.get_recipients_key()))
+        except EmailDigestSent.DoesNotExist:
+            return None
+
+    def get_recipients_key(self):
+        return ','.join(sorted(self.recipients))
+
+    def send_digest(self, company, date):
+        """ Sends the digest of a date and records it as sent
+
+        :param company: The company
+        :type company: Company
+        :param date: The date of the tasks to report
+        :type date: datetime.date
+        :return: void
+        """
+        message = MIMEText(self.render(company, date), 'plain', 'utf-8')
+        message['Subject'] = self.subject % {'date': date.isoformat(), 'company': company.name}
+        message['From'] = self.sender
+        message['To'] = ', '.join(self.recipients)
+
+        self.send(message)
+
+        sent = self.get_digest_sent(company) or EmailDigestSent(company=company.id,
+                                                                recipients=self.get_recipients_key())
+        sent.date = date
+        sent.sent_at = datetime.datetime.utcnow()
+        sent.save()
+
+    @staticmethod
+    def render(company, date):
+        """ Renders the digest of a date (all its tasks are read with a single query)
+
+        :param company: The company
+        :type company: Company
+        :param date: The date of the tasks to report
+        :type date: datetime.date
+        :return: The body of the email
+        :rtype: str
+        """
+        tasks = Task.select(Task.description, Task.time_spent_seconds).where(
+            (Task.company == company.id) & (Task.date == date)).order_by(
+            Task.time_spent_seconds.desc(), Task.description).tuples()
+
+        lines = ['%s - %s' % (company.name, date.isoformat()), '']
+        total = 0
+        for description, seconds in tasks:
+            lines.append('%6s  %s' % (format_seconds(seconds), description))
+            total += seconds
+
+        if total == 0:
+            lines.append('No time tracked')
+        else:
+            lines += ['', '%6s  Total' % format_seconds(total)]
+
+        return '\n'.join(lines) + '\n'
+
+    def send(self, message):
+        """ Sends a message through the connection shared with the other plugins using the same server
+
+        :param message: The message
+        :type message: email.message.Message
+        :return: void
+        """
+        with self._lock:
+            if self.connection is None:
+                self.connection = get_connection(self.host, self.port, self.username, self.password, self.use_tls)
+        self.connection.send(self.sender, self.recipients, message)
+
+    def close(self):
+        with self._lock:
+            if self.connection is not None:
+                release_connection(self.connection)
+                self.connection = None
@@ -1,82 +1,487 @@
 from base import BaseNotificationPlugin
 from jira.client import JIRA
+from jira.exceptions import JIRAError, raise_on_error
+from jira.resources import Worklog
 from business_logic.models import *
-from peewee import JOIN_LEFT_OUTER, fn
-import re
+from peewee import BooleanField, TextField
+from multiprocessing.pool import ThreadPool
+from business_logic.throttling import TokenBucket, call_with_retries, get_backoff_delay
+from business_logic.instrumentation import stats
+from business_logic.managers import CompaniesMgr
+from business_logic.ticket_matcher import TicketMatcher
+import collections
+import itertools
+import json
 import pytz
 from dateutil.parser import parse
 
+# max amount of issue keys on each search
+ISSUES_SEARCH_CHUNK_SIZE = 50
+# max amount of outbox items on each bulk statement
+OUTBOX_CHUNK_SIZE = 100
+
+
+def is_retryable_error(error):
+    """ Checks if a failed jira request is worth retrying (jira throttled it, or had a temporary failure)
+
+    :param error: The exception raised by the request
+    :type error: Exception
+    :rtype: bool
+    """
+    status_code = getattr(error, 'status_code', None)
+    return isinstance(status_code, int) and (status_code == 429 or status_code >= 500)
+
 
 class JiraTaskUpdated(Model):
     task = ForeignKeyField(Task, related_name='jira_tasks_updated')
     updated_at = DateTimeField(default=datetime.datetime.utcnow)
+    # the worklog created for the task, so that it can be updated without looking for it
+    issue_id = CharField(null=True)
+    worklog_id = CharField(null=True)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('task', 'updated_at'), False),
+        )
+
+
+class JiraSyncState(Model):
+    """
+    Up to which task version (see Task.version) the worklogs of a company are synced to a jira server
+    """
+    company = ForeignKeyField(Company, related_name='jira_sync_states')
+    server = CharField()
+    synced_version = IntegerField(default=0)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('company', 'server'), True),
+        )
+
+
+class JiraOutboxItem(Model):
+    """
+    A task whose worklog has to be pushed to a jira server. It stays here until the push succeeds, failures are
+    attempted again later and, after too many of them, the item is parked (it's left alone until the task changes)
+    """
+    company = ForeignKeyField(Company, related_name='jira_outbox_items')
+    server = CharField()
+    task = ForeignKeyField(Task, related_name='jira_outbox_items')
+    attempts = IntegerField(default=0)
+    next_attempt_at = DateTimeField(default=datetime.datetime.utcnow)
+    parked = BooleanField(default=False)
+    last_error = TextField(null=True)
+    created_at = DateTimeField(default=datetime.datetime.utcnow)
+    updated_at = DateTimeField(default=datetime.datetime.utcnow)
 
     class Meta:
         database = db
+        indexes = (
+            (('server', 'task'), True),
+            (('company', 'server', 'parked', 'next_attempt_at'), False),
+        )
 
 
 class JiraIssueTrackingPlugin(BaseNotificationPlugin):
-    def __init__(self, server, username, password, ticket_regexps):
+    def __init__(self, server, username, password, ticket_regexps, concurrency=1, requests_per_second=None,
+                 max_retries=3, max_attempts=8, retry_backoff=60, max_retry_backoff=6 * 3600, outbox_batch_size=1000):
+        """
+        :param concurrency: Amount of issues whose worklogs are pushed at the same time
+        :type concurrency: int
+        :param requests_per_second: Max amount of requests sent to jira per second (None for no limit)
+        :type requests_per_second: float
+        :param max_retries: Times a request is retried when jira throttles it (429) or fails (5xx)
+        :type max_retries: int
+        :param max_attempts: Runs a push is attempted on before it's parked (see JiraOutboxItem)
+        :type max_attempts: int
+        :param retry_backoff: Seconds to wait before attempting a failed push again, doubled on each attempt
+        :type retry_backoff: float
+        :param max_retry_backoff: Max seconds to wait before attempting a failed push again
+        :type max_retry_backoff: float
+        :param outbox_batch_size: Max amount of pushes attempted on each run
+        :type outbox_batch_size: int
+        """
         super(JiraIssueTrackingPlugin, self).__init__()
+        self.server = server
         self.jira = JIRA(server, basic_auth=(username, password))
         self.ticket_regexps = ticket_regexps
+        self.ticket_matcher = TicketMatcher(ticket_regexps)
+        self.concurrency = concurrency
+        self.rate_limiter = TokenBucket(requests_per_second) if requests_per_second else None
+        self.max_retries = max_retries
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.outbox_batch_size = outbox_batch_size
+
+    def close(self):
+        self.jira._session.close()
 
     def execute_if_it_has_to(self, company):
         # jira doesn't need to check if it _has_to_
-        pending_updates = Task.select().join(Company).switch(Task).join(JiraTaskUpdated, JOIN_LEFT_OUTER).where(
-            (Company.id == company.id) & (
-                (~(fn.Exists(JiraTaskUpdated.select().where(JiraTaskUpdated.task == Task.id)))) |
-                (JiraTaskUpdated.updated_at < Task.updated_at)
-            ))
+        self.enqueue_pending_tasks(company)
+        self.drain_outbox(company)
+
+    def enqueue_pending_tasks(self, company):
+        """ Adds the tasks that changed since the last run (and reference an issue) to the outbox
+
+        A task that's already there is made due again, even if it was parked, as what's pushed changed.
+
+        :param company: The company
+        :type company: Company
+        :return: The amount of tasks added
+        :rtype: int
+        """
+        sync_state = self.get_sync_state(company)
+        pending_updates = list(CompaniesMgr.get_pending_tasks(company.id, sync_state.synced_version))
+
+        if len(pending_updates) == 0:
+            return 0
+
+        matches = self.ticket_matcher.match_all([task.description for task in pending_updates])
+        task_ids = [task.id for task in pending_updates if task.description in matches]
+        now = datetime.datetime.utcnow()
+
+        with JiraOutboxItem._meta.database.transaction():
+            for i in range(0, len(task_ids), OUTBOX_CHUNK_SIZE):
+                chunk = task_ids[i:i + OUTBOX_CHUNK_SIZE]
+                in_chunk = (JiraOutboxItem.server == self.server) & (JiraOutboxItem.task << chunk)
+
+                existing = set(row[0] for row in JiraOutboxItem.select(JiraOutboxItem.task).where(in_chunk).tuples())
+                JiraOutboxItem.update(attempts=0, parked=False, next_attempt_at=now, last_error=None,
+                                      updated_at=now).where(in_chunk).execute()
+
+                new_items = [{'company': company.id, 'server': self.server, 'task': task_id, 'attempts': 0,
+                              'parked': False, 'next_attempt_at': now, 'created_at': now, 'updated_at': now}
+                             for task_id in chunk if task_id not in existing]
+                if new_items:
+                    JiraOutboxItem.insert_many(new_items).execute()
+
+            # the outbox has them now, so the sync state can move past them
+            sync_state.synced_version = pending_updates[-1].version
+            sync_state.save()
+
+        return len(task_ids)
+
+    def drain_outbox(self, company, now=None):
+        """ Attempts the pushes of the company that are due. The ones that succeed leave the outbox, the ones that fail
+        are attempted again later (waiting longer each time) and parked after `max_attempts` attempts
+
+        :param company: The company
+        :type company: Company
+        :param now: The current time (naive, in UTC), defaults to now
+        :type now: datetime.datetime
+        :return: The amount of pushes that failed
+        :rtype: int
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        due = ((JiraOutboxItem.company == company.id) & (JiraOutboxItem.server == self.server) &
+               (JiraOutboxItem.parked == False) & (JiraOutboxItem.next_attempt_at <= now))
+        items = list(JiraOutboxItem.select(JiraOutboxItem, Task).join(Task).where(due).order_by(
+            JiraOutboxItem.id).limit(self.outbox_batch_size))
+
+        if len(items) == 0:
+            return 0
 
         company_tz = pytz.timezone(company.timezone)
 
-        for task in list(pending_updates):
-            # get the ticket id
-            current_best_position = len(task.description)
-            current_match = None
-            for regexp in self.ticket_regexps:
-                match = re.search('\\b(' + regexp + ')\\b', task.description)
-                if match is not None and match.start(1) < current_best_position:
-                    current_best_position = match.start(1)
-                    current_match = match.group(1)
-
-            if current_match is not None:
-                issue = None
-                try:
-                    issue = self.jira.issue(current_match)
-                except:
-                    pass
-
-                if issue is not None:
-                    # found a ticket!
-                    description = task.description
-                    if current_best_position == 0:
-                        description = re.sub('^[^a-zA-Z0-9\\(]*', '', task.description[len(current_match):])
-
-                    worklog_ready = False
-                    for worklog in self.jira.worklogs(issue.id):
-                        started = parse(worklog.started).astimezone(company_tz).date()
-                        if task.date == started and worklog.comment == description:
-                            if worklog.timeSpentSeconds != task.time_spent_seconds:
-                                worklog.update(timeSpentSeconds=task.time_spent_seconds)
-                            worklog_ready = True
-
-                    if not worklog_ready:
-                        # get the timezone suffix on the task's date (considering DST)
-                        task_date_with_time = datetime.datetime.combine(task.date, datetime.datetime.min.time())
-                        suffix = company_tz.localize(task_date_with_time).strftime('%z')
-
-                        # make it 6pm wherever they are
-                        dt = parse(task.date.strftime('%Y-%m-%dT18:00:00') + suffix)
-                        self.jira.add_worklog(issue.id, timeSpentSeconds=task.time_spent_seconds, started=dt,
-                                              comment=description)
-
-                    if task.jira_tasks_updated.count() == 0:
-                        task_updated = JiraTaskUpdated()
+        matches = self.ticket_matcher.match_all([item.task.description for item in items])
+        issue_errors = {}
+        issues = self.get_issues(set([key for key, description in matches.values()]), issue_errors)
+
+        # pushes on each issue, the ones on the same issue are done sequentially as they share its worklogs
+        items_by_issue = collections.OrderedDict()
+        # items that don't need to be pushed: their key is gone (the regexps changed) or their issue doesn't exist
+        done = []
+        failed = []
+        for item in items:
+            match = matches.get(item.task.description)
+            if match is not None and match[0] in issue_errors:
+                failed.append((item, issue_errors[match[0]]))
+            elif match is not None and match[0] in issues:
+                issue = issues[match[0]]
+                items_by_issue.setdefault(issue.id, (issue, []))[1].append((item, match[1]))
+            else:
+                done.append(item)
+
+        # worklogs of each issue (by issue id), only valid during this run
+        worklogs_cache = {}
+
+        # what was pushed for each task before
+        tasks_updated = dict((task_updated.task.id, task_updated) for task_updated in
+                             JiraTaskUpdated.select(JiraTaskUpdated, Task).join(Task).where(
+                                 Task.id << JiraOutboxItem.select(JiraOutboxItem.task).where(due)))
+
+        def push_issue_worklogs(entry):
+            issue, issue_items = entry
+            res = []
+            # this may run on a pool thread, that doesn't know which company it's working for
+            with stats.company(company.id):
+                for item, description in issue_items:
+                    try:
+                        worklog_id = self.push_worklog(item.task, issue, description, company_tz, worklogs_cache,
+                                                       tasks_updated.get(item.task.id))
+                        res.append((item, issue.id, worklog_id, None))
+                    except Exception as e:
+                        res.append((item, issue.id, None, e))
+            return res
+
+        if self.concurrency > 1 and len(items_by_issue) > 1:
+            pool = ThreadPool(min(self.concurrency, len(items_by_issue)))
+            results = pool.imap_unordered(push_issue_worklogs, items_by_issue.values())
+        else:
+            pool = None
+            results = itertools.imap(push_issue_worklogs, items_by_issue.values())
+
+        try:
+            # pushes finish in any order, but each result is recorded (here, on a single thread) as soon as it's done
+            for pushed in results:
+                for item, issue_id, worklog_id, error in pushed:
+                    if error is None:
+                        self.mark_as_updated(item.task, issue_id, worklog_id, tasks_updated.get(item.task.id))
+                        done.append(item)
                     else:
-                        task_updated = task.jira_tasks_updated[0]
+                        failed.append((item, error))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+            with JiraOutboxItem._meta.database.transaction():
+                done_ids = [item.id for item in done]
+                for i in range(0, len(done_ids), OUTBOX_CHUNK_SIZE):
+                    JiraOutboxItem.delete().where(JiraOutboxItem.id << done_ids[i:i + OUTBOX_CHUNK_SIZE]).execute()
+
+                for item, error in failed:
+                    self.record_failure(item, error, now)
+
+        return len(failed)
+
+    def record_failure(self, item, error, now):
+        """ Records a failed push, scheduling its next attempt or parking it if it ran out of them
+
+        :param item: The outbox item
+        :type item: JiraOutboxItem
+        :param error: The exception raised by the push
+        :type error: Exception
+        :param now: The current time (naive, in UTC)
+        :type now: datetime.datetime
+        :return: void
+        """
+        item.attempts += 1
+        item.last_error = ('%s: %s' % (type(error).__name__, error))[:1000]
+        item.updated_at = now
+        if item.attempts >= self.max_attempts:
+            item.parked = True
+        else:
+            item.next_attempt_at = now + datetime.timedelta(
+                seconds=get_backoff_delay(item.attempts - 1, self.retry_backoff, self.max_retry_backoff))
+        item.save()
+
+    def get_sync_state(self, company):
+        """ Gets up to which task version the tasks of the company were added to the outbox of this plugin's server
+
+        :param company: The company
+        :type company: Company
+        :rtype: JiraSyncState
+        """
+        try:
+            return JiraSyncState.get((JiraSyncState.company == company.id) & (JiraSyncState.server == self.server))
+        except JiraSyncState.DoesNotExist:
+            return JiraSyncState(company=company.id, server=self.server)
+
+    @staticmethod
+    def mark_as_updated(task, issue_id, worklog_id, task_updated=None):
+        """ Records that the worklog of a task is up to date with the task as it was read
+
+        :param task: The task pushed
+        :type task: Task
+        :param issue_id: The id of the issue the worklog is on
+        :type issue_id: str
+        :param worklog_id: The id of the worklog
+        :type worklog_id: str
+        :param task_updated: What was recorded the previous time the task was pushed, if it was
+        :type task_updated: JiraTaskUpdated
+        :return: void
+        """
+        if task_updated is None:
+            task_updated = JiraTaskUpdated()
+
+        task_updated.task = task
+        task_updated.issue_id = issue_id
+        task_updated.worklog_id = worklog_id
+        task_updated.updated_at = datetime.datetime.utcnow()
+        task_updated.save()
+
+    def request(self, fn, *args, **kwargs):
+        """ Sends a request to jira, waiting for the rate limiter and retrying it if jira throttles it or fails
+
+        :param fn: The client function that sends the request
+        :return: Whatever the function returns
+        """
+        def send():
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            with stats.timed('http.jira'):
+                return fn(*args, **kwargs)
+
+        return call_with_retries(send, is_retryable_error, max_retries=self.max_retries)
+
+    def get_issues(self, keys, errors=None):
+        """ Gets the issues with the given keys, searching for them in chunks
+
+        :param keys: The issue keys
+        :type keys: set
+        :param errors: If set, the keys that couldn't be looked up (for any reason other than the issue not existing,
+            including jira not being reachable) are added to it with their error instead of raising it
+        :type errors: dict
+        :return: The issues that exist, by the key they were asked with
+        :rtype: dict
+        """
+        keys = sorted(keys)
+        res = {}
+        for i in range(0, len(keys), ISSUES_SEARCH_CHUNK_SIZE):
+            chunk = keys[i:i + ISSUES_SEARCH_CHUNK_SIZE]
+            try:
+                jql = 'key in (%s)' % ','.join(['"%s"' % key for key in chunk])
+                found = self.request(self.jira.search_issues, jql, maxResults=len(chunk), fields='key')
+            except JIRAError:
+                # jira rejects the whole search if any of the keys doesn't exist
+                found = []
+            except Exception as e:
+                # jira couldn't be reached (or timed out), so none of the keys can be looked up now
+                if errors is None:
+                    raise
+                for key in chunk:
+                    errors[key] = e
+                continue
+
+            for issue in found:
+                res[issue.key] = issue
+
+            # keys that weren't found (they don't exist, or the issue was moved) are looked up one by one
+            for key in chunk:
+                if key not in res:
+                    try:
+                        res[key] = self.request(self.jira.issue, key)
+                    except Exception as e:
+                        if getattr(e, 'status_code', None) == 404:
+                            continue
+                        if errors is None:
+                            raise
+                        errors[key] = e
+
+        return res
+
+    def get_worklogs(self, issue, worklogs_cache):
+        """ Gets the worklogs of an issue, fetching them only the first time they're needed on a run
+
+        :param issue: The issue
+        :param worklogs_cache: The worklogs already fetched on this run, by issue id
+        :type worklogs_cache: dict
+        :return: The worklogs of the issue
+        :rtype: list
+        """
+        if issue.id not in worklogs_cache:
+            worklogs_cache[issue.id] = self.request(self.jira.worklogs, issue.id)
+        return worklogs_cache[issue.id]
+
+    def push_worklog(self, task, issue, description, company_tz, worklogs_cache, task_updated=None):
+        """ Creates or updates the worklog of a task on its issue
+
+        If the id of the worklog created for the task is known it's updated directly, the worklogs of the issue are
+        only scanned looking for it when it isn't (or it no longer exists).
+
+        :param task: The task to log
+        :type task: Task
+        :param issue: The issue referenced by the task
+        :param description: The comment for the worklog
+        :type description: str
+        :param company_tz: The timezone of the company
+        :param worklogs_cache: The worklogs already fetched on this run, by issue id (it's kept updated)
+        :type worklogs_cache: dict
+        :param task_updated: What was recorded the previous time the task was pushed, if it was
+        :type task_updated: JiraTaskUpdated
+        :return: The id of the worklog
+        :rtype: str
+        """
+        if task_updated is not None and task_updated.worklog_id is not None and task_updated.issue_id == issue.id:
+            try:
+                self.request(self.update_worklog, issue.id, task_updated.worklog_id, task.time_spent_seconds)
+                for worklog in worklogs_cache.get(issue.id, []):
+                    if worklog.id == task_updated.worklog_id:
+                        worklog.timeSpentSeconds = task.time_spent_seconds
+                return task_updated.worklog_id
+            except JIRAError as e:
+                if e.status_code != 404:
+                    raise
+                # the worklog was deleted, look for it (or create it again)
+
+        worklogs = self.get_worklogs(issue, worklogs_cache)
+
+        worklog_id = None
+        for worklog in worklogs:
+            started = parse(worklog.started).astimezone(company_tz).date()
+            if task.date == started and worklog.comment == description:
+                if worklog.timeSpentSeconds != task.time_spent_seconds:
+                    self.request(self.update_worklog, issue.id, worklog.id, task.time_spent_seconds)
+                    worklog.timeSpentSeconds = task.time_spent_seconds
+                worklog_id = worklog.id
+
+        if worklog_id is None:
+            # get the timezone suffix on the task's date (considering DST)
+            task_date_with_time = datetime.datetime.combine(task.date, datetime.datetime.min.time())
+            suffix = company_tz.localize(task_date_with_time).strftime('%z')
+
+            # make it 6pm wherever they are
+            dt = parse(task.date.strftime('%Y-%m-%dT18:00:00') + suffix)
+            worklog = self.request(self.add_worklog, issue.id, task.time_spent_seconds, dt, description)
+            worklogs.append(worklog)
+            worklog_id = worklog.id
+
+        return worklog_id
+
+    def add_worklog(self, issue_id, time_spent_seconds, started, comment):
+        """ Creates a worklog on an issue with a single request
+
+        The client's add_worklog doesn't support setting the time in seconds
+
+        :param issue_id: The id of the issue
+        :type issue_id: str
+        :param time_spent_seconds: The time spent
+        :type time_spent_seconds: int
+        :param started: When the work started
+        :type started: datetime.datetime
+        :param comment: The worklog comment
+        :type comment: str
+        :return: The worklog created
+        :rtype: Worklog
+        """
+        data = {'timeSpentSeconds': time_spent_seconds, 'comment': comment,
+                'started': started.strftime('%Y-%m-%dT%H:%M:%S.000%z')}
+        r = self.jira._session.post(self.jira._get_url('issue/%s/worklog' % issue_id),
+                                    headers={'content-type': 'application/json'}, data=json.dumps(data))
+        raise_on_error(r)
+        return Worklog(self.jira._options, self.jira._session, json.loads(r.text))
+
+    def update_worklog(self, issue_id, worklog_id, time_spent_seconds):
+        """ Updates the time spent on a worklog with a single request
+
+        The client's Worklog.update sends the update twice and then reloads the worklog
 
-                    task_updated.task = task
-                    task_updated.updated_at = datetime.datetime.utcnow()
-                    task_updated.save()
\ No newline at end of file
+        :param issue_id: The id of the issue
+        :type issue_id: str
+        :param worklog_id: The id of the worklog
+        :type worklog_id: str
+        :param time_spent_seconds: The time spent
+        :type time_spent_seconds: int
+        :return: void
+        """
+        r = self.jira._session.put(self.jira._get_url('issue/%s/worklog/%s' % (issue_id, worklog_id)),
+                                   headers={'content-type': 'application/json'},
+                                   data=json.dumps({'timeSpentSeconds': time_spent_seconds}))
+        raise_on_error(r)
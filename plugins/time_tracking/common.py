@@ -1,11 +1,49 @@
 from abc import ABCMeta, abstractmethod
 from business_logic.models import Task, Company
 import datetime
+import pytz
 
 class BaseTimeTrackingPlugin(object):
     __metaclass__ = ABCMeta
 
     @abstractmethod
+    def get_time_tracking_results(self, company, date):
+        """ Gets the time tracked since the given date for the given company
+
+        :param company: The company to get the time for
+        :type company: Company
+        :param date: The date to start checking the times
+        :type date: datetime.date
+        :return: The time tracking results (dicts with 'description' and 'seconds') of each date
+        :rtype: dict
+        """
+        pass
+
+    def get_time_tracking_changes(self, company, cursor):
+        """ Gets the time tracking results that changed after the given cursor
+
+        Every date returned has its full results, as they replace the ones already stored. This default implementation
+        uses the last date ingested as the cursor and fetches again from it (as it may have changed since), plugins that
+        can tell exactly what changed should override it.
+
+        :param company: The company to get the time for
+        :type company: Company
+        :param cursor: The cursor returned on the previous call, or None if there wasn't one
+        :type cursor: str
+        :return: The time tracking results of each date (see get_time_tracking_results) and the new cursor
+        :rtype: (dict, str)
+        """
+        if cursor is None:
+            since = datetime.datetime.now(pytz.timezone(company.timezone)).date() - datetime.timedelta(days=1)
+        else:
+            since = datetime.datetime.strptime(cursor, '%Y-%m-%d').date()
+
+        results = self.get_time_tracking_results(company, since)
+        if len(results) == 0:
+            return results, cursor
+
+        return results, max(results).isoformat()
+
     def update_tasks_since(self, company, date):
         """ Updates all the tasks since the given date for the given company
 
@@ -16,4 +54,19 @@ class BaseTimeTrackingPlugin(object):
         :return: List of the tasks updated
         :rtype: [Task]
         """
+        # imported here, as the managers module imports this one
+        from business_logic.managers import CompaniesMgr
+
+        results = self.get_time_tracking_results(company, date)
+        CompaniesMgr.update_tasks_bulk(company.id, results)
+
+        return list(company.tasks.where(Task.date << results.keys())) if results else []
+
+    def close(self):
+        """ Releases the resources held by the plugin (connections, sessions)
+
+        It's called when the plugin is evicted from the plugins pool
+
+        :return: void
+        """
         pass
@@ -5,5 +5,25 @@ class TimeTrackingTestPlugin(BaseTimeTrackingPlugin):
     def __init__(self, responses):
         self.test_responses = responses
 
-    def update_tasks_since(self, company, date):
-        raise Exception()
+    def get_time_tracking_results(self, company, date):
+        # the responses are snapshots of each day taken at different times, the latest one has the whole day
+        latest = {}
+        for snapshot in self.test_responses:
+            if snapshot.date() >= date and (snapshot.date() not in latest or snapshot > latest[snapshot.date()]):
+                latest[snapshot.date()] = snapshot
+
+        return dict((day, self.test_responses[snapshot]) for day, snapshot in latest.items())
+
+    def get_time_tracking_changes(self, company, cursor):
+        # the cursor is the time of the last snapshot ingested, only the days with newer snapshots changed
+        latest = {}
+        for snapshot in self.test_responses:
+            if (cursor is None or snapshot.isoformat() > cursor) and \
+                    (snapshot.date() not in latest or snapshot > latest[snapshot.date()]):
+                latest[snapshot.date()] = snapshot
+
+        if len(latest) == 0:
+            return {}, cursor
+
+        return dict((day, self.test_responses[snapshot]) for day, snapshot in latest.items()), \
+            max(latest.values()).isoformat()
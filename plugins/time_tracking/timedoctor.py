@@ -1,13 +1,146 @@
 from common import BaseTimeTrackingPlugin
+from business_logic.aggregation import TimeTrackingAggregator
+from business_logic.instrumentation import stats
+from requests.adapters import HTTPAdapter
+import datetime
+import pytz
+import requests
 
+API_URL = 'https://webapi.timedoctor.com'
 
-class TimeDoctorPlugin(BaseTimeTrackingPlugin):
-    def __init__(self, username, password):
-        super(TimeDoctorPlugin, self).__init__()
+
+class TimeDoctorAccount(object):
+    """
+    A TimeDoctor account, with its own pooled HTTP session and access token
+    """
+
+    def __init__(self, base_url, username, password, client_id, client_secret, company_id=None, projects=None,
+                 page_size=500):
+        """
+        :param company_id: The TimeDoctor company to get the worklogs from, defaults to the user's one
+        :type company_id: int
+        :param projects: If set, only the worklogs of these projects are considered (for accounts shared by
+            several customers)
+        :type projects: [str]
+        :param page_size: Amount of worklogs requested on each page
+        :type page_size: int
+        """
+        self.base_url = base_url.rstrip('/')
         self.username = username
         self.password = password
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.company_id = company_id
+        self.projects = set(projects) if projects else None
+        self.page_size = page_size
+        self.access_token = None
+
+        self.session = requests.Session()
+        self.session.mount(self.base_url, HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+    def authenticate(self):
+        r = self.session.get(self.base_url + '/oauth/v2/token', params={
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'grant_type': 'password',
+            'username': self.username,
+            'password': self.password
+        })
+        r.raise_for_status()
+        self.access_token = r.json()['access_token']
+
+    def get(self, path, **params):
+        """ Sends a GET request to the API, authenticating first if needed (or if the token expired)
+
+        :param path: The path of the endpoint
+        :type path: str
+        :return: The decoded response
+        :rtype: dict
+        """
+        if self.access_token is None:
+            self.authenticate()
+
+        params['access_token'] = self.access_token
+        with stats.timed('http.timedoctor'):
+            r = self.session.get(self.base_url + path, params=params)
+        if r.status_code == 401:
+            self.authenticate()
+            params['access_token'] = self.access_token
+            with stats.timed('http.timedoctor'):
+                r = self.session.get(self.base_url + path, params=params)
+
+        r.raise_for_status()
+        return r.json()
+
+    def get_company_id(self):
+        if self.company_id is None:
+            self.company_id = self.get('/v1.1/companies')['user']['company_id']
+        return self.company_id
+
+    def iter_worklogs(self, start_date, end_date):
+        """ Iterates over the worklogs between the given dates, requesting the pages as they're needed
+
+        :param start_date: The first date to get the worklogs of
+        :type start_date: datetime.date
+        :param end_date: The last date to get the worklogs of
+        :type end_date: datetime.date
+        :return: The worklogs (as returned by the API)
+        :rtype: generator
+        """
+        path = '/v1.1/companies/%s/worklogs' % self.get_company_id()
+        offset = 1
+        while True:
+            page = self.get(path, start_date=start_date.isoformat(), end_date=end_date.isoformat(),
+                            offset=offset, limit=self.page_size, consolidated=0)
+            items = page['worklogs']['items']
+
+            for item in items:
+                if self.projects is None or item.get('project_name') in self.projects:
+                    yield item
+
+            offset += len(items)
+            if len(items) < self.page_size or offset > page.get('count', offset):
+                return
+
+    def close(self):
+        self.session.close()
+
+
+class TimeDoctorPlugin(BaseTimeTrackingPlugin):
+    def __init__(self, username=None, password=None, client_id=None, client_secret=None, company_id=None,
+                 projects=None, accounts=None, base_url=API_URL, page_size=500):
+        """
+        The account can be set with the arguments, or several of them can be used by setting `accounts` (a list of
+        dicts with username, password, client_id, client_secret and optionally company_id and projects)
+        """
+        super(TimeDoctorPlugin, self).__init__()
+
+        if accounts is None:
+            accounts = [{'username': username, 'password': password, 'client_id': client_id,
+                         'client_secret': client_secret, 'company_id': company_id, 'projects': projects}]
+
+        self.accounts = [TimeDoctorAccount(base_url=base_url, page_size=page_size, **account) for account in accounts]
+
+    def iter_worklogs(self, start_date, end_date):
+        """ Iterates over the worklogs of all the accounts between the given dates
+
+        :rtype: generator
+        """
+        for account in self.accounts:
+            for item in account.iter_worklogs(start_date, end_date):
+                yield item
+
+    def get_time_tracking_results(self, company, date):
+        today = datetime.datetime.now(pytz.timezone(company.timezone)).date()
+
+        # the worklogs are summed as they arrive, so only the totals are kept in memory
+        aggregator = TimeTrackingAggregator()
+        for item in self.iter_worklogs(date, today):
+            day = datetime.datetime.strptime(item['start_time'][:10], '%Y-%m-%d').date()
+            aggregator.add(day, item['task_name'], int(item['length']))
 
-    def update_tasks_since(self, company, date):
-        res = []
+        return aggregator.get_results()
 
-        pass
\ No newline at end of file
+    def close(self):
+        for account in self.accounts:
+            account.close()
@@ -1,4 +1,5 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import random
 
 data = {
     'companies': [
@@ -93,3 +94,46 @@ data = {
         }
     ]
 }
+
+
+def generate_companies(count, days=30, tasks_per_day=20, start=datetime(2014, 1, 1)):
+    """ Generates companies shaped like the ones on `data`, with `tasks_per_day` distinct tasks tracked on each of
+    `days` days. It's deterministic, so the same arguments always produce the same data
+
+    :param count: Amount of companies to generate
+    :type count: int
+    :return: The companies, one at a time
+    :rtype: generator
+    """
+    for i in range(count):
+        rnd = random.Random(i)
+        project = 'P%d' % i
+        yield {
+            'name': 'Company %d' % i,
+            'timezone': rnd.choice(['US/Pacific', 'US/Eastern', 'Europe/London', 'America/Montevideo']),
+            'notification_plugins': [
+                {
+                    'notification_plugin': 'jira_plugin.JiraIssueTrackingPlugin',
+                    'notification_data': {
+                        'server': 'http://127.0.0.1:2990/jira',
+                        'username': 'admin',
+                        'password': 'admin',
+                        'ticket_regexps': [
+                            project + '-[0-9]+'
+                        ]
+                    },
+                }
+            ],
+            'time_tracking_plugin': 'test.TimeTrackingTestPlugin',
+            'time_tracking_data': {
+                'responses': dict(
+                    (start + timedelta(days=day, hours=18), [
+                        {
+                            'description': '%s-%d task %d' % (project, rnd.randint(1, 50), t) if t % 4 else
+                            'meeting %d' % t,
+                            'seconds': rnd.randint(1, 240) * 30
+                        } for t in range(tasks_per_day)
+                    ]) for day in range(days)
+                )
+            }
+        }
@@ -0,0 +1,328 @@
+"""
+Local stand-ins for the external services the plugins talk to, so that the tests run offline
+"""
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import asyncore
+import email
+import json
+import re
+import smtpd
+import threading
+import time
+import urlparse
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server running on a background thread on a random local port. It records every request it receives in
+    `requests` as (method, path, query params) tuples
+    """
+    daemon_threads = True
+
+    def __init__(self, handler_class):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler_class)
+        self.requests = []
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def parse(self):
+        parsed = urlparse.urlparse(self.path)
+        params = dict((k, v[-1]) for k, v in urlparse.parse_qs(parsed.query).items())
+        self.server.requests.append((self.command, parsed.path, params))
+        return parsed.path, params
+
+    responded = False
+
+    def respond(self, status, body=None):
+        self.responded = True
+        data = json.dumps(body) if body is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class TimeDoctorHandler(StubRequestHandler):
+    def do_GET(self):
+        path, params = self.parse()
+        server = self.server
+
+        if path == '/oauth/v2/token':
+            if (params.get('username'), params.get('password')) not in server.credentials:
+                return self.respond(400, {'error': 'invalid_grant'})
+            return self.respond(200, {'access_token': 'token-' + params['username'], 'expires_in': 3600})
+
+        username = params.get('access_token', '')[len('token-'):]
+        if username not in server.worklogs:
+            return self.respond(401, {'error': 'invalid_token'})
+
+        if path == '/v1.1/companies':
+            return self.respond(200, {'user': {'company_id': server.company_ids[username]}})
+
+        if path == '/v1.1/companies/%s/worklogs' % server.company_ids[username]:
+            items = [item for item in server.worklogs[username] if
+                     params['start_date'] <= item['start_time'][:10] <= params['end_date']]
+            offset, limit = int(params['offset']), int(params['limit'])
+            page = items[offset - 1:offset - 1 + limit]
+            return self.respond(200, {'count': len(items), 'offset': offset, 'limit': limit,
+                                      'worklogs': {'count': len(page), 'items': page}})
+
+        self.respond(404, {'error': 'not found'})
+
+
+class TimeDoctorStubServer(StubServer):
+    """
+    Stand-in for the TimeDoctor API: password grant tokens, the user's company and its paginated worklogs
+    """
+
+    def __init__(self):
+        StubServer.__init__(self, TimeDoctorHandler)
+        self.credentials = set()
+        self.company_ids = {}
+        self.worklogs = {}
+
+    def add_account(self, username, password, company_id, worklogs):
+        """
+        :param worklogs: The worklogs of the account, as the API returns them (task_name, project_name, start_time
+            and length are the ones used)
+        :type worklogs: [dict]
+        """
+        self.credentials.add((username, password))
+        self.company_ids[username] = company_id
+        self.worklogs[username] = worklogs
+
+
+class JiraHandler(StubRequestHandler):
+    api = '/jira/rest/api/2'
+
+    def issue_json(self, issue):
+        return {'id': issue['id'], 'key': issue['key'], 'self': self.server.url + self.api + '/issue/' + issue['id'],
+                'fields': {}}
+
+    def worklog_json(self, issue, worklog):
+        res = dict(worklog)
+        res['self'] = '%s%s/issue/%s/worklog/%s' % (self.server.url, self.api, issue['id'], worklog['id'])
+        return res
+
+    def read_body(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def route(self):
+        path, params = self.parse()
+        time.sleep(self.server.get_delay(self.command, path))
+        status = self.server.get_failure(self.command, path)
+        if status is not None:
+            self.respond(status, {'errorMessages': ['Injected failure']})
+            return None, None, params
+        if not path.startswith(self.api + '/'):
+            return None, None, params
+        parts = path[len(self.api) + 1:].split('/')
+        return parts, self.server.find_issue(parts[1]) if parts[0] == 'issue' and len(parts) > 1 else None, params
+
+    def do_GET(self):
+        parts, issue, params = self.route()
+        server = self.server
+        if self.responded:
+            return
+
+        if parts == ['serverInfo']:
+            return self.respond(200, {'versionNumbers': [6, 3, 0], 'version': '6.3.0'})
+
+        if parts == ['search']:
+            keys = re.findall('"([^"]+)"', params.get('jql', ''))
+            missing = [key for key in keys if server.find_issue(key) is None]
+            if missing:
+                return self.respond(400, {'errorMessages': [
+                    "An issue with key '%s' does not exist for field 'key'." % missing[0]]})
+            issues = [self.issue_json(server.find_issue(key)) for key in keys]
+            return self.respond(200, {'startAt': 0, 'maxResults': len(issues), 'total': len(issues),
+                                      'issues': issues})
+
+        if parts is not None and parts[0] == 'issue':
+            if issue is None:
+                return self.respond(404, {'errorMessages': ['Issue Does Not Exist']})
+            if len(parts) == 2:
+                return self.respond(200, self.issue_json(issue))
+            if parts[2:] == ['worklog']:
+                worklogs = [self.worklog_json(issue, w) for w in issue['worklogs']]
+                return self.respond(200, {'startAt': 0, 'maxResults': len(worklogs), 'total': len(worklogs),
+                                          'worklogs': worklogs})
+
+        self.respond(404, {'errorMessages': ['Not found']})
+
+    def do_POST(self):
+        parts, issue, params = self.route()
+        if self.responded:
+            return
+
+        if parts is not None and issue is not None and parts[2:] == ['worklog']:
+            data = self.read_body()
+            with self.server.lock:
+                worklog = {'id': str(self.server.next_id()), 'comment': data.get('comment'),
+                           'started': data['started'], 'timeSpentSeconds': data['timeSpentSeconds']}
+                issue['worklogs'].append(worklog)
+            return self.respond(201, self.worklog_json(issue, worklog))
+
+        self.respond(404, {'errorMessages': ['Not found']})
+
+    def do_PUT(self):
+        parts, issue, params = self.route()
+        if self.responded:
+            return
+
+        if parts is not None and issue is not None and len(parts) == 4 and parts[2] == 'worklog':
+            worklog = [w for w in issue['worklogs'] if w['id'] == parts[3]]
+            if worklog:
+                worklog[0].update(dict((k, v) for k, v in self.read_body().items() if
+                                       k in ('comment', 'started', 'timeSpentSeconds')))
+                return self.respond(200, self.worklog_json(issue, worklog[0]))
+
+        self.respond(404, {'errorMessages': ['Not found']})
+
+
+class JiraStubServer(StubServer):
+    """
+    In-process stand-in for the parts of the JIRA REST API the jira plugin uses: server info, issues, key searches
+    and worklogs. Its url (with the /jira context path) can be used as the plugin's server
+    """
+
+    def __init__(self):
+        StubServer.__init__(self, JiraHandler)
+        self.lock = threading.Lock()
+        self.reset()
+
+    @property
+    def jira_url(self):
+        return self.url + '/jira'
+
+    def reset(self, issue_keys=()):
+        """ Removes all the issues (and worklogs) and the recorded requests, and creates the given issues
+
+        :param issue_keys: The keys of the issues to create
+        :type issue_keys: [str]
+        """
+        with self.lock:
+            self.issues = {}
+            self.issues_by_id = {}
+            self.failures = []
+            self.delays = []
+            self._last_id = 10000
+            del self.requests[:]
+        for key in issue_keys:
+            self.add_issue(key)
+
+    def next_id(self):
+        self._last_id += 1
+        return self._last_id
+
+    def fail(self, method, path_regexp, status=503, times=None):
+        """ Makes the matching requests fail
+
+        :param method: The HTTP method of the requests
+        :type method: str
+        :param path_regexp: Regexp searched on the path of the requests
+        :type path_regexp: str
+        :param status: The status code they get
+        :type status: int
+        :param times: Amount of requests that fail, None for all of them (until the server is reset)
+        :type times: int
+        """
+        with self.lock:
+            self.failures.append([method, re.compile(path_regexp), status, times])
+
+    def get_failure(self, method, path):
+        with self.lock:
+            for failure in self.failures:
+                if failure[0] == method and failure[1].search(path) and failure[3] != 0:
+                    if failure[3] is not None:
+                        failure[3] -= 1
+                    return failure[2]
+        return None
+
+    def delay(self, method, path_regexp, seconds):
+        """ Makes the matching requests take longer
+
+        :param method: The HTTP method of the requests
+        :type method: str
+        :param path_regexp: Regexp searched on the path of the requests
+        :type path_regexp: str
+        :param seconds: The time they take
+        :type seconds: float
+        """
+        with self.lock:
+            self.delays.append((method, re.compile(path_regexp), seconds))
+
+    def get_delay(self, method, path):
+        with self.lock:
+            return sum(delay[2] for delay in self.delays if delay[0] == method and delay[1].search(path))
+
+    def add_issue(self, key):
+        with self.lock:
+            issue = {'id': str(self.next_id()), 'key': key, 'worklogs': []}
+            self.issues[key] = issue
+            self.issues_by_id[issue['id']] = issue
+        return issue
+
+    def find_issue(self, key_or_id):
+        return self.issues.get(key_or_id) or self.issues_by_id.get(key_or_id)
+
+    def get_worklogs(self, key):
+        return self.issues[key]['worklogs']
+
+
+class SmtpStubServer(smtpd.SMTPServer):
+    """
+    Local SMTP server keeping the messages it receives in `messages` (as email.message.Message) and counting the
+    connections it accepts in `connections`
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.messages = []
+        self.connections = 0
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        message = email.message_from_string(data)
+        message.rcpttos = rcpttos
+        self.messages.append(message)
+
+    def start(self):
+        self._thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05, 'map': self._map})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        for channel in list(self._map.values()):
+            channel.close()
+        self._thread.join(1)
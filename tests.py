@@ -1,41 +1,71 @@
 import unittest
-import inspect
-import peewee
-import sys
 import copy
-import itertools
-import re
 from test_data import data as test_data
+from test_servers import TimeDoctorStubServer, JiraStubServer, SmtpStubServer
 from abc import ABCMeta
 from jira.client import JIRA
-from playhouse.test_utils import test_database
+from jira.exceptions import JIRAError
 from business_logic.managers import *
 from business_logic.models import *
 from dateutil.parser import parse
 import pytz
 import math
+import pickle
+import os
+import socket
+import tempfile
+import threading
+import time
+import benchmarks
+from business_logic import migrations
+from business_logic.config import is_legacy_config
+from business_logic.aggregation import TimeTrackingAggregator
+from business_logic.pool import PluginPool
+from business_logic.ticket_matcher import TicketMatcher
+from business_logic.instrumentation import Histogram, stats
+from business_logic.database import PooledSqliteDatabase, release_connection
+from business_logic.throttling import TokenBucket, call_with_retries
+from peewee import IntegrityError, fn
+from playhouse.test_utils import test_database
+from business_logic.scheduler import Scheduler, next_local_time, next_interval_time
+from business_logic.tasks_io import export_tasks, import_tasks
+from StringIO import StringIO
 
 # need to import all the plugins that have DB tables so that TestCaseWithPeewee's run() method loads them
 import plugins.notification.jira_plugin
+from plugins.notification.jira_plugin import JiraIssueTrackingPlugin, JiraOutboxItem, JiraTaskUpdated, \
+    is_retryable_error
+from plugins.notification.email_plugin import EmailDigestPlugin, get_connection_key
 # ########################################################################################################
 
-test_db = peewee.SqliteDatabase('test' + datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S') + '.db')
+# the jira plugin talks to this stand-in instead of a real JIRA
+jira_server = JiraStubServer().start()
+for company in test_data['companies']:
+    for conf in company['notification_plugins']:
+        if conf['notification_plugin'] == 'jira_plugin.JiraIssueTrackingPlugin':
+            conf['notification_data']['server'] = jira_server.jira_url
+
+# a single in-memory database for the whole suite, its schema is created only once
+test_db = PooledSqliteDatabase(':memory:', pragmas=[], threadlocals=False)
+for model_class in get_models():
+    model_class._meta.database = test_db
+test_db.create_tables(get_models())
 
 
 class TestCaseWithPeewee(unittest.TestCase):
     """
-    This abstract class is used to "inject" the test database so that the tests don't use the real sqlite db
+    This abstract class runs each test inside a transaction on the test database, that's rolled back when the test
+    finishes so that the next one starts with empty tables
     """
 
     __metaclass__ = ABCMeta
 
     def run(self, result=None):
-        model_classes = []
-        for module in [m for m in sys.modules if m.startswith('plugins') or m.startswith('business_logic')]:
-            model_classes += [m[1] for m in inspect.getmembers(sys.modules[module], inspect.isclass) if
-                              issubclass(m[1], peewee.Model) and m[1] != peewee.Model and m[1] not in model_classes]
-        with test_database(test_db, model_classes):
-            super(TestCaseWithPeewee, self).run(result)
+        with test_db.transaction() as transaction:
+            try:
+                super(TestCaseWithPeewee, self).run(result)
+            finally:
+                transaction.rollback()
 
 
 class TestCompanyCreation(TestCaseWithPeewee):
@@ -106,6 +136,41 @@ class TestCompanyCreation(TestCaseWithPeewee):
                           time_tracking_data=company_data['time_tracking_data'])
 
 
+class TestCompanyConfiguration(TestCaseWithPeewee):
+    def test_configuration_round_trip(self):
+        company_data = test_data['companies'][0]
+        company = Company(name=company_data['name'], notification_plugins=company_data['notification_plugins'],
+                          timezone=company_data['timezone'], time_tracking_plugin=company_data['time_tracking_plugin'],
+                          time_tracking_data=company_data['time_tracking_data'])
+        company.save()
+
+        # it's stored as versioned json, not as a pickle
+        self.assertFalse(is_legacy_config(company.time_tracking_data_str))
+
+        company = CompaniesMgr.get_company(company.id)
+        self.assertTrue(company.notification_plugins == company_data['notification_plugins'])
+        self.assertTrue(company.time_tracking_data == company_data['time_tracking_data'])
+
+        # the decoded value is memoized until the setter runs
+        self.assertTrue(company.notification_plugins is company.notification_plugins)
+        company.notification_plugins = []
+        self.assertTrue(company.notification_plugins == [])
+
+    def test_legacy_configuration_conversion(self):
+        company_data = test_data['companies'][0]
+        company = Company(name=company_data['name'], notification_plugins_str=pickle.dumps([]),
+                          timezone=company_data['timezone'], time_tracking_plugin=company_data['time_tracking_plugin'],
+                          time_tracking_data_str=pickle.dumps(company_data['time_tracking_data']))
+        company.save()
+
+        self.assertTrue(migrations.convert_company_configs() == 1)
+        self.assertTrue(migrations.convert_company_configs() == 0)
+
+        company = CompaniesMgr.get_company(company.id)
+        self.assertFalse(is_legacy_config(company.time_tracking_data_str))
+        self.assertTrue(company.time_tracking_data == company_data['time_tracking_data'])
+
+
 class TestTimeTrackingData(TestCaseWithPeewee):
     def setUp(self):
         self.company_data = \
@@ -140,9 +205,520 @@ class TestTimeTrackingData(TestCaseWithPeewee):
             # check that there's no one missing
             self.assertTrue(len(res) == 0)
 
+    def test_time_tracking_bulk_storage(self):
+        responses = self.company_data['time_tracking_data']['responses']
+        results_by_date = {}
+        for datet in responses:
+            results_by_date.setdefault(datet.date(), []).extend(responses[datet])
+
+        CompaniesMgr.update_tasks_bulk(self.company_id, results_by_date)
+
+        # Call it twice to see how it handles updates
+        CompaniesMgr.update_tasks_bulk(self.company_id, results_by_date)
+
+        company = CompaniesMgr.get_company(self.company_id)
+        for date in results_by_date:
+            res = get_aggregated_time_tracking_results(results_by_date[date])
+
+            for task in company.tasks.where(Task.date == date):
+                self.assertTrue(task.description in res)
+                self.assertTrue(task.time_spent_seconds == res[task.description])
+                del (res[task.description])
+
+            self.assertTrue(len(res) == 0)
+
+
+class TestAggregation(unittest.TestCase):
+    def test_streaming_aggregation(self):
+        def entries():
+            for i in range(1000):
+                yield {'date': datetime.date(2014, 1, 1 + i % 2), 'description': 'task %d' % (i % 3), 'seconds': 1}
+
+        aggregator = TimeTrackingAggregator().add_entries(entries())
+
+        self.assertTrue(aggregator.get_totals(datetime.date(2014, 1, 1)) ==
+                        {'task 0': 167, 'task 1': 166, 'task 2': 167})
+        self.assertTrue(sum(aggregator.get_totals(datetime.date(2014, 1, 2)).values()) == 500)
+        self.assertTrue(len(aggregator.get_results()[datetime.date(2014, 1, 2)]) == 3)
+
+    def test_intervals_are_split_at_local_midnights(self):
+        pacific = pytz.timezone('US/Pacific')
+        aggregator = TimeTrackingAggregator().add_intervals([
+            # 23:00 to 01:00 in Pacific time (naive datetimes are in UTC)
+            (datetime.datetime(2014, 1, 8, 7), datetime.datetime(2014, 1, 8, 9), 'DEV-1 coding'),
+            # the same, with aware datetimes and on another timezone
+            (pytz.timezone('Europe/Madrid').localize(datetime.datetime(2014, 1, 8, 8)),
+             pytz.timezone('Europe/Madrid').localize(datetime.datetime(2014, 1, 8, 10)), 'DEV-1 coding'),
+            # from saturday 23:00 to monday 01:00, across the 23 hours sunday DST starts
+            (pacific.localize(datetime.datetime(2014, 3, 8, 23)), pacific.localize(datetime.datetime(2014, 3, 10, 1)),
+             'standup'),
+            # timestamps, and an entry that ends before it starts
+            (1389168000, 1389168060, 'DEV-1 coding'),
+            (datetime.datetime(2014, 1, 8, 9), datetime.datetime(2014, 1, 8, 8), 'ignored'),
+        ], pacific)
+
+        self.assertTrue(aggregator.totals == {(datetime.date(2014, 1, 7), 'DEV-1 coding'): 7200,
+                                              (datetime.date(2014, 1, 8), 'DEV-1 coding'): 7260,
+                                              (datetime.date(2014, 3, 8), 'standup'): 3600,
+                                              (datetime.date(2014, 3, 9), 'standup'): 23 * 3600,
+                                              (datetime.date(2014, 3, 10), 'standup'): 3600})
+        self.assertTrue(TimeTrackingAggregator().add_intervals([], pacific).totals == {})
+
+
+class TestTaskVersions(TestCaseWithPeewee):
+    def test_only_changes_bump_the_version(self):
+        company = Company(name='Acme', notification_plugins=[], timezone='US/Pacific',
+                          time_tracking_plugin='test.TimeTrackingTestPlugin', time_tracking_data={})
+        company.save()
+        date = datetime.date(2014, 1, 1)
+
+        CompaniesMgr.update_tasks(company.id, date, [{'description': 'a', 'seconds': 10},
+                                                     {'description': 'b', 'seconds': 10}])
+        CompaniesMgr.update_tasks(company.id, date, [{'description': 'a', 'seconds': 10},
+                                                     {'description': 'b', 'seconds': 20}])
+        CompaniesMgr.update_tasks(company.id, date, [{'description': 'a', 'seconds': 10},
+                                                     {'description': 'b', 'seconds': 20}])
+
+        versions = dict((task.description, task.version) for task in company.tasks)
+        self.assertTrue(versions == {'a': 1, 'b': 2})
+
+    def test_unchanged_dates_are_skipped(self):
+        company = Company(name='Acme', notification_plugins=[], timezone='US/Pacific',
+                          time_tracking_plugin='test.TimeTrackingTestPlugin', time_tracking_data={})
+        company.save()
+        results = {datetime.date(2014, 1, 1): [{'description': 'a', 'seconds': 10}, {'description': 'b', 'seconds': 5},
+                                               {'description': 'b', 'seconds': 5}],
+                   datetime.date(2014, 1, 2): [{'description': u'caf\xe9', 'seconds': 10}]}
+        CompaniesMgr.update_tasks_bulk(company.id, results)
+        self.assertTrue(DailyDigest.select().where(DailyDigest.company == company.id).count() == 2)
+
+        # the same totals, in another order, only read the company, the digests and what the tasks add up to
+        stats.reset()
+        stats.enable()
+        try:
+            CompaniesMgr.update_tasks_bulk(company.id, {
+                datetime.date(2014, 1, 1): [{'description': 'b', 'seconds': 10}, {'description': 'a', 'seconds': 10}],
+                datetime.date(2014, 1, 2): [{'description': u'caf\xe9', 'seconds': 10}]})
+            self.assertTrue(stats.get_results()['db.query']['total']['count'] == 3)
+        finally:
+            stats.disable()
+            stats.reset()
+
+        # when a date changes only its changed tasks are written, and its digest is replaced
+        digest = DailyDigest.get((DailyDigest.company == company.id) & (DailyDigest.date == datetime.date(2014, 1, 1)))
+        CompaniesMgr.update_tasks(company.id, datetime.date(2014, 1, 1), [{'description': 'a', 'seconds': 10},
+                                                                         {'description': 'b', 'seconds': 20}])
+        versions = dict((task.description, task.version) for task in company.tasks)
+        self.assertTrue(versions == {'a': 1, 'b': 2, u'caf\xe9': 1})
+        self.assertTrue(DailyDigest.get(DailyDigest.id == digest.id).digest != digest.digest)
+        self.assertTrue(DailyDigest.select().where(DailyDigest.company == company.id).count() == 2)
+
+        # the tasks changed or removed by something else are written again, even if the results are the same
+        CompaniesMgr.update_tasks_bulk(company.id, results)
+        Task.update(time_spent_seconds=1).where(Task.description == 'a').execute()
+        Task.delete().where(Task.description == u'caf\xe9').execute()
+        CompaniesMgr.update_tasks_bulk(company.id, results)
+        self.assertTrue(sorted((task.description, task.time_spent_seconds) for task in company.tasks) ==
+                        [('a', 10), ('b', 10), (u'caf\xe9', 10)])
+
+
+class TestReports(TestCaseWithPeewee):
+    def setUp(self):
+        company = Company(name='Acme', notification_plugins=[{
+            'notification_plugin': 'jira_plugin.JiraIssueTrackingPlugin',
+            'notification_data': {'ticket_regexps': ['DEV-[0-9]+']}
+        }], timezone='US/Pacific', time_tracking_plugin='test.TimeTrackingTestPlugin', time_tracking_data={})
+        company.save()
+        self.company_id = company.id
+
+        # tuesday, wednesday, friday of the next week and saturday of the next month
+        for date, secs in [(datetime.date(2014, 1, 7), 100), (datetime.date(2014, 1, 8), 200),
+                           (datetime.date(2014, 1, 17), 400), (datetime.date(2014, 2, 1), 800)]:
+            CompaniesMgr.update_tasks(self.company_id, date, [{'description': 'DEV-1 coding', 'seconds': secs},
+                                                              {'description': 'standup', 'seconds': 10}])
+
+    def test_daily_totals_follow_the_tasks(self):
+        CompaniesMgr.update_tasks(self.company_id, datetime.date(2014, 1, 7),
+                                  [{'description': 'DEV-1 coding', 'seconds': 150},
+                                   {'description': 'DEV-2 review', 'seconds': 50}])
+
+        totals = dict(((t.date, t.issue_key), t.time_spent_seconds) for t in
+                      DailyTotal.select().where(DailyTotal.date == datetime.date(2014, 1, 7)))
+        self.assertTrue(totals == {(datetime.date(2014, 1, 7), 'DEV-1'): 150,
+                                   (datetime.date(2014, 1, 7), 'DEV-2'): 50,
+                                   (datetime.date(2014, 1, 7), ''): 10})
+
+        # rebuilding them from the tasks gives the same result
+        before = dict(((t.date, t.issue_key), t.time_spent_seconds) for t in DailyTotal.select())
+        CompaniesMgr.rebuild_daily_totals(self.company_id)
+        self.assertTrue(dict(((t.date, t.issue_key), t.time_spent_seconds) for t in DailyTotal.select()) == before)
+
+    def test_daily_totals_follow_the_regexps(self):
+        date = datetime.date(2014, 1, 8)
+        CompaniesMgr.update_tasks(self.company_id, date, [{'description': 'OPS-1 deploy', 'seconds': 100}])
+
+        company = Company.get(Company.id == self.company_id)
+        company.notification_plugins = [{'notification_plugin': 'jira_plugin.JiraIssueTrackingPlugin',
+                                         'notification_data': {'ticket_regexps': ['DEV-[0-9]+', 'OPS-[0-9]+']}}]
+        company.save()
+
+        # the task is moved to its issue, not only what it changed
+        CompaniesMgr.update_tasks(self.company_id, date, [{'description': 'OPS-1 deploy', 'seconds': 150}])
+        totals = dict((t.issue_key, t.time_spent_seconds) for t in DailyTotal.select().where(DailyTotal.date == date))
+        self.assertTrue(totals == {'DEV-1': 200, 'OPS-1': 150, '': 10})
+
+        # the reports pick the changes up without any update in between
+        company = Company.get(Company.id == self.company_id)
+        company.notification_plugins = [{'notification_plugin': 'jira_plugin.JiraIssueTrackingPlugin',
+                                         'notification_data': {'ticket_regexps': ['DEV-[0-9]+']}}]
+        company.save()
+        self.assertTrue(CompaniesMgr.get_report(self.company_id, date, date, 'issue').items() ==
+                        [(None, 160), ('DEV-1', 200)])
+
+    def test_reports(self):
+        start, end = datetime.date(2014, 1, 1), datetime.date(2014, 2, 28)
+
+        self.assertTrue(CompaniesMgr.get_report(self.company_id, start, end, 'day').items() == [
+            (datetime.date(2014, 1, 7), 110), (datetime.date(2014, 1, 8), 210), (datetime.date(2014, 1, 17), 410),
+            (datetime.date(2014, 2, 1), 810)])
+        self.assertTrue(CompaniesMgr.get_report(self.company_id, start, end, 'week').items() == [
+            (datetime.date(2014, 1, 6), 320), (datetime.date(2014, 1, 13), 410), (datetime.date(2014, 1, 27), 810)])
+        self.assertTrue(CompaniesMgr.get_report(self.company_id, start, end, 'month').items() == [
+            (datetime.date(2014, 1, 1), 730), (datetime.date(2014, 2, 1), 810)])
+        self.assertTrue(CompaniesMgr.get_report(self.company_id, start, datetime.date(2014, 1, 8), 'issue').items() ==
+                        [(None, 20), ('DEV-1', 300)])
+        self.assertRaises(InvalidReportGrouping, CompaniesMgr.get_report, self.company_id, start, end, 'year')
+
+
+class TestTasksImportExport(TestCaseWithPeewee):
+    def setUp(self):
+        self.companies = []
+        for name in [u'Acme', u'Caf\xe9']:
+            company = Company(name=name, notification_plugins=[], timezone='US/Pacific',
+                              time_tracking_plugin='test.TimeTrackingTestPlugin', time_tracking_data={})
+            company.save()
+            self.companies.append(company.id)
+
+    def get_tasks(self):
+        return sorted((t.company.id, t.date, t.description, t.time_spent_seconds) for t in Task.select())
+
+    def test_round_trip(self):
+        CompaniesMgr.update_tasks(self.companies[0], datetime.date(2014, 1, 7),
+                                  [{'description': u'DEV-1 coding, "quoted"', 'seconds': 100},
+                                   {'description': u'caf\xe9', 'seconds': 10}])
+        CompaniesMgr.update_tasks(self.companies[1], datetime.date(2014, 1, 8),
+                                  [{'description': 'standup', 'seconds': 20}])
+        tasks = self.get_tasks()
+
+        for fmt in ['csv', 'ndjson']:
+            out = StringIO()
+            self.assertTrue(export_tasks(out, fmt) == 3)
+
+            Task.delete().execute()
+            self.assertTrue(import_tasks(StringIO(out.getvalue()), fmt, batch_size=2) == 3)
+            self.assertTrue(self.get_tasks() == tasks)
+
+        # filtered by company and dates
+        out = StringIO()
+        self.assertTrue(export_tasks(out, 'ndjson', self.companies[0], datetime.date(2014, 1, 7),
+                                     datetime.date(2014, 1, 7)) == 2)
+        self.assertTrue(export_tasks(StringIO(), 'csv', end_date=datetime.date(2014, 1, 6)) == 0)
+
+    def test_import_uses_the_aggregation_rules(self):
+        CompaniesMgr.update_tasks(self.companies[0], datetime.date(2014, 1, 7),
+                                  [{'description': 'coding', 'seconds': 1000}])
+
+        # a TimeDoctor export, where a task has several entries
+        inp = StringIO('\n'.join(['start_time,task_name,length',
+                                   '2014-01-07 09:00:00,coding,100',
+                                   '2014-01-07 15:00:00,coding,50',
+                                   '2014-01-07 16:00:00,meeting,5',
+                                   '2014-01-08 09:00:00,review,30']) + '\n')
+        self.assertTrue(import_tasks(inp, 'csv', self.companies[0], batch_size=1) == 4)
+        self.assertTrue(self.get_tasks() == [(self.companies[0], datetime.date(2014, 1, 7), 'coding', 150),
+                                             (self.companies[0], datetime.date(2014, 1, 7), 'meeting', 5),
+                                             (self.companies[0], datetime.date(2014, 1, 8), 'review', 30)])
+        self.assertTrue(CompaniesMgr.get_report(self.companies[0], datetime.date(2014, 1, 1),
+                                                datetime.date(2014, 1, 31)).values() == [155, 30])
+
+        self.assertRaises(InvalidTaskFormat, import_tasks, StringIO('{"date": "2014-01-07", "seconds": 1}\n'),
+                          'ndjson', self.companies[0])
+        self.assertRaises(InvalidTaskFormat, import_tasks, StringIO('date,description,seconds\n'), 'xml')
+
+    def test_malformed_files(self):
+        for fmt, content, line in [
+                ('csv', 'date,description,seconds\n2014-01-07,coding,100\n2014-01-07,review\n', 2),
+                ('csv', 'date,description,seconds\n2014-01-07,caf\xe9,100\n', 1),
+                ('ndjson', '{"date": "2014-01-07", "description": "coding", "seconds": 100}\n\n{"date": \n', 2),
+                ('ndjson', '["2014-01-07", "coding", 100]\n', 1)]:
+            try:
+                import_tasks(StringIO(content), fmt, self.companies[0])
+                self.fail()
+            except InvalidTaskFormat as e:
+                self.assertTrue(str(e).startswith('Line %d: ' % line))
+        self.assertTrue(self.get_tasks() == [])
+
+    def test_import_writes_complete_dates(self):
+        CompaniesMgr.update_tasks(self.companies[0], datetime.date(2014, 1, 8),
+                                  [{'description': 'review', 'seconds': 1000}])
+        version = Task.select(fn.Max(Task.version)).scalar()
+        lines = ['date,description,seconds', '2014-01-07,coding,100', '2014-01-07,coding,50', '2014-01-08,review,30',
+                 '2014-01-08,review,20']
+
+        # the date with an invalid entry isn't written at all, the one before it is written complete
+        self.assertRaises(InvalidTaskFormat, import_tasks, StringIO('\n'.join(lines[:-1] + ['2014-01-08,review,x'])),
+                          'csv', self.companies[0], batch_size=1)
+        self.assertTrue(self.get_tasks() == [(self.companies[0], datetime.date(2014, 1, 7), 'coding', 150),
+                                             (self.companies[0], datetime.date(2014, 1, 8), 'review', 1000)])
+
+        # nor is the date being read when the entries go back to one that was already written
+        self.assertRaises(InvalidTaskFormat, import_tasks, StringIO('\n'.join(lines + ['2014-01-07,coding,1'])),
+                          'csv', self.companies[0], batch_size=1)
+        self.assertTrue(self.get_tasks()[1][3] == 1000)
+
+        # the tasks imported aren't pushed, unless it's asked for
+        self.assertTrue(import_tasks(StringIO('\n'.join(lines)), 'csv', self.companies[0]) == 4)
+        self.assertTrue(self.get_tasks()[1][3] == 50)
+        self.assertTrue(CompaniesMgr.get_pending_tasks(self.companies[0], version).count() == 0)
+        self.assertTrue(import_tasks(StringIO('\n'.join(lines[:-1])), 'csv', self.companies[0], notify=True) == 3)
+        self.assertTrue([t.description for t in CompaniesMgr.get_pending_tasks(self.companies[0], version)] ==
+                        ['review'])
+
+    def test_update_tasks_from_intervals(self):
+        # the company is on US/Pacific, so 2014-01-08 06:00 UTC is still the 7th there
+        CompaniesMgr.update_tasks_from_intervals(self.companies[0], [
+            (datetime.datetime(2014, 1, 8, 6), datetime.datetime(2014, 1, 8, 9), 'coding'),
+            (datetime.datetime(2014, 1, 8, 20), datetime.datetime(2014, 1, 8, 21), 'coding')])
+
+        self.assertTrue(self.get_tasks() == [(self.companies[0], datetime.date(2014, 1, 7), 'coding', 7200),
+                                             (self.companies[0], datetime.date(2014, 1, 8), 'coding', 2 * 3600)])
+
+
+class TestSync(TestCaseWithPeewee):
+    def test_sync_companies(self):
+        company_data = test_data['companies'][0]
+        company_ids = []
+        for time_tracking_plugin in ['test.TimeTrackingTestPlugin', 'invalid.Plugin']:
+            company = Company(name=company_data['name'], notification_plugins=[], timezone=company_data['timezone'],
+                              time_tracking_plugin=time_tracking_plugin,
+                              time_tracking_data=company_data['time_tracking_data'])
+            company.save()
+            company_ids.append(company.id)
+
+        results = CompaniesMgr.sync_companies(since=datetime.date(2014, 1, 1), workers=1)
+
+        # the failure of the second company is reported, but it doesn't affect the first one
+        self.assertTrue([res['company_id'] for res in results] == company_ids)
+        self.assertTrue(results[0]['error'] is None and results[1]['error'] is not None)
+        self.assertTrue(results[0]['timings'].keys() == ['fetch', 'update_tasks', 'notifications'])
+
+        # the last snapshot of each day is the one stored
+        responses = company_data['time_tracking_data']['responses']
+        for datet in [datetime.datetime(2014, 1, 1, 17, 0, 0), datetime.datetime(2014, 1, 2, 10, 30, 0)]:
+            res = get_aggregated_time_tracking_results(responses[datet])
+            tasks = CompaniesMgr.get_company(company_ids[0]).tasks.where(Task.date == datet.date())
+            self.assertTrue(dict((task.description, task.time_spent_seconds) for task in tasks) == res)
+
+
+    def test_incremental_sync(self):
+        company_data = test_data['companies'][0]
+        company = Company(name=company_data['name'], notification_plugins=[], timezone=company_data['timezone'],
+                          time_tracking_plugin=company_data['time_tracking_plugin'],
+                          time_tracking_data=company_data['time_tracking_data'])
+        company.save()
+
+        CompaniesMgr.sync_company(company.id)
+        self.assertTrue(CompaniesMgr.get_watermark(company.id).cursor == '2014-01-02T10:30:00')
+        updated_at = dict((task.id, task.updated_at) for task in company.tasks)
+        self.assertTrue(len(updated_at) == 7)
+
+        # nothing changed after the watermark, so nothing is written
+        CompaniesMgr.sync_company(company.id)
+        self.assertTrue(dict((task.id, task.updated_at) for task in company.tasks) == updated_at)
+        self.assertTrue(CompaniesMgr.get_watermark(company.id).cursor == '2014-01-02T10:30:00')
+
+
+class TestInstrumentation(TestCaseWithPeewee):
+    def setUp(self):
+        stats.reset()
+        stats.enable()
+
+    def tearDown(self):
+        stats.disable()
+        stats.reset()
+
+    def test_sync_stats(self):
+        company_data = test_data['companies'][0]
+        company = Company(name=company_data['name'], notification_plugins=[], timezone=company_data['timezone'],
+                          time_tracking_plugin=company_data['time_tracking_plugin'],
+                          time_tracking_data=company_data['time_tracking_data'])
+        company.save()
+
+        CompaniesMgr.sync_company(company.id)
+
+        results = stats.get_results()
+        for metric in ['db.query', 'plugins.get_object', 'time_tracking.fetch']:
+            self.assertTrue(results[metric]['companies'][company.id]['count'] > 0)
+        self.assertTrue(results['time_tracking.fetch']['total']['count'] == 1)
+
+        # nothing is recorded when it's off
+        stats.disable()
+        CompaniesMgr.sync_company(company.id)
+        self.assertTrue(stats.get_results()['time_tracking.fetch']['total']['count'] == 1)
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for ms in [0.5] * 90 + [30] * 9 + [20000]:
+            histogram.add(ms / 1000.0)
+
+        self.assertTrue(histogram.count == 100)
+        self.assertTrue(histogram.percentile(50) == 0.001)
+        self.assertTrue(histogram.percentile(95) == 0.05)
+        self.assertTrue(histogram.percentile(100) == 20)
+
+
+class TestScheduler(TestCaseWithPeewee):
+    def test_next_local_time(self):
+        pacific = pytz.timezone('US/Pacific')
+
+        # 18:00 in the pacific is 02:00 UTC in winter and 01:00 UTC in summer
+        self.assertTrue(next_local_time(pacific, datetime.datetime(2014, 1, 10, 12), 18) ==
+                        datetime.datetime(2014, 1, 11, 2))
+        self.assertTrue(next_local_time(pacific, datetime.datetime(2014, 7, 10, 12), 18) ==
+                        datetime.datetime(2014, 7, 11, 1))
+        # the day the clocks go forward 02:30 doesn't exist, it happens at 03:30 (PDT)
+        self.assertTrue(next_local_time(pacific, datetime.datetime(2014, 3, 9, 8), 2, 30) ==
+                        datetime.datetime(2014, 3, 9, 10, 30))
+        # the day they go back 01:30 happens twice (PDT and then PST), the second one is next once the first is past
+        self.assertTrue(next_local_time(pacific, datetime.datetime(2014, 11, 2, 7), 1, 30) ==
+                        datetime.datetime(2014, 11, 2, 8, 30))
+        self.assertTrue(next_local_time(pacific, datetime.datetime(2014, 11, 2, 8, 30), 1, 30) ==
+                        datetime.datetime(2014, 11, 2, 9, 30))
+        self.assertTrue(next_local_time(pacific, datetime.datetime(2014, 11, 2, 9, 30), 1, 30) ==
+                        datetime.datetime(2014, 11, 3, 9, 30))
+        # 09:05 UTC is 01:05 PST, on the repeated hour, so the next quarter is 10 minutes away
+        self.assertTrue(next_interval_time(pacific, datetime.datetime(2014, 11, 2, 9, 5), 15) ==
+                        datetime.datetime(2014, 11, 2, 9, 15))
+        self.assertTrue(next_interval_time(pacific, datetime.datetime(2014, 11, 2, 8, 5), 15) ==
+                        datetime.datetime(2014, 11, 2, 8, 15))
+        # 01:50 PDT is followed by 01:00 PST, and 01:50 PST by 02:00 PST
+        self.assertTrue(next_interval_time(pacific, datetime.datetime(2014, 11, 2, 8, 50), 15) ==
+                        datetime.datetime(2014, 11, 2, 9))
+        self.assertTrue(next_interval_time(pacific, datetime.datetime(2014, 11, 2, 9, 50), 15) ==
+                        datetime.datetime(2014, 11, 2, 10))
+        # 01:50 PST is followed by 03:00 PDT when they go forward
+        self.assertTrue(next_interval_time(pacific, datetime.datetime(2014, 3, 9, 9, 50), 15) ==
+                        datetime.datetime(2014, 3, 9, 10))
+        self.assertTrue(next_interval_time(pacific, datetime.datetime(2014, 1, 1, 7, 50), 15) ==
+                        datetime.datetime(2014, 1, 1, 8))
+
+        # half hour timezones are due on their own quarters
+        kolkata = pytz.timezone('Asia/Kolkata')
+        self.assertTrue(next_interval_time(kolkata, datetime.datetime(2014, 1, 1, 10, 20), 60) ==
+                        datetime.datetime(2014, 1, 1, 10, 30))
+        self.assertTrue(next_interval_time(kolkata, datetime.datetime(2014, 1, 1, 18, 20), 60) ==
+                        datetime.datetime(2014, 1, 1, 18, 30))
+
+    def test_due_queue(self):
+        now = [datetime.datetime(2014, 1, 1, 10, 5)]
+        synced = []
+
+        def sync(company_ids):
+            synced.append(sorted(company_ids))
+            return [{'company_id': company_id, 'error': None} for company_id in company_ids]
+
+        def create_company(name, timezone, notification_plugins=None):
+            company = Company(name=name, notification_plugins=notification_plugins or [], timezone=timezone,
+                              time_tracking_plugin='test.TimeTrackingTestPlugin', time_tracking_data={})
+            company.save()
+            return company
+
+        utc = create_company('UTC', 'UTC')
+        kolkata = create_company('Kolkata', 'Asia/Kolkata')
+        scheduler = Scheduler(interval=60, refresh_interval=300, sync=sync, clock=lambda: now[0])
+
+        self.assertTrue(scheduler.run_once() == [])
+        # 10:30 UTC is 16:00 in Kolkata
+        self.assertTrue(scheduler.get_next_wake_time() == datetime.datetime(2014, 1, 1, 10, 10))
+
+        now[0] = datetime.datetime(2014, 1, 1, 10, 30)
+        scheduler.run_once()
+        self.assertTrue(synced == [[kolkata.id]])
+
+        # a new company and a change of timezone are picked up on the next refresh
+        digest = create_company('Digest', 'UTC', [{
+            'notification_plugin': 'email_plugin.EmailDigestPlugin',
+            'notification_data': {'host': '127.0.0.1', 'sender': 'horas@example.com', 'recipients': ['a@example.com'],
+                                  'send_at_hour': 10}}])
+        utc.timezone = 'America/Montevideo'
+        utc.save()
+        now[0] = datetime.datetime(2014, 1, 1, 10, 40)
+        scheduler.run_once()
+        # the digest is due at 10:00 UTC tomorrow, but it's synced every hour before that
+        self.assertTrue(scheduler.get_next_wake_time() == datetime.datetime(2014, 1, 1, 10, 45))
+
+        now[0] = datetime.datetime(2014, 1, 1, 11, 0)
+        scheduler.run_once()
+        self.assertTrue(synced[-1] == sorted([utc.id, digest.id]))
+
+        now[0] = datetime.datetime(2014, 1, 1, 11, 30)
+        scheduler.run_once()
+        self.assertTrue(synced[-1] == [kolkata.id])
+
+        # companies removed aren't synced anymore
+        kolkata.delete_instance()
+        now[0] = datetime.datetime(2014, 1, 1, 12, 0)
+        scheduler.run_once()
+        self.assertTrue(synced[-1] == sorted([utc.id, digest.id]))
+        now[0] = datetime.datetime(2014, 1, 1, 12, 30)
+        self.assertTrue(scheduler.run_once() == [])
+
+
+class TestTimeDoctor(TestCaseWithPeewee):
+    def setUp(self):
+        def worklog(task_name, project_name, start_time, length):
+            return {'task_name': task_name, 'project_name': project_name, 'start_time': start_time,
+                    'length': str(length)}
+
+        self.server = TimeDoctorStubServer().start()
+        self.server.add_account('me', 'secret', 10, [
+            worklog('DEV-1 fixing it', 'Acme', '2014-01-01 10:00:00', 600),
+            worklog('DEV-1 fixing it', 'Acme', '2014-01-01 11:00:00', 300),
+            worklog('personal stuff', 'Personal', '2014-01-01 12:00:00', 1000),
+            worklog('DEV-1 fixing it', 'Acme', '2014-01-02 10:00:00', 120),
+            worklog('too old', 'Acme', '2013-12-31 10:00:00', 120)])
+        self.server.add_account('client', 'pass', 20, [
+            worklog('standup call', 'Whatever', '2014-01-01 09:00:00', 900)])
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_worklogs(self):
+        plugin = PluginsManager.get_time_tracking_plugin('timedoctor.TimeDoctorPlugin', base_url=self.server.url,
+                                                         page_size=2, accounts=[
+            {'username': 'me', 'password': 'secret', 'client_id': 'id', 'client_secret': 'secret',
+             'projects': ['Acme']},
+            {'username': 'client', 'password': 'pass', 'client_id': 'id', 'client_secret': 'secret'}])
+        company = Company(name='Acme', notification_plugins=[], timezone='US/Pacific',
+                          time_tracking_plugin='timedoctor.TimeDoctorPlugin', time_tracking_data={})
+
+        res = plugin.get_time_tracking_results(company, datetime.date(2014, 1, 1))
+
+        self.assertTrue(sorted(res.keys()) == [datetime.date(2014, 1, 1), datetime.date(2014, 1, 2)])
+        self.assertTrue(get_aggregated_time_tracking_results(res[datetime.date(2014, 1, 1)]) ==
+                        {'DEV-1 fixing it': 900, 'standup call': 900})
+        self.assertTrue(res[datetime.date(2014, 1, 2)] == [{'description': 'DEV-1 fixing it', 'seconds': 120}])
+
+        # the worklogs are paginated, and each account authenticates only once
+        worklog_pages = [r for r in self.server.requests if r[1].endswith('/worklogs')]
+        self.assertTrue([r[2]['offset'] for r in worklog_pages] == ['1', '3', '1'])
+        self.assertTrue(len([r for r in self.server.requests if r[1] == '/oauth/v2/token']) == 2)
+
 
 class TestJiraIssueTracking(TestCaseWithPeewee):
     def setUp(self):
+        jira_server.reset(['DEV-1234', 'DEV-1532', 'TEST-1'])
+
         self.company_data = \
             [c for c in test_data['companies'] if c['time_tracking_plugin'] == 'test.TimeTrackingTestPlugin' and any(
                 item['notification_plugin'] == 'jira_plugin.JiraIssueTrackingPlugin' for item in
@@ -171,21 +747,12 @@ class TestJiraIssueTracking(TestCaseWithPeewee):
             jira = JIRA(jira_plugin_conf['server'],
                         basic_auth=(jira_plugin_conf['username'], jira_plugin_conf['password']))
 
+            matches = TicketMatcher(jira_plugin_conf['ticket_regexps']).match_all(res)
             for key in res:
-                current_best_position = len(key)
-                current_match = None
-                for regexp in jira_plugin_conf['ticket_regexps']:
-                    match = re.search('\\b(' + regexp + ')\\b', key)
-                    if match is not None and match.start(1) < current_best_position:
-                        current_best_position = match.start(1)
-                        current_match = match.group(1)
-
-                if current_match is not None:
+                if key in matches:
                     # found a ticket!
-                    description = key
+                    current_match, description = matches[key]
                     success = False
-                    if current_best_position == 0:
-                        description = re.sub('^[^a-zA-Z0-9\\(]*', '', key[len(current_match):])
 
                     issue = None
                     try:
@@ -211,14 +778,541 @@ class TestJiraIssueTracking(TestCaseWithPeewee):
         pass
 
 
-def get_aggregated_time_tracking_results(results):
-    # element to group by
-    grouping_fn = lambda x: x['description']
+class TestJiraOutbox(TestCaseWithPeewee):
+    def setUp(self):
+        jira_server.reset(['DEV-1', 'DEV-2'])
+        self.plugin = JiraIssueTrackingPlugin(jira_server.jira_url, 'admin', 'admin', ['DEV-[0-9]+'], max_retries=0,
+                                              max_attempts=3, retry_backoff=60)
+        self.company = Company(name='Acme', notification_plugins=[], timezone='US/Pacific',
+                               time_tracking_plugin='test.TimeTrackingTestPlugin', time_tracking_data={})
+        self.company.save()
+        self.date = datetime.date(2014, 1, 1)
+
+    def tearDown(self):
+        self.plugin.close()
+
+    def update_tasks(self, dev_2_seconds):
+        CompaniesMgr.update_tasks(self.company.id, self.date, [
+            {'description': 'DEV-1 coding', 'seconds': 600},
+            {'description': 'DEV-2 review', 'seconds': dev_2_seconds},
+            {'description': 'DEV-3 missing issue', 'seconds': 60},
+            {'description': 'standup', 'seconds': 300}])
+
+    def test_failed_pushes_are_retried_and_parked(self):
+        # every worklog pushed to DEV-2 fails
+        jira_server.fail('POST', '/issue/%s/worklog$' % jira_server.find_issue('DEV-2')['id'], 500)
+        self.update_tasks(1200)
+
+        # the failure doesn't affect the other tasks, and the task without an issue is dropped
+        self.plugin.execute_if_it_has_to(self.company)
+        self.assertTrue(len(jira_server.get_worklogs('DEV-1')) == 1)
+        item = JiraOutboxItem.get()
+        self.assertTrue(item.task.description == 'DEV-2 review' and item.attempts == 1 and not item.parked)
+        self.assertTrue('500' in item.last_error)
+        self.assertTrue(item.next_attempt_at > datetime.datetime.utcnow() + datetime.timedelta(seconds=59))
+
+        # it's not attempted again until it's due
+        requests = len(jira_server.requests)
+        self.plugin.execute_if_it_has_to(self.company)
+        self.assertTrue(len(jira_server.requests) == requests)
+
+        # it's parked after the third failed attempt, and left alone after that
+        later = [datetime.datetime.utcnow() + datetime.timedelta(days=days) for days in [1, 2, 3]]
+        self.assertTrue(self.plugin.drain_outbox(self.company, later[0]) == 1)
+        self.assertTrue(self.plugin.drain_outbox(self.company, later[1]) == 1)
+        self.assertTrue(JiraOutboxItem.get().parked)
+        requests = len(jira_server.requests)
+        self.assertTrue(self.plugin.drain_outbox(self.company, later[2]) == 0)
+        self.assertTrue(len(jira_server.requests) == requests)
+
+        # once jira works again, a change on the task gives it another chance
+        jira_server.failures = []
+        self.update_tasks(1500)
+        self.plugin.execute_if_it_has_to(self.company)
+        self.assertTrue(JiraOutboxItem.select().count() == 0)
+        self.assertTrue([w['timeSpentSeconds'] for w in jira_server.get_worklogs('DEV-2')] == [1500])
+
+    def test_issue_lookup_failures_are_retried(self):
+        jira_server.fail('GET', '/search$', 503)
+        jira_server.fail('GET', '/issue/DEV-2$', 503)
+        self.update_tasks(1200)
+
+        self.plugin.execute_if_it_has_to(self.company)
+        self.assertTrue(len(jira_server.get_worklogs('DEV-1')) == 1)
+        self.assertTrue([item.task.description for item in JiraOutboxItem.select()] == ['DEV-2 review'])
+
+        jira_server.failures = []
+        self.plugin.drain_outbox(self.company, datetime.datetime.utcnow() + datetime.timedelta(days=1))
+        self.assertTrue(JiraOutboxItem.select().count() == 0)
+        self.assertTrue(len(jira_server.get_worklogs('DEV-2')) == 1)
+
+    def test_unreachable_jira_is_retried(self):
+        self.update_tasks(1200)
+        # nothing listens on the port the plugin sends the requests to
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        server = self.plugin.jira._options['server']
+        self.plugin.jira._options['server'] = 'http://127.0.0.1:%d' % closed.getsockname()[1]
+        closed.close()
+
+        # even the issue that doesn't exist can't be told apart from the rest until jira answers
+        self.plugin.enqueue_pending_tasks(self.company)
+        self.assertTrue(self.plugin.drain_outbox(self.company) == 3)
+        items = list(JiraOutboxItem.select().order_by(JiraOutboxItem.id))
+        self.assertTrue(sorted(item.task.description for item in items) == ['DEV-1 coding', 'DEV-2 review',
+                                                                             'DEV-3 missing issue'])
+        for item in items:
+            self.assertTrue(item.attempts == 1 and not item.parked and 'ConnectionError' in item.last_error)
+            self.assertTrue(item.next_attempt_at > datetime.datetime.utcnow() + datetime.timedelta(seconds=59))
+
+        self.plugin.jira._options['server'] = server
+        self.plugin.drain_outbox(self.company, datetime.datetime.utcnow() + datetime.timedelta(days=1))
+        self.assertTrue(JiraOutboxItem.select().count() == 0)
+        self.assertTrue(len(jira_server.get_worklogs('DEV-1')) == 1 and len(jira_server.get_worklogs('DEV-2')) == 1)
+
+    def get_worklog_requests(self, key):
+        issue_id = jira_server.find_issue(key)['id']
+        return [(method, path) for method, path, params in jira_server.requests if
+                '/issue/%s/worklog' % issue_id in path]
+
+    def test_known_worklogs_are_updated_directly(self):
+        self.update_tasks(1200)
+        self.plugin.execute_if_it_has_to(self.company)
+        worklog_id = jira_server.get_worklogs('DEV-2')[0]['id']
+        self.assertTrue(JiraTaskUpdated.get(JiraTaskUpdated.worklog_id == worklog_id).task.description ==
+                        'DEV-2 review')
+
+        # the worklog is updated with a single request, without listing the worklogs of the issue
+        del jira_server.requests[:]
+        self.update_tasks(1500)
+        self.plugin.execute_if_it_has_to(self.company)
+        self.assertTrue(self.get_worklog_requests('DEV-2') == [
+            ('PUT', '/jira/rest/api/2/issue/%s/worklog/%s' % (jira_server.find_issue('DEV-2')['id'], worklog_id))])
+        self.assertTrue([w['timeSpentSeconds'] for w in jira_server.get_worklogs('DEV-2')] == [1500])
+
+    def test_deleted_worklogs_are_created_again(self):
+        self.update_tasks(1200)
+        self.plugin.execute_if_it_has_to(self.company)
+        old_worklog_id = jira_server.get_worklogs('DEV-2')[0]['id']
+
+        # someone deleted it on jira, so the update gets a 404 and it's looked for (and created) again
+        del jira_server.get_worklogs('DEV-2')[:]
+        del jira_server.requests[:]
+        self.update_tasks(1500)
+        self.plugin.execute_if_it_has_to(self.company)
+
+        issue_path = '/jira/rest/api/2/issue/%s/worklog' % jira_server.find_issue('DEV-2')['id']
+        self.assertTrue(self.get_worklog_requests('DEV-2') == [('PUT', '%s/%s' % (issue_path, old_worklog_id)),
+                                                               ('GET', issue_path), ('POST', issue_path)])
+        worklogs = jira_server.get_worklogs('DEV-2')
+        self.assertTrue(len(worklogs) == 1 and worklogs[0]['timeSpentSeconds'] == 1500)
+        self.assertTrue(worklogs[0]['id'] != old_worklog_id)
+        task_updated = JiraTaskUpdated.select().join(Task).where(Task.description == 'DEV-2 review').get()
+        self.assertTrue(task_updated.worklog_id == worklogs[0]['id'])
+        self.assertTrue(JiraOutboxItem.select().count() == 0)
+
+    def test_concurrent_pushes(self):
+        plugin = JiraIssueTrackingPlugin(jira_server.jira_url, 'admin', 'admin', ['DEV-[0-9]+'], concurrency=4,
+                                         max_retries=0)
+        for key in ['DEV-3', 'DEV-4']:
+            jira_server.add_issue(key)
+        issue_ids = dict((key, jira_server.find_issue(key)['id']) for key in ['DEV-1', 'DEV-2', 'DEV-3', 'DEV-4'])
+        # the first issues are the slowest, so their pushes finish last, and the ones to DEV-2 fail
+        jira_server.delay('POST', '/issue/%s/worklog$' % issue_ids['DEV-1'], 0.3)
+        jira_server.delay('POST', '/issue/%s/worklog$' % issue_ids['DEV-2'], 0.2)
+        jira_server.fail('POST', '/issue/%s/worklog$' % issue_ids['DEV-2'], 500)
+
+        CompaniesMgr.update_tasks(self.company.id, self.date, [{'description': 'DEV-1 coding', 'seconds': 600},
+                                                               {'description': 'DEV-1 review', 'seconds': 60},
+                                                               {'description': 'DEV-2 review', 'seconds': 1200},
+                                                               {'description': 'DEV-3 testing', 'seconds': 300},
+                                                               {'description': 'DEV-4 deploy', 'seconds': 120}])
+        try:
+            self.assertTrue(plugin.enqueue_pending_tasks(self.company) == 5)
+            self.assertTrue(plugin.drain_outbox(self.company) == 1)
+        finally:
+            plugin.close()
+
+        # the worklogs pushed on the same issue don't step on each other
+        self.assertTrue(sorted((w['comment'], w['timeSpentSeconds']) for w in jira_server.get_worklogs('DEV-1')) ==
+                        [('coding', 600), ('review', 60)])
+        self.assertTrue([w['timeSpentSeconds'] for w in jira_server.get_worklogs('DEV-3')] == [300])
+        self.assertTrue([w['timeSpentSeconds'] for w in jira_server.get_worklogs('DEV-4')] == [120])
+        self.assertTrue(jira_server.get_worklogs('DEV-2') == [])
+
+        # each task pushed is recorded with its own worklog, whatever order they finished in
+        worklogs = dict((w['id'], (key, w['comment'])) for key in ['DEV-1', 'DEV-3', 'DEV-4'] for w in
+                        jira_server.get_worklogs(key))
+        updated = dict((t.task.description, (t.issue_id, worklogs[t.worklog_id])) for t in JiraTaskUpdated.select())
+        self.assertTrue(updated == {'DEV-1 coding': (issue_ids['DEV-1'], ('DEV-1', 'coding')),
+                                    'DEV-1 review': (issue_ids['DEV-1'], ('DEV-1', 'review')),
+                                    'DEV-3 testing': (issue_ids['DEV-3'], ('DEV-3', 'testing')),
+                                    'DEV-4 deploy': (issue_ids['DEV-4'], ('DEV-4', 'deploy'))})
+
+        # only the failed push is left on the outbox, waiting to be attempted again
+        items = list(JiraOutboxItem.select())
+        self.assertTrue(len(items) == 1 and items[0].task.description == 'DEV-2 review')
+        self.assertTrue(items[0].attempts == 1 and not items[0].parked and '500' in items[0].last_error)
+
+
+class TestEmailDigest(TestCaseWithPeewee):
+    def setUp(self):
+        self.smtp_server = SmtpStubServer().start()
+        PluginsManager.reset_pool()
+
+    def tearDown(self):
+        PluginsManager.reset_pool()
+        self.smtp_server.stop()
+
+    def create_company(self, name, timezone, send_at_hour, recipients=None):
+        company = Company(name=name, timezone=timezone, time_tracking_plugin='test.TimeTrackingTestPlugin',
+                          time_tracking_data={}, notification_plugins=[{
+                              'notification_plugin': 'email_plugin.EmailDigestPlugin',
+                              'notification_data': {'host': '127.0.0.1', 'port': self.smtp_server.port,
+                                                    'sender': 'horas@example.com',
+                                                    'recipients': recipients or ['boss@example.com'],
+                                                    'send_at_hour': send_at_hour}
+                          }])
+        company.save()
+        return company
+
+    def test_due_dates(self):
+        company = self.create_company('Acme', 'America/Montevideo', 18)
+        plugin = EmailDigestPlugin(**company.notification_plugins[0]['notification_data'])
+
+        # 20:00 UTC is 17:00 in Montevideo (UTC-3 in july), 21:00 UTC is 18:00
+        self.assertTrue(plugin.get_due_dates(company, datetime.datetime(2014, 7, 1, 20, 0)) == [])
+        self.assertTrue(plugin.get_due_dates(company, datetime.datetime(2014, 7, 1, 21, 0)) ==
+                        [datetime.date(2014, 7, 1)])
+        # 02:00 UTC is still the previous day there
+        self.assertTrue(plugin.get_due_dates(company, datetime.datetime(2014, 7, 2, 2, 0)) ==
+                        [datetime.date(2014, 7, 1)])
+
+        plugin.send_digest(company, datetime.date(2014, 7, 1))
+        self.assertTrue(plugin.get_due_dates(company, datetime.datetime(2014, 7, 1, 22, 0)) == [])
+        self.assertTrue(plugin.get_due_dates(company, datetime.datetime(2014, 7, 2, 21, 0)) ==
+                        [datetime.date(2014, 7, 2)])
+
+        # the days missed while it wasn't running are sent too, the current one once it's time to
+        self.assertTrue(plugin.get_due_dates(company, datetime.datetime(2014, 7, 4, 20, 0)) ==
+                        [datetime.date(2014, 7, 2), datetime.date(2014, 7, 3)])
+        self.assertTrue(plugin.get_due_dates(company, datetime.datetime(2014, 7, 4, 21, 0)) ==
+                        [datetime.date(2014, 7, 2), datetime.date(2014, 7, 3), datetime.date(2014, 7, 4)])
+        plugin.close()
+
+    def test_missed_days_are_sent(self):
+        company = self.create_company('Acme', 'UTC', 0)
+        plugin = PluginsManager.get_notification_plugin(company.notification_plugins[0]['notification_plugin'],
+                                                        **company.notification_plugins[0]['notification_data'])
+        today = datetime.datetime.utcnow().date()
+        plugin.send_digest(company, today - datetime.timedelta(days=3))
+
+        CompaniesMgr.trigger_notifications(company.id)
+        CompaniesMgr.trigger_notifications(company.id)
+        PluginsManager.reset_pool()
+
+        self.assertTrue([message['Subject'] for message in self.smtp_server.messages] == [
+            'Time report for %s' % (today - datetime.timedelta(days=days)).isoformat() for days in [3, 2, 1, 0]])
+
+    def test_digests_share_the_connection(self):
+        # each company has its own recipients, so each one gets its own plugin instance from the pool
+        companies = [self.create_company('Company %d' % i, 'UTC', 0, ['boss%d@example.com' % i]) for i in range(3)]
+        today = datetime.datetime.utcnow().date()
+        CompaniesMgr.update_tasks(companies[0].id, today, [{'description': 'DEV-1 coding', 'seconds': 5400},
+                                                           {'description': 'standup', 'seconds': 900}])
+
+        for company in companies:
+            CompaniesMgr.trigger_notifications(company.id)
+        # it was already sent today
+        CompaniesMgr.trigger_notifications(companies[0].id)
+        PluginsManager.reset_pool()
+
+        self.assertTrue(len(self.smtp_server.messages) == 3)
+        self.assertTrue(self.smtp_server.connections == 1)
+
+        message = self.smtp_server.messages[0]
+        self.assertTrue(message['Subject'] == 'Time report for %s' % today.isoformat())
+        self.assertTrue(message.rcpttos == ['boss0@example.com'])
+        body = message.get_payload(decode=True)
+        self.assertTrue('  1:30  DEV-1 coding\n  0:15  standup\n' in body)
+        self.assertTrue('  1:45  Total' in body)
+        self.assertTrue('No time tracked' in self.smtp_server.messages[1].get_payload(decode=True))
+
+    def test_connections_are_shared_per_password(self):
+        key = get_connection_key('127.0.0.1', 25, 'horas', 'secret', True)
+        self.assertTrue(get_connection_key('127.0.0.1', 25, 'horas', u'secret', True) == key)
+        self.assertTrue(get_connection_key('127.0.0.1', 25, 'horas', 'old secret', True) != key)
+        self.assertTrue('secret' not in key)
+
+
+class TestTicketMatcher(unittest.TestCase):
+    def test_ticket_matching(self):
+        matcher = TicketMatcher(['TEST-[0-9]+', 'DEV-[0-9]+'])
+        descriptions = ['standup call',
+                        'DEV-1234 trying to understand the bug',
+                        'TEST-1: checking mailchimp\'s api',
+                        'rewriting the commit_to_jira function (as defined at DEV-1532), also affects TEST-1534',
+                        'MYDEV-12 is not a ticket']
+
+        matches = matcher.match_all(descriptions)
+
+        self.assertTrue(len(matches) == 3)
+        self.assertTrue(matches['DEV-1234 trying to understand the bug'] ==
+                        ('DEV-1234', 'trying to understand the bug'))
+        self.assertTrue(matches['TEST-1: checking mailchimp\'s api'] == ('TEST-1', 'checking mailchimp\'s api'))
+        # the leftmost key wins, and the description is kept when it doesn't start with it
+        self.assertTrue(matches[descriptions[3]] == ('DEV-1532', descriptions[3]))
+
 
-    # sort the elements (groupby needs them sorted)
-    elements = sorted(results, key=grouping_fn)
-    groups = itertools.groupby(elements, grouping_fn)
-    return dict([(r[0], sum([item['seconds'] for item in r[1]])) for r in groups])
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.database = PooledSqliteDatabase(self.path, pragmas=[], pool_size=0)
+
+    def tearDown(self):
+        self.database.close()
+        os.remove(self.path)
+
+    def test_duplicated_tasks_are_removed(self):
+        with test_database(self.database, get_models()):
+            # a database from before the unique index, where the same task was stored more than once
+            self.database.execute_sql('DROP INDEX "%s"' % migrations.get_index_name(
+                Task, ['company', 'date', 'description']))
+            company = Company(name='Acme', notification_plugins=[{
+                'notification_plugin': 'jira_plugin.JiraIssueTrackingPlugin',
+                'notification_data': {'ticket_regexps': ['DEV-[0-9]+']}
+            }], timezone='US/Pacific', time_tracking_plugin='test.TimeTrackingTestPlugin', time_tracking_data={})
+            company.save()
+            date = datetime.date(2014, 1, 1)
+            # update_tasks kept updating the first one of them, the rest kept their old values
+            updated_at = datetime.datetime(2014, 1, 2)
+            for description, seconds, days in [('DEV-1 coding', 900, 1), ('standup', 10, 0), ('DEV-1 coding', 100, 0),
+                                               ('DEV-1 coding', 200, 0), ('standup', 20, 0)]:
+                task = Task.create(company=company, date=date, description=description, time_spent_seconds=seconds,
+                                   updated_at=updated_at + datetime.timedelta(days=days))
+                JiraTaskUpdated.create(task=task, updated_at=task.updated_at)
+            CompaniesMgr.rebuild_daily_totals(company.id)
+
+            migrations.migrate()
+
+            # the one updated last is kept (the first one when they're even), and the totals count only what's left
+            self.assertTrue(sorted((t.description, t.time_spent_seconds) for t in Task.select()) ==
+                            [('DEV-1 coding', 900), ('standup', 10)])
+            self.assertTrue(dict((t.issue_key, t.time_spent_seconds) for t in DailyTotal.select()) ==
+                            {'DEV-1': 900, '': 10})
+            # the tasks kept are still up to date on jira
+            self.assertTrue(sorted(t.task.time_spent_seconds for t in JiraTaskUpdated.select()) == [10, 900])
+            self.assertTrue(migrations.remove_duplicated_tasks() == 0)
+            self.assertRaises(IntegrityError, Task.create, company=company, date=date, description='standup',
+                              time_spent_seconds=1)
+
+
+class TestDatabase(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.database = PooledSqliteDatabase(self.path, busy_timeout=10, pool_size=2)
+        self.database.execute_sql('CREATE TABLE counter (id INTEGER PRIMARY KEY, value INTEGER)')
+        self.database.execute_sql('INSERT INTO counter VALUES (1, 0)')
+
+    def tearDown(self):
+        release_connection(self.database)
+        self.database.close_idle()
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def get_value(self):
+        return self.database.execute_sql('SELECT value FROM counter').fetchone()[0]
+
+    def test_pragmas(self):
+        self.assertTrue(self.database.execute_sql('PRAGMA journal_mode').fetchone()[0] == 'wal')
+        self.assertTrue(self.database.execute_sql('PRAGMA synchronous').fetchone()[0] == 1)
+
+    def test_concurrent_writers(self):
+        errors = []
+
+        def increment():
+            try:
+                for i in range(20):
+                    # reading and then writing inside the transaction is safe, as it takes the write lock first
+                    with self.database.transaction():
+                        value = self.get_value()
+                        self.database.execute_sql('UPDATE counter SET value = ?', (value + 1,))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                release_connection(self.database)
+
+        threads = [threading.Thread(target=increment) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(errors == [])
+        # the connections of the threads (and this one's) were kept to be reused, up to the size of the pool
+        release_connection(self.database)
+        self.assertTrue(len(self.database._pool) == 2)
+        self.assertTrue(self.get_value() == 80)
+
+    def test_readers_dont_wait_for_the_writer(self):
+        writing = threading.Event()
+        done = threading.Event()
+
+        def write():
+            with self.database.transaction():
+                self.database.execute_sql('UPDATE counter SET value = 1')
+                writing.set()
+                done.wait(5)
+            release_connection(self.database)
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        writing.wait(5)
+
+        start = time.time()
+        self.assertTrue(self.get_value() == 0)
+        self.assertTrue(time.time() - start < 1)
+
+        done.set()
+        thread.join()
+        self.assertTrue(self.get_value() == 1)
+
+
+class TestPluginPool(unittest.TestCase):
+    def test_plugins_are_reused(self):
+        responses = test_data['companies'][0]['time_tracking_data']['responses']
+        PluginsManager.reset_pool()
+        plugin = PluginsManager.get_time_tracking_plugin('test.TimeTrackingTestPlugin', responses=responses)
+
+        self.assertTrue(plugin is PluginsManager.get_time_tracking_plugin('test.TimeTrackingTestPlugin',
+                                                                          responses=copy.deepcopy(responses)))
+        self.assertFalse(plugin is PluginsManager.get_time_tracking_plugin('test.TimeTrackingTestPlugin',
+                                                                           responses={}))
+
+        PluginsManager.reset_pool()
+        self.assertFalse(plugin is PluginsManager.get_time_tracking_plugin('test.TimeTrackingTestPlugin',
+                                                                           responses=responses))
+
+    def test_eviction(self):
+        now = [0]
+        closed = []
+
+        class Closeable(object):
+            def close(self):
+                closed.append(self)
+
+        pool = PluginPool(ttl=10, max_size=2, clock=lambda: now[0])
+        first = pool.get('first', {}, Closeable)
+        pool.get('second', {}, Closeable)
+
+        # using it refreshes its position, so the least recently used one is 'second'
+        self.assertTrue(pool.get('first', {}, Closeable) is first)
+        pool.get('third', {}, Closeable)
+        self.assertTrue(len(closed) == 1 and len(pool) == 2)
+
+        now[0] = 20
+        self.assertFalse(pool.get('first', {}, Closeable) is first)
+        self.assertTrue(len(closed) == 3 and len(pool) == 1)
+
+    def test_slow_creations_dont_block_the_pool(self):
+        pool = PluginPool()
+        started = threading.Event()
+        release = threading.Event()
+        created = []
+        results = []
+
+        def slow_factory():
+            created.append('slow')
+            started.set()
+            release.wait(5)
+            return object()
+
+        def get_slow():
+            results.append(pool.get('slow', {}, slow_factory))
+
+        threads = [threading.Thread(target=get_slow) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        started.wait(5)
+
+        # while the slow one is being created, the rest of the pool can be used
+        fast = []
+        thread = threading.Thread(target=lambda: fast.append(pool.get('fast', {}, object)))
+        thread.start()
+        thread.join(2)
+        self.assertTrue(len(fast) == 1 and not release.is_set())
+
+        release.set()
+        for thread in threads:
+            thread.join()
+        # the threads waiting for the same instance get the one created
+        self.assertTrue(created == ['slow'] and results[0] is results[1])
+        self.assertTrue(len(pool) == 2)
+
+
+class TestThrottling(unittest.TestCase):
+    def test_token_bucket(self):
+        now = [0.0]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        bucket = TokenBucket(2, capacity=2, clock=lambda: now[0], sleep=sleep)
+        for i in range(6):
+            bucket.acquire()
+
+        # the first two are the burst, the other four have to wait for the refill at 2 per second
+        self.assertTrue(math.fabs(now[0] - 2) < 0.001)
+
+    def test_retries(self):
+        attempts = []
+
+        def fail_twice():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise JIRAError(429, 'throttled')
+            return 'done'
+
+        self.assertTrue(call_with_retries(fail_twice, is_retryable_error, backoff=0) == 'done')
+
+        del attempts[:]
+        self.assertRaises(JIRAError, call_with_retries, fail_twice, is_retryable_error, max_retries=1, backoff=0)
+
+        def not_found():
+            attempts.append(1)
+            raise JIRAError(404, 'not found')
+
+        del attempts[:]
+        self.assertRaises(JIRAError, call_with_retries, not_found, is_retryable_error, backoff=0)
+        self.assertTrue(len(attempts) == 1)
+
+
+class TestNetworkEfficiency(unittest.TestCase):
+    def test_notification_http_calls(self):
+        for run, res in benchmarks.benchmark_notifications(companies=2, tasks=10, issues=3):
+            self.assertTrue(res['http_calls'] <= res['max_http_calls'])
+
+
+class TestStorageBenchmark(unittest.TestCase):
+    def test_storage_benchmark(self):
+        results = benchmarks.benchmark_storage(companies=2, days=3, tasks_per_day=4)
+
+        self.assertTrue(results['ingest']['operations'] == 2 * 3 * 4)
+        self.assertTrue(results['pending_tasks_all']['operations'] == 2 * 3 * 4)
+        # one of every three tasks changed on the re-ingest
+        self.assertTrue(results['pending_tasks_changed']['operations'] == 2 * 3 * 2)
+
+    def test_ingestion_benchmark(self):
+        results = benchmarks.benchmark_ingestion(companies=5, days=3, entries_per_day=4)
+
+        self.assertTrue(results['operations'] == 5 * 3 * 4)
+
+
+def get_aggregated_time_tracking_results(results):
+    return TimeTrackingAggregator().add_entries(results).get_totals(None)
 
 
 def main():